@@ -9,7 +9,15 @@ from sys import exit, stderr
 from .introspection import (
     get_listing_operations, get_services, get_verbs, introspect_regions_for_service, recreate_caches
 )
-from .query import do_list_files, do_query
+from .changes import FULL_SWEEP_INTERVAL
+from .diff import do_diff
+from .distribute import LEASE_SECONDS, do_coordinate, do_work
+from .export import do_export
+from .index import INDEXES
+from .listing import load_query_profile
+from .query import do_list_files, do_query, do_reprocess, plan_queries
+from .serve import do_serve
+from .watch import DEFAULT_REFRESH_INTERVAL, do_watch
 
 CAN_SET_OPEN_FILE_LIMIT = False
 try:
@@ -91,6 +99,120 @@ def main():
     query.add_argument('-d', '--directory', default='.', help='Directory to save result listings to')
     query.add_argument('-v', '--verbose', action='count', help='Print detailed info during run')
     query.add_argument('-c', '--profile', help='Use a specific .aws/credentials profile.')
+    query.add_argument(
+        '--ignore-observed-availability',
+        action='store_true',
+        help='Also query services in regions where previous queries found all their operations unavailable'
+    )
+    query.add_argument(
+        '--schedule',
+        choices=['longest-first', 'locality', 'random'],
+        default='longest-first',
+        help=(
+            'Order of queries: longest first by the durations of previous runs (default), in small batches per '
+            'endpoint that reuse warm connections (locality), or random'
+        )
+    )
+    query.add_argument(
+        '--no-prewarm',
+        action='store_true',
+        help='Do not open connections to the endpoints in the background ahead of their first query'
+    )
+    query.add_argument(
+        '--simulate',
+        action='store_true',
+        help='Do not query, but print the expected run time of each schedule based on previous runs'
+    )
+    query.add_argument(
+        '--expand-children',
+        action='store_true',
+        help=(
+            'Also query operations that need the identifier of a parent resource (e.g. ECS services per cluster) '
+            'for every found parent resource. With --operation, both parent and child operations must be selected.'
+        )
+    )
+    query.add_argument(
+        '--child-fanout',
+        default=100,
+        type=int,
+        help='Maximum number of parent resources to query each child operation for (default: 100)'
+    )
+    query.add_argument(
+        '--report',
+        help=(
+            'Write a record with timing and classification of every query to this run report file as results '
+            'arrive (JSON lines, or CSV if the name ends with .csv), and only print a summary at the end'
+        )
+    )
+    query.add_argument(
+        '--store',
+        help=(
+            'Also add the listings to the snapshot store in this directory, where unchanged listings of '
+            'successive runs are only stored once'
+        )
+    )
+    query.add_argument(
+        '--record',
+        help=(
+            'Record the raw responses of all queries to a cassette in this directory, '
+            'so that the run can be reprocessed later without AWS requests'
+        )
+    )
+    query.add_argument(
+        '--export',
+        help='Also export all found resources to a Parquet dataset in this directory, partitioned by service and region'
+    )
+    query.add_argument(
+        '--changes-only',
+        action='store_true',
+        help=(
+            'Only query listings affected by changes that CloudTrail reports since the last run with this option, '
+            'and everything if the last full sweep is older than --full-sweep-interval'
+        )
+    )
+    query.add_argument(
+        '--cloudtrail-directory',
+        help='With --changes-only, read CloudTrail log files (e.g. exported from S3) from this directory instead'
+    )
+    query.add_argument(
+        '--full-sweep-interval',
+        default=FULL_SWEEP_INTERVAL,
+        type=int,
+        help='With --changes-only, seconds after which everything is queried again (default: {})'.
+        format(FULL_SWEEP_INTERVAL)
+    )
+    query.add_argument(
+        '--query-profile',
+        help=(
+            'JSON file with additional parameters (e.g. filters) and JMESPath projections of response items '
+            'per service and operation, to request and keep only the needed resources and fields'
+        )
+    )
+    query.add_argument(
+        '--tags',
+        action='store_true',
+        help='Join the tags of the resources, fetched in bulk once per region from the Resource Groups Tagging API'
+    )
+    query.add_argument(
+        '--index',
+        choices=INDEXES,
+        help=(
+            'Ask this resource index which services and regions contain resources first, query those first '
+            'and the services it does not cover afterwards'
+        )
+    )
+    query.add_argument(
+        '--index-region',
+        default='us-east-1',
+        help='With --index, the region of the Resource Explorer aggregator index or Config aggregator'
+    )
+    query.add_argument('--index-view', help='With --index resource-explorer, the ARN of the view to search')
+    query.add_argument('--config-aggregator', help='With --index config, the name of the configuration aggregator')
+    query.add_argument(
+        '--index-deprioritize',
+        action='store_true',
+        help='With --index, query service/region pairs the index reports empty last instead of skipping them'
+    )
 
     # Once you have queried, show is the next most important command. So it comes second
     show = subparsers.add_parser(
@@ -98,6 +220,213 @@ def main():
     )
     show.add_argument('listingfile', nargs='*', help='listing file(s) to load and print')
     show.add_argument('-v', '--verbose', action='count', help='print given listing files with detailed info')
+    show.add_argument(
+        '-p',
+        '--parallel',
+        default=None,
+        type=int,
+        help='Number of processes parsing listing files (default: number of CPUs)'
+    )
+    show.add_argument(
+        '--summary-only',
+        action='store_true',
+        help='Only print resource counts, taken from the run manifest without parsing the listing files if possible'
+    )
+
+    diff = subparsers.add_parser(
+        'diff',
+        description=(
+            'Show resources that were added (+), removed (-) or changed (~) between two directories of '
+            'listing files, e.g. from two query runs'
+        ),
+        help='Compare saved listings of two runs'
+    )
+    diff.add_argument('old', help='directory with the older listing files')
+    diff.add_argument('new', help='directory with the newer listing files')
+    diff.add_argument('-v', '--verbose', action='count', help='also print the changed attributes of resources')
+
+    export = subparsers.add_parser(
+        'export',
+        description=(
+            'Export the resources of saved listings to a Parquet dataset, partitioned by service and region, with '
+            'the columns profile, operation, resource_type, id, arn and the resource as JSON in item'
+        ),
+        help='Export saved listings to Parquet'
+    )
+    export.add_argument('listingfile', nargs='+', help='listing file(s) to export')
+    export.add_argument('-o', '--output', required=True, help='directory of the Parquet dataset')
+
+    reprocess = subparsers.add_parser(
+        'reprocess',
+        description=(
+            'Derive and save the listings of a run recorded with query --record from its cassette, '
+            'without making any AWS requests'
+        ),
+        help='Reprocess recorded raw responses'
+    )
+    reprocess.add_argument('cassette', help='directory of the cassette recorded with query --record')
+    reprocess.add_argument('-d', '--directory', default='.', help='Directory to save result listings to')
+    reprocess.add_argument('-v', '--verbose', action='count', help='Print detailed info during run')
+    reprocess.add_argument(
+        '-p',
+        '--parallel',
+        default=None,
+        type=int,
+        help='Number of processes reprocessing the cassette (default: number of CPUs)'
+    )
+
+    serve = subparsers.add_parser(
+        'serve',
+        description=(
+            'Keep boto3 clients, query plans and caches loaded and execute scans requested over local HTTP, '
+            'e.g. curl "http://127.0.0.1:8080/query?service=ec2&region=eu-west-1". '
+            'Results are streamed as one JSON line per query.'
+        ),
+        help='Serve scan requests from a warm process'
+    )
+    serve.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    serve.add_argument('--port', default=8080, type=int, help='Port to listen on (default: 8080)')
+    serve.add_argument('--socket', help='Listen on this Unix domain socket instead of a TCP port')
+    serve.add_argument('-p', '--parallel', default=32, type=int, help='Number of request to do in parallel per scan')
+    serve.add_argument('-d', '--directory', default='.', help='Directory to save result listings to')
+    serve.add_argument('-v', '--verbose', action='count', help='Print detailed info during run')
+    serve.add_argument('-c', '--profile', help='Use a specific .aws/credentials profile.')
+
+    watch = subparsers.add_parser(
+        'watch',
+        description=(
+            'Query AWS continuously, refreshing each listing on its own interval (short for often changing '
+            'services like ec2 and lambda) within a request budget, and print a JSON line for every listing '
+            'whose resources changed'
+        ),
+        help='Query AWS continuously and report changes'
+    )
+    watch.add_argument(
+        '-s',
+        '--service',
+        action='append',
+        help='Restrict watching to the given service (can be specified multiple times)'
+    )
+    watch.add_argument(
+        '-r',
+        '--region',
+        action='append',
+        help='Restrict watching to the given region (can be specified multiple times)'
+    )
+    watch.add_argument(
+        '-o',
+        '--operation',
+        action='append',
+        help='Restrict watching to the given operation (can be specified multiple times)'
+    )
+    watch.add_argument('-p', '--parallel', default=8, type=int, help='Number of request to do in parallel')
+    watch.add_argument('-d', '--directory', default='.', help='Directory to save changed listings to')
+    watch.add_argument('-v', '--verbose', action='count', help='Print detailed info during run')
+    watch.add_argument('-c', '--profile', help='Use a specific .aws/credentials profile.')
+    watch.add_argument(
+        '--rate', default=5.0, type=float, help='Maximum number of requests per second on average (default: 5)'
+    )
+    watch.add_argument(
+        '--default-interval',
+        default=DEFAULT_REFRESH_INTERVAL,
+        type=int,
+        help='Seconds between refreshes of services without a specific interval (default: {})'.
+        format(DEFAULT_REFRESH_INTERVAL)
+    )
+    watch.add_argument('--duration', type=int, help='Stop watching after this many seconds')
+
+    coordinate = subparsers.add_parser(
+        'coordinate',
+        description=(
+            'Plan a scan and hand out its queries to workers (see work) on other machines over HTTP, with leases '
+            'that expire and retries, merging their results into the listing files of this directory'
+        ),
+        help='Distribute a scan to workers'
+    )
+    coordinate.add_argument(
+        '-s',
+        '--service',
+        action='append',
+        help='Restrict the scan to the given service (can be specified multiple times)'
+    )
+    coordinate.add_argument(
+        '-r',
+        '--region',
+        action='append',
+        help='Restrict the scan to the given region (can be specified multiple times)'
+    )
+    coordinate.add_argument(
+        '-o',
+        '--operation',
+        action='append',
+        help='Restrict the scan to the given operation (can be specified multiple times)'
+    )
+    coordinate.add_argument(
+        '-c',
+        '--profile',
+        action='append',
+        help=(
+            'Scan with the given .aws/credentials profile, which the workers must have '
+            '(can be specified multiple times)'
+        )
+    )
+    coordinate.add_argument('--host', default='127.0.0.1', help='Address to listen on (default: 127.0.0.1)')
+    coordinate.add_argument('--port', default=8081, type=int, help='Port to listen on (default: 8081)')
+    coordinate.add_argument(
+        '--queue',
+        default='aws_list_all_queue.sqlite',
+        help='SQLite work queue file in the directory (default: %(default)s)'
+    )
+    coordinate.add_argument(
+        '--resume',
+        action='store_true',
+        help='Resume the unfinished scan in the existing queue file, which must have been planned for the same queries'
+    )
+    coordinate.add_argument(
+        '--token',
+        default=os.environ.get('AWS_LIST_ALL_TOKEN'),
+        help=(
+            'Shared token that workers must send; required to listen on other addresses than localhost safely '
+            '(default: $AWS_LIST_ALL_TOKEN)'
+        )
+    )
+    coordinate.add_argument(
+        '--lease-seconds',
+        default=LEASE_SECONDS,
+        type=int,
+        help='Seconds after which queries of unresponsive workers are handed out again (default: %(default)s)'
+    )
+    coordinate.add_argument(
+        '--expand-children',
+        action='store_true',
+        help=(
+            'Also query operations that need the identifier of a parent resource (e.g. ECS services per cluster) '
+            'for every found parent resource. With --operation, both parent and child operations must be selected.'
+        )
+    )
+    coordinate.add_argument(
+        '--child-fanout',
+        default=100,
+        type=int,
+        help='Maximum number of parent resources to query each child operation for (default: 100)'
+    )
+    coordinate.add_argument('-d', '--directory', default='.', help='Directory to save result listings to')
+    coordinate.add_argument('-v', '--verbose', action='count', help='Print detailed info during run')
+
+    work = subparsers.add_parser(
+        'work',
+        description='Execute queries of a distributed scan handed out by a coordinator',
+        help='Work for a coordinator'
+    )
+    work.add_argument('coordinator', help='URL of the coordinator, e.g. http://10.0.0.1:8081/')
+    work.add_argument('-p', '--parallel', default=32, type=int, help='Number of request to do in parallel')
+    work.add_argument('--worker', help='Name of this worker (default: host name and process id)')
+    work.add_argument(
+        '--token',
+        default=os.environ.get('AWS_LIST_ALL_TOKEN'),
+        help='Shared token of the coordinator (default: $AWS_LIST_ALL_TOKEN)'
+    )
+    work.add_argument('-v', '--verbose', action='count', help='Print detailed info during run')
 
     # Introspection debugging is not the main function. So we put it all into a subcommand.
     introspect = subparsers.add_parser(
@@ -153,10 +482,27 @@ def main():
             'Use this only if you run a copy from git.'
         )
     )
+    caches.add_argument(
+        '--incremental',
+        action='store_true',
+        help=(
+            'Only resolve service/region pairs that are missing from the current service region cache, '
+            'e.g. services or regions added in a new boto3 version.'
+        )
+    )
 
     args = parser.parse_args()
 
     if args.command == 'query':
+        if args.index == 'config' and not args.config_aggregator:
+            parser.error('--index config requires --config-aggregator')
+        if args.query_profile:
+            load_query_profile(args.query_profile)
+        report_filename = os.path.abspath(args.report) if args.report else None
+        store_directory = os.path.abspath(args.store) if args.store else None
+        record_directory = os.path.abspath(args.record) if args.record else None
+        export_directory = os.path.abspath(args.export) if args.export else None
+        cloudtrail_directory = os.path.abspath(args.cloudtrail_directory) if args.cloudtrail_directory else None
         if args.directory:
             try:
                 os.makedirs(args.directory)
@@ -171,15 +517,110 @@ def main():
             args.operation,
             verbose=args.verbose or 0,
             parallel=args.parallel,
-            selected_profile=args.profile
+            selected_profile=args.profile,
+            use_observed_availability=not args.ignore_observed_availability,
+            schedule=args.schedule,
+            simulate=args.simulate,
+            expand_children=args.expand_children,
+            child_fanout=args.child_fanout,
+            report_filename=report_filename,
+            store_directory=store_directory,
+            record_directory=record_directory,
+            export_directory=export_directory,
+            changes_only=args.changes_only,
+            cloudtrail_directory=cloudtrail_directory,
+            full_sweep_interval=args.full_sweep_interval,
+            resource_index=args.index,
+            index_region=args.index_region,
+            index_view=args.index_view,
+            config_aggregator=args.config_aggregator,
+            skip_empty=not args.index_deprioritize,
+            tags=args.tags,
+            prewarm=not args.no_prewarm
         )
     elif args.command == 'show':
         if args.listingfile:
-            increase_limit_nofiles()
-            do_list_files(args.listingfile, verbose=args.verbose or 0)
+            do_list_files(
+                args.listingfile,
+                verbose=0 if args.summary_only else args.verbose or 0,
+                parallel=args.parallel,
+                summary_only=args.summary_only
+            )
         else:
             show.print_help()
             return 1
+    elif args.command == 'watch':
+        if args.directory:
+            try:
+                os.makedirs(args.directory)
+            except OSError:
+                pass
+            os.chdir(args.directory)
+        if args.rate <= 0:
+            parser.error('--rate must be positive')
+        increase_limit_nofiles()
+        to_run = plan_queries(
+            args.service or get_services(), args.region, args.operation, args.verbose or 0, args.profile
+        )
+        do_watch(
+            to_run,
+            rate=args.rate,
+            parallel=args.parallel,
+            default_interval=args.default_interval,
+            duration=args.duration,
+            verbose=args.verbose or 0
+        )
+    elif args.command == 'coordinate':
+        if args.directory:
+            try:
+                os.makedirs(args.directory)
+            except OSError:
+                pass
+            os.chdir(args.directory)
+        to_run = []
+        for profile in args.profile or [None]:
+            to_run.extend(
+                plan_queries(args.service or get_services(), args.region, args.operation, args.verbose or 0, profile)
+            )
+        return do_coordinate(
+            to_run,
+            args.host,
+            args.port,
+            args.queue,
+            args.lease_seconds,
+            verbose=args.verbose or 0,
+            expand_children=args.expand_children,
+            child_fanout=args.child_fanout,
+            selected_operations=args.operation,
+            resume=args.resume,
+            token=args.token
+        )
+    elif args.command == 'work':
+        increase_limit_nofiles()
+        do_work(args.coordinator, args.parallel, args.worker, verbose=args.verbose or 0, token=args.token)
+    elif args.command == 'serve':
+        socket_path = os.path.abspath(args.socket) if args.socket else None
+        if args.directory:
+            try:
+                os.makedirs(args.directory)
+            except OSError:
+                pass
+            os.chdir(args.directory)
+        increase_limit_nofiles()
+        do_serve(args.host, args.port, socket_path, args.parallel, args.profile, verbose=args.verbose or 0)
+    elif args.command == 'export':
+        do_export(args.listingfile, args.output)
+    elif args.command == 'reprocess':
+        cassette_directory = os.path.abspath(args.cassette)
+        if args.directory:
+            try:
+                os.makedirs(args.directory)
+            except OSError:
+                pass
+            os.chdir(args.directory)
+        do_reprocess(cassette_directory, verbose=args.verbose or 0, parallel=args.parallel)
+    elif args.command == 'diff':
+        do_diff(args.old, args.new, verbose=args.verbose or 0)
     elif args.command == 'introspect':
         if args.introspect == 'list-services':
             for service in get_services():
@@ -200,7 +641,7 @@ def main():
             return 1
     elif args.command == 'recreate-caches':
         increase_limit_nofiles()
-        recreate_caches(args.update_packaged_values)
+        recreate_caches(args.update_packaged_values, incremental=args.incremental)
     else:
         parser.print_help()
         return 1
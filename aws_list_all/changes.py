@@ -0,0 +1,234 @@
+from __future__ import print_function
+
+import gzip
+import json
+import os
+import re
+from collections import defaultdict
+from datetime import datetime, timezone
+from itertools import chain
+
+from app_json_file_cache.data_cache import DataCache
+
+from .client import get_client
+from .introspection import get_global_services
+
+last_scan_cache = DataCache('aws_list_all', 'last_scans')
+
+# Seconds after which a full sweep is done even if CloudTrail reports no changes
+FULL_SWEEP_INTERVAL = 24 * 3600
+
+# CloudTrail delivers events up to about 15 minutes late, so events are read from this long before the last scan
+CLOUDTRAIL_DELIVERY_DELAY = 15 * 60
+
+# CloudTrail reports the events of global services, e.g. IAM, in this region
+GLOBAL_EVENTS_REGION = 'us-east-1'
+
+# Services whose CloudTrail event source differs from their boto3 service name
+EVENT_SOURCE_SERVICES = {
+    'elasticloadbalancing': ['elb', 'elbv2'],
+    'email': ['ses', 'sesv2'],
+    'es': ['es', 'opensearch'],
+    'monitoring': ['cloudwatch'],
+    'states': ['stepfunctions'],
+    'tagging': [],
+}
+
+# Resource nouns of the listings that events change as a side effect, besides the listings of their own nouns
+SIDE_EFFECT_NOUNS = {
+    # Instances are launched with volumes and network interfaces
+    ('ec2', 'RunInstances'): ('volume', 'networkinterface'),
+    # Images are backed by snapshots of the volumes of the instance
+    ('ec2', 'CreateImage'): ('snapshot', ),
+}
+
+# First words of event names of operations that do not change resources
+READ_ONLY_VERBS = ('BatchGet', 'Describe', 'Get', 'List', 'Lookup', 'Search', 'Head', 'Select', 'Scan', 'Query')
+
+
+def get_event_services(event_source):
+    """Return the boto3 service names of a CloudTrail event source, e.g. ec2.amazonaws.com"""
+    prefix = event_source.split('.')[0]
+    return EVENT_SOURCE_SERVICES.get(prefix, [prefix])
+
+
+def get_singular(noun):
+    """Return the singular of the given lower-cased noun"""
+    if noun.endswith('ies'):
+        return noun[:-3] + 'y'
+    if noun.endswith('sses'):
+        return noun[:-2]
+    return noun[:-1] if noun.endswith('s') and not noun.endswith('ss') else noun
+
+
+def get_resource_noun(name):
+    """Return the lower-cased resource noun of an event or operation name without its verb and plural,
+    e.g. securitygroup for CreateSecurityGroup and DescribeSecurityGroups"""
+    words = re.findall('[A-Z][a-z0-9]*|[a-z0-9]+', name)
+    return get_singular(''.join(words[1:]).lower() if len(words) > 1 else name.lower())
+
+
+def get_event_nouns(service, event_name):
+    """Return the resource nouns of the listings the given event may change: the nouns of the leading words after
+    its verb, e.g. securitygroup and securitygroupingress for AuthorizeSecurityGroupIngress, and the nouns of the
+    resources it changes as a side effect"""
+    words = re.findall('[A-Z][a-z0-9]*|[a-z0-9]+', event_name)[1:]
+    nouns = set(get_singular(''.join(words[:length]).lower()) for length in range(1, len(words) + 1))
+    return nouns | set(SIDE_EFFECT_NOUNS.get((service, event_name), ()))
+
+
+def is_mutating_event(event_name, read_only=None):
+    """Return whether the given event changes resources"""
+    if read_only is not None:
+        return not read_only
+    return not event_name.startswith(READ_ONLY_VERBS)
+
+
+def select_changed_queries(to_run, events, global_services=()):
+    """Return the queries of to_run whose listings may have been changed by the given (service, region, event name)
+    events. An event affects the listing operations of its service in its region (or in any region, for global
+    queries and services) whose resource noun is one of the event's nouns, or all listing operations of the service
+    if none matches."""
+    affected = set()
+    for service, region, event_name in events:
+        candidates = [
+            query for query in to_run
+            if query[0] == service and (query[1] == region or query[1] is None or service in global_services)
+        ]
+        nouns = get_event_nouns(service, event_name)
+        matching = [query for query in candidates if get_resource_noun(query[2]) in nouns]
+        affected.update(tuple(query[:4]) for query in (matching or candidates))
+    return [query for query in to_run if tuple(query[:4]) in affected]
+
+
+def lookup_events(region, since, profile=None):
+    """Yield (service, region, event name, event time) of the mutating CloudTrail management events in the given
+    region since the given time"""
+    client = get_client('cloudtrail', region, profile)
+    paginator = client.get_paginator('lookup_events')
+    pages = paginator.paginate(
+        LookupAttributes=[{
+            'AttributeKey': 'ReadOnly',
+            'AttributeValue': 'false'
+        }],
+        StartTime=datetime.fromtimestamp(since, timezone.utc)
+    )
+    for page in pages:
+        for event in page['Events']:
+            for service in get_event_services(event['EventSource']):
+                yield service, region, event['EventName'], event['EventTime'].timestamp()
+
+
+def read_log_directory(directory, since):
+    """Yield (service, region, event name, event time) of the mutating events in the CloudTrail log files
+    (e.g. exported from S3) in the given directory since the given time"""
+    since_time = datetime.fromtimestamp(since, timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+    for path, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if filename.endswith('.json.gz'):
+                log_file = gzip.open(os.path.join(path, filename), 'rt')
+            elif filename.endswith('.json'):
+                log_file = open(os.path.join(path, filename))
+            else:
+                continue
+            with log_file:
+                records = json.load(log_file).get('Records', [])
+            for record in records:
+                if record.get('eventTime', '') < since_time:
+                    continue
+                if not is_mutating_event(record['eventName'], record.get('readOnly')):
+                    continue
+                event_time = datetime.strptime(record['eventTime'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc)
+                for service in get_event_services(record['eventSource']):
+                    yield service, record.get('awsRegion'), record['eventName'], event_time.timestamp()
+
+
+def get_last_scans(profile=None):
+    """Return a dict of the services scanned with the given profile to dicts of their regions ('' for global
+    queries) to the times of the last scan and the last full sweep, and the pending operations whose queries
+    failed in the last scan"""
+    try:
+        return last_scan_cache.get({}).get(profile or '', {})
+    except KeyError:
+        return {}
+
+
+def record_scan(start_time, scopes, failed=(), profile=None):
+    """Record the start time of a completed scan of the given dict of (service, region) scopes to whether they
+    were swept fully. The operations of the given failed (service, region, operation) queries stay pending,
+    and are queried again by the next scan of their scope until they succeed."""
+    try:
+        last_scans = last_scan_cache.get({})
+    except KeyError:
+        last_scans = {}
+    pending = defaultdict(set)
+    for service, region, operation in failed:
+        pending[(service, region)].add(operation)
+    profile_scans = last_scans.setdefault(profile or '', {})
+    for (service, region), full_sweep in scopes.items():
+        scope_scans = profile_scans.setdefault(service, {}).setdefault(region or '', {})
+        scope_scans['scan'] = start_time
+        if full_sweep:
+            scope_scans['full_sweep'] = start_time
+        scope_scans['pending'] = sorted(pending[(service, region)])
+    last_scan_cache.store({}, last_scans)
+
+
+def read_events(to_run, profile=None, cloudtrail_directory=None, since=0, now=0):
+    """Return the (service, region, event name, event time) events of the regions of to_run since the given time"""
+    if cloudtrail_directory:
+        return list(read_log_directory(cloudtrail_directory, since))
+    events = []
+    regions = set(query[1] or GLOBAL_EVENTS_REGION for query in to_run)
+    for region in sorted(regions):
+        try:
+            events.extend(lookup_events(region, since, profile))
+        except Exception as exc:  # pylint:disable=broad-except
+            # Without events of a region, everything in it may have changed
+            print('Cannot read CloudTrail events in {}: {!r}'.format(region, exc))
+            events.extend((service, region, '', now) for service in set(query[0] for query in to_run))
+    return events
+
+
+def plan_changed_queries(
+    to_run, profile=None, cloudtrail_directory=None, full_sweep_interval=FULL_SWEEP_INTERVAL, now=None
+):
+    """Return the queries of to_run to execute, and a dict of the (service, region) scopes of to_run to whether
+    they are swept fully. Scopes without a recent full sweep are swept fully, and of the others, the queries that
+    failed in their last scan and the queries affected by the changes reported by CloudTrail since their last scan
+    are executed."""
+    last_scans = get_last_scans(profile)
+    now = now or datetime.now(timezone.utc).timestamp()
+    scopes = {}
+    selected = set()
+    queries_since = defaultdict(list)
+    for query in to_run:
+        service, region, operation = query[:3]
+        scope_scans = last_scans.get(service, {}).get(region or '', {})
+        full_sweep = 'scan' not in scope_scans or now - scope_scans.get('full_sweep', 0) > full_sweep_interval
+        scopes[(service, region)] = full_sweep
+        if full_sweep or operation in scope_scans.get('pending', ()):
+            selected.add(tuple(query[:4]))
+        else:
+            queries_since[scope_scans['scan'] - CLOUDTRAIL_DELIVERY_DELAY].append(query)
+    swept = sum(scopes.values())
+    if swept:
+        print('No recent full sweep of {} services and regions, querying them fully.'.format(swept))
+    if not queries_since:
+        return to_run, scopes
+    events = read_events(
+        list(chain.from_iterable(queries_since.values())), profile, cloudtrail_directory, min(queries_since), now
+    )
+    changed = 0
+    global_services = get_global_services()
+    for since, queries in queries_since.items():
+        events_since = [event[:3] for event in events if event[3] >= since]
+        affected = select_changed_queries(queries, events_since, global_services)
+        changed += len(affected)
+        selected.update(tuple(query[:4]) for query in affected)
+    print(
+        '{} mutating CloudTrail events since the last scan affect {} of {} queries.'.format(
+            len(events), changed, sum(len(queries) for queries in queries_since.values())
+        )
+    )
+    return [query for query in to_run if tuple(query[:4]) in selected], scopes
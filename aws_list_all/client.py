@@ -1,11 +1,105 @@
+from collections import OrderedDict
+from threading import Lock
+
 import boto3
 
-_CLIENTS = {}
+CAN_GET_RUSAGE = False
+try:
+    from resource import getrusage, RUSAGE_SELF
+    CAN_GET_RUSAGE = True
+except ImportError:
+    pass
+
+# Number of cached clients above which the least recently used ones are dropped from the cache
+MAX_CLIENTS = 256
+
+_CLIENTS = OrderedDict()
+_REMAINING_WORK = {}
+_DONE_WORK = set()
+_CLIENT_STATS = {'created': 0, 'evicted_done': 0, 'evicted_lru': 0, 'max_cached': 0}
+_LOCK = Lock()
+
+
+def get_client(service, region=None, profile=None, unless_done=False):
+    """Return (cached) boto3 clients for this service and this region. With unless_done, return None instead
+    if all registered work of the client is done, which is checked atomically with caching a new client,
+    so that no client is cached after its work was done."""
+    key = (service, region, profile)
+    with _LOCK:
+        if unless_done and key in _DONE_WORK:
+            return None
+        if key in _CLIENTS:
+            _CLIENTS.move_to_end(key)
+            return _CLIENTS[key]
+    client = boto3.Session(region_name=region, profile_name=profile).client(service)
+    with _LOCK:
+        if unless_done and key in _DONE_WORK:
+            # The work was done while the client was created
+            cached = None
+        elif key in _CLIENTS:
+            # Another thread created the client in the meantime
+            cached = _CLIENTS[key]
+        else:
+            _CLIENTS[key] = client
+            _CLIENT_STATS['created'] += 1
+            while len(_CLIENTS) > MAX_CLIENTS:
+                # Clients may still be in use by other threads, so they are not closed, only no longer cached
+                _CLIENTS.popitem(last=False)
+                _CLIENT_STATS['evicted_lru'] += 1
+            _CLIENT_STATS['max_cached'] = max(_CLIENT_STATS['max_cached'], len(_CLIENTS))
+            return client
+    client.close()
+    return cached
+
 
+def expect_work(queries):
+    """Register the given [service, region, operation, profile] queries as work that will use cached clients"""
+    with _LOCK:
+        for query in queries:
+            key = (query[0], query[1], query[3])
+            _REMAINING_WORK[key] = _REMAINING_WORK.get(key, 0) + 1
+            _DONE_WORK.discard(key)
 
-def get_client(service, region=None, profile=None):
-    """Return (cached) boto3 clients for this service and this region"""
+
+def finish_work(service, region=None, profile=None):
+    """Register that a query of the given client is done, and close and evict the client if it was the last one"""
     key = (service, region, profile)
-    if key not in _CLIENTS:
-        _CLIENTS[key] = boto3.Session(region_name=region, profile_name=profile).client(service)
-    return _CLIENTS[key]
+    with _LOCK:
+        if key not in _REMAINING_WORK:
+            return
+        _REMAINING_WORK[key] -= 1
+        if _REMAINING_WORK[key] > 0:
+            return
+        del _REMAINING_WORK[key]
+        _DONE_WORK.add(key)
+        client = _CLIENTS.pop(key, None)
+        if client is None:
+            return
+        _CLIENT_STATS['evicted_done'] += 1
+    client.close()
+
+
+def is_work_done(service, region=None, profile=None):
+    """Return whether all registered queries of the given client are done"""
+    with _LOCK:
+        return (service, region, profile) in _DONE_WORK
+
+
+def get_client_stats():
+    """Return the numbers of created, evicted and at most cached clients, and the peak memory use in MB,
+    if available"""
+    with _LOCK:
+        stats = dict(_CLIENT_STATS, cached=len(_CLIENTS))
+    if CAN_GET_RUSAGE:
+        # Linux reports the peak resident set size in KB
+        stats['max_rss_mb'] = getrusage(RUSAGE_SELF).ru_maxrss // 1024
+    return stats
+
+
+def print_client_stats():
+    stats = get_client_stats()
+    print(
+        'Clients: {created} created, {evicted_done} closed after their work was done, {evicted_lru} evicted '
+        'by the size cap, at most {max_cached} cached'.format(**stats) +
+        (', peak memory {} MB'.format(stats['max_rss_mb']) if 'max_rss_mb' in stats else '')
+    )
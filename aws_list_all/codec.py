@@ -0,0 +1,114 @@
+from __future__ import print_function
+
+import json
+import re
+from base64 import b64encode
+from datetime import date
+from decimal import Decimal
+
+HAVE_ORJSON = False
+try:
+    import orjson
+    HAVE_ORJSON = True
+except ImportError:
+    pass
+
+
+def encode_default(obj):
+    """Return a JSON-serializable replacement for values in AWS responses that JSON has no type for"""
+    if isinstance(obj, date):
+        return obj.isoformat()
+    if isinstance(obj, Decimal):
+        return int(obj) if obj == obj.to_integral_value() else float(obj)
+    if hasattr(obj, 'read'):
+        # Streaming bodies are read completely. They can only be read once, so responses should be buffered
+        # with buffer_streams before they are encoded.
+        obj = obj.read()
+    if isinstance(obj, (bytes, bytearray)):
+        try:
+            return obj.decode('utf-8')
+        except UnicodeDecodeError:
+            return b64encode(obj).decode('ascii')
+    raise TypeError('Object of type {} is not JSON serializable'.format(type(obj).__name__))
+
+
+def buffer_streams(response):
+    """Replace the streaming bodies in the given raw response by their content, so that it can be encoded more than
+    once, e.g. by a codec that falls back to another one. Streams are always top-level members of responses."""
+    for key, value in response.items():
+        if hasattr(value, 'read'):
+            response[key] = value.read()
+    return response
+
+
+class StdlibCodec(object):
+    """Encodes with the json module of the standard library, which writes to the file in chunks"""
+    name = 'json'
+
+    @staticmethod
+    def dump(data, filename):
+        with open(filename, 'w') as jsonfile:
+            json.dump(data, jsonfile, default=encode_default)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as jsonfile:
+            return json.load(jsonfile)
+
+
+# orjson decodes integers above 64 bit as floats, which loses digits. Files with integers outside of the signed
+# 64 bit range (or strings of them, which is rare) are decoded by the standard library instead.
+LONG_NUMBER = re.compile(rb'\d{19}')
+LARGE_INTEGER_CANDIDATE = re.compile(rb'-?\d{19,}')
+INT64_RANGE = (-2**63, 2**63 - 1)
+
+
+def has_large_integer(data):
+    """Return whether the given encoded JSON data may have integers outside of the signed 64 bit range"""
+    # Most listings have no numbers of 19 digits at all, which is quicker to rule out
+    if not LONG_NUMBER.search(data):
+        return False
+    return any(
+        not INT64_RANGE[0] <= int(match.group()) <= INT64_RANGE[1] for match in LARGE_INTEGER_CANDIDATE.finditer(data)
+    )
+
+
+class OrjsonCodec(object):
+    """Encodes with orjson, which serializes datetimes natively and is much faster on large responses.
+    Integers above 64 bit are encoded and decoded by the standard library."""
+    name = 'orjson'
+
+    @staticmethod
+    def dump(data, filename):
+        try:
+            encoded = orjson.dumps(data, default=encode_default)
+        except orjson.JSONEncodeError:
+            # e.g. integers larger than 64 bit, which only the standard library can encode
+            StdlibCodec.dump(data, filename)
+            return
+        with open(filename, 'wb') as jsonfile:
+            jsonfile.write(encoded)
+
+    @staticmethod
+    def load(filename):
+        with open(filename, 'rb') as jsonfile:
+            data = jsonfile.read()
+        if has_large_integer(data):
+            return json.loads(data)
+        return orjson.loads(data)
+
+
+CODECS = {codec.name: codec for codec in [StdlibCodec] + ([OrjsonCodec] if HAVE_ORJSON else [])}
+
+# The fastest available codec is used for listing files
+codec = OrjsonCodec if HAVE_ORJSON else StdlibCodec
+
+
+def dump_listing_file(data, filename):
+    """Write the JSON data of a listing to the given file"""
+    codec.dump(data, filename)
+
+
+def load_listing_file(filename):
+    """Return the JSON data of the listing in the given file"""
+    return codec.load(filename)
@@ -0,0 +1,128 @@
+"""Microbenchmark of the JSON codecs on synthetic listings shaped like large EC2 and CloudWatch Logs responses.
+
+Run with: python -m aws_list_all.codec_benchmark [number of resources]"""
+from __future__ import print_function
+
+import os
+import sys
+from datetime import datetime, timedelta
+from tempfile import mkdtemp
+from time import time
+
+from dateutil.tz import tzutc
+
+from .codec import CODECS
+
+
+def make_instance(i, start):
+    """Return the i-th synthetic EC2 instance, launched after the given time"""
+    launch_time = start + timedelta(minutes=i)
+    tags = [{'Key': 'Name', 'Value': 'instance-{}'.format(i)}, {'Key': 'team', 'Value': 'analytics'}]
+    network_interface = {
+        'NetworkInterfaceId': 'eni-{:017x}'.format(i),
+        'PrivateIpAddress': '10.0.{}.{}'.format(i // 256 % 256, i % 256),
+        'Attachment': {
+            'AttachTime': launch_time,
+            'DeleteOnTermination': True
+        },
+    }
+    block_device_mapping = {
+        'DeviceName': '/dev/xvda',
+        'Ebs': {
+            'VolumeId': 'vol-{:017x}'.format(i),
+            'AttachTime': start,
+            'Status': 'attached'
+        },
+    }
+    return {
+        'InstanceId': 'i-{:017x}'.format(i),
+        'InstanceType': 't3.micro',
+        'LaunchTime': launch_time,
+        'State': {
+            'Code': 16,
+            'Name': 'running'
+        },
+        'Tags': tags,
+        'NetworkInterfaces': [network_interface],
+        'BlockDeviceMappings': [block_device_mapping],
+    }
+
+
+def make_instances_data(count):
+    """Return the JSON data of an EC2 instance listing with the given number of resources, including datetime
+    values"""
+    start = datetime(2020, 1, 1, tzinfo=tzutc())
+    instances = [make_instance(i, start) for i in range(count)]
+    return {
+        'service': 'ec2',
+        'region': 'eu-west-1',
+        'profile': None,
+        'operation': 'DescribeInstances',
+        'response': {
+            'ResponseMetadata': {
+                'HTTPStatusCode': 200
+            },
+            'Reservations': [{
+                'ReservationId': 'r-{:017x}'.format(i),
+                'Instances': [instance]
+            } for i, instance in enumerate(instances)],
+        },
+    }
+
+
+def make_log_groups_data(count):
+    """Return the JSON data of a CloudWatch Logs log group listing with the given number of resources, which
+    has many small resources with integer timestamps"""
+    log_groups = [{
+        'logGroupName': '/aws/lambda/function-{}'.format(i),
+        'creationTime': 1577836800000 + i * 60000,
+        'retentionInDays': 30,
+        'metricFilterCount': 0,
+        'arn': 'arn:aws:logs:eu-west-1:123456789012:log-group:/aws/lambda/function-{}:*'.format(i),
+        'storedBytes': i * 1024,
+    } for i in range(count)]
+    return {
+        'service': 'logs',
+        'region': 'eu-west-1',
+        'profile': None,
+        'operation': 'DescribeLogGroups',
+        'response': {
+            'ResponseMetadata': {
+                'HTTPStatusCode': 200
+            },
+            'logGroups': log_groups
+        },
+    }
+
+
+# Functions that return synthetic listings of a given number of resources
+LISTINGS = {
+    'ec2': make_instances_data,
+    'logs': make_log_groups_data,
+}
+
+
+def benchmark(count=20000, repetitions=3):
+    """Print the best dump and load times of every available codec for listings of the given size"""
+    directory = mkdtemp()
+    filename = os.path.join(directory, 'listing.json')
+    for listing, make_data in sorted(LISTINGS.items()):
+        data = make_data(count)
+        print('{} listing with {} resources'.format(listing, count))
+        for name, codec in sorted(CODECS.items()):
+            dump_time = load_time = float('inf')
+            for _ in range(repetitions):
+                start_time = time()
+                codec.dump(data, filename)
+                dump_time = min(dump_time, time() - start_time)
+                start_time = time()
+                codec.load(filename)
+                load_time = min(load_time, time() - start_time)
+            size = os.path.getsize(filename)
+            print('{: <8} dump {:.3f}s load {:.3f}s ({:.1f} MB)'.format(name, dump_time, load_time, size / 1e6))
+            os.remove(filename)
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    benchmark(*map(int, sys.argv[1:2]))
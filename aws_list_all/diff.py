@@ -0,0 +1,107 @@
+from __future__ import print_function
+
+import json
+import os
+from collections import Counter
+
+from .codec import load_listing_file
+from .listing import Listing
+from .report import MANIFEST_FILENAME
+
+DIFF_ADDED = '+'
+DIFF_REMOVED = '-'
+DIFF_CHANGED = '~'
+
+
+def get_listing_filenames(directory):
+    """Return the sorted names of the listing files in the given directory"""
+    return sorted(
+        filename for filename in os.listdir(directory) if filename.endswith('.json') and filename != MANIFEST_FILENAME
+    )
+
+
+def load_resources(filename):
+    """Return the listing in the given file and its resources by resource type (without the truncation marker)"""
+    listing = Listing.from_json(load_listing_file(filename))
+    resources = listing.resources
+    resources.pop('truncated', None)
+    return listing, resources
+
+
+def key_resources(listing, resource_type, resources):
+    """Return a dict of the identifiers of the given resources to their canonical JSON representation.
+    Resources without a (unique) identifier are keyed by their canonical JSON representation itself."""
+    idkey = listing.identifier_key(resource_type, resources)
+    keyed = {}
+    for item in resources:
+        canonical = json.dumps(item, sort_keys=True, default=str)
+        identifier = item.get(idkey) if idkey and isinstance(item, dict) else None
+        if identifier is None or str(identifier) in keyed:
+            keyed[canonical] = canonical
+        else:
+            keyed[str(identifier)] = canonical
+    return keyed
+
+
+def changed_keys(old, new):
+    """Return the sorted top-level keys that differ between two canonical JSON representations of a resource"""
+    old, new = json.loads(old), json.loads(new)
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return []
+    return sorted(key for key in set(old) | set(new) if old.get(key) != new.get(key))
+
+
+def diff_listing_files(old_filename, new_filename):
+    """Yield (change, service, region, operation, resource_type, identifier, changed keys) tuples for the resources
+    that were added, removed or changed between two listing files of the same query, either of which may be None"""
+    old_listing, old_resources = load_resources(old_filename) if old_filename else (None, {})
+    new_listing, new_resources = load_resources(new_filename) if new_filename else (None, {})
+    listing = new_listing or old_listing
+    for resource_type in sorted(set(old_resources) | set(new_resources)):
+        old_keyed = key_resources(listing, resource_type, old_resources.get(resource_type, []))
+        new_keyed = key_resources(listing, resource_type, new_resources.get(resource_type, []))
+        for identifier in sorted(set(old_keyed) | set(new_keyed)):
+            if identifier not in new_keyed:
+                change, keys = DIFF_REMOVED, []
+            elif identifier not in old_keyed:
+                change, keys = DIFF_ADDED, []
+            elif old_keyed[identifier] != new_keyed[identifier]:
+                change, keys = DIFF_CHANGED, changed_keys(old_keyed[identifier], new_keyed[identifier])
+            else:
+                continue
+            yield (change, listing.service, listing.region, listing.operation, resource_type, identifier, keys)
+
+
+def do_diff(old_directory, new_directory, verbose=0):
+    """Print the resources that were added, removed or changed between the listing files in two directories.
+
+    The sorted file names of both directories are merged, so only the two listings of one query are held
+    in memory at any time. Returns the number of differences."""
+    old_filenames = get_listing_filenames(old_directory)
+    new_filenames = get_listing_filenames(new_directory)
+    counts = Counter()
+    old_index = new_index = 0
+    while old_index < len(old_filenames) or new_index < len(new_filenames):
+        old_filename = old_filenames[old_index] if old_index < len(old_filenames) else None
+        new_filename = new_filenames[new_index] if new_index < len(new_filenames) else None
+        if new_filename is None or (old_filename is not None and old_filename < new_filename):
+            new_filename = None
+            old_index += 1
+        elif old_filename is None or new_filename < old_filename:
+            old_filename = None
+            new_index += 1
+        else:
+            old_index += 1
+            new_index += 1
+        differences = diff_listing_files(
+            old_filename and os.path.join(old_directory, old_filename),
+            new_filename and os.path.join(new_directory, new_filename),
+        )
+        for change, service, region, operation, resource_type, identifier, keys in differences:
+            counts[change] += 1
+            line = [change, service, region, operation, resource_type, identifier]
+            if verbose > 0 and keys:
+                line.append(','.join(keys))
+            print(*line)
+    print('{} added, {} removed, {} changed'.format(counts[DIFF_ADDED], counts[DIFF_REMOVED], counts[DIFF_CHANGED]))
+    return sum(counts.values())
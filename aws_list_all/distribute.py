@@ -0,0 +1,477 @@
+from __future__ import print_function
+
+import json
+import socket
+import sqlite3
+import sys
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from hmac import compare_digest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ipaddress import ip_address
+from os import getpid
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.error import URLError
+from urllib.request import Request, urlopen
+
+from .codec import encode_default
+from .introspection import update_observed_availability
+from .listing import Listing
+from .query import (
+    CHILD_FANOUT, RESULT_ERROR, AvailabilityEvidence, get_child_queries, is_region_unavailable, print_results,
+    process_record
+)
+from .record import RecordedListing
+from .report import ListingManifest
+from .schedule import record_durations
+
+# Seconds after which a leased work unit is handed out again if its worker did not complete it
+LEASE_SECONDS = 600
+
+# Number of times a work unit is handed out before it is given up
+MAX_ATTEMPTS = 3
+
+# Keys of listing files that make up their query
+QUERY_KEYS = ('service', 'region', 'operation', 'profile')
+
+# Header of the shared token that workers send to coordinators with a token
+TOKEN_HEADER = 'X-Token'
+
+# Errors after which a work unit is handed out again, e.g. to a worker that is not throttled
+RETRYABLE_ERRORS = (
+    'Throttl', 'TooManyRequests', 'RequestLimitExceeded', 'Rate exceeded', 'EndpointConnectionError', 'Timeout'
+)
+
+
+def is_retryable(record):
+    return 'error' in record and any(error in record['error'] for error in RETRYABLE_ERRORS)
+
+
+def get_record_query(record):
+    """Return the query of the given cassette record of a work unit"""
+    if 'query' in record:
+        return get_unit_query(record['query'])
+    query = [record['listing'].get(key) for key in QUERY_KEYS]
+    return query + [record['listing']['parameters']] if record['listing'].get('parameters') else query
+
+
+def get_unit_query(query):
+    """Return the given query without empty parameters"""
+    return list(query[:4]) + [query[4]] if len(query) > 4 and query[4] else list(query[:4])
+
+
+def get_plan_json(queries):
+    return json.dumps(sorted(json.dumps(query) for query in queries))
+
+
+class WorkQueue(object):
+    """A SQLite-backed queue of the queries of a distributed scan. Work units are leased to workers for a limited
+    time and are handed out again if their lease expires, until they are completed or were attempted too often.
+    The queue survives restarts of the coordinator, so an interrupted scan can be resumed. The queries the scan
+    was planned for are kept, so that it is only resumed for the same queries."""
+
+    def __init__(self, filename, max_attempts=MAX_ATTEMPTS):
+        self.max_attempts = max_attempts
+        self._lock = Lock()
+        self._db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS units ('
+            'id INTEGER PRIMARY KEY, query TEXT NOT NULL, state TEXT NOT NULL, '
+            'worker TEXT, lease_expires REAL, attempts INTEGER NOT NULL DEFAULT 0, result TEXT)'
+        )
+        self._db.execute('CREATE TABLE IF NOT EXISTS plan (queries TEXT NOT NULL)')
+        # Results of units that were being saved when the coordinator stopped are incomplete
+        self._db.execute('UPDATE units SET state = ? WHERE state = ?', ('pending', 'completing'))
+
+    def add(self, queries):
+        """Add the given queries as pending work units, unless the queue has units already"""
+        with self._lock:
+            if self._db.execute('SELECT COUNT(*) FROM units').fetchone()[0]:
+                return False
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.executemany(
+                    'INSERT INTO units (query, state) VALUES (?, ?)',
+                    ((json.dumps(query), 'pending') for query in queries)
+                )
+                self._db.execute('INSERT INTO plan (queries) VALUES (?)', (get_plan_json(queries), ))
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+            return True
+
+    def is_planned_for(self, queries):
+        """Return whether the scan of the queue was planned for the given queries, in any order"""
+        with self._lock:
+            row = self._db.execute('SELECT queries FROM plan').fetchone()
+        return row is not None and row[0] == get_plan_json(queries)
+
+    def expire(self, now=None):
+        """Give up the units whose lease expired and that were attempted too often"""
+        now = time() if now is None else now
+        with self._lock:
+            expired = self._db.execute(
+                'SELECT id, query, attempts FROM units WHERE state = ? AND lease_expires < ? AND attempts >= ?',
+                ('leased', now, self.max_attempts)
+            ).fetchall()
+            for unit_id, query, attempts in expired:
+                service, region, operation, profile = json.loads(query)[:4]
+                result = (
+                    RESULT_ERROR, service, region, operation, profile,
+                    'Lease expired after {} attempts'.format(attempts)
+                )
+                self._db.execute(
+                    'UPDATE units SET state = ?, result = ? WHERE id = ?', ('failed', json.dumps(result), unit_id)
+                )
+
+    def lease(self, worker, count, lease_seconds=LEASE_SECONDS, now=None):
+        """Lease up to count pending units (or units whose lease expired) to the given worker and return a list
+        of their ids and queries"""
+        now = time() if now is None else now
+        self.expire(now)
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                units = self._db.execute(
+                    'SELECT id, query FROM units WHERE state = ? OR (state = ? AND lease_expires < ?) ORDER BY id '
+                    'LIMIT ?', ('pending', 'leased', now, count)
+                ).fetchall()
+                self._db.executemany(
+                    'UPDATE units SET state = ?, worker = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?',
+                    (('leased', worker, now + lease_seconds, unit_id) for unit_id, _ in units)
+                )
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+        return [(unit_id, json.loads(query)) for unit_id, query in units]
+
+    def complete(self, unit_id, worker, record):
+        """Complete the given unit leased by the given worker with its cassette record. Retryable errors are handed
+        out again, if the unit may be attempted again. Returns the query of the unit if the record is its result,
+        or None if not, e.g. if the lease expired and the unit was leased to another worker since."""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT attempts, query FROM units WHERE id = ? AND state = ? AND worker = ?',
+                (unit_id, 'leased', worker)
+            ).fetchone()
+            if row is None:
+                return None
+            if is_retryable(record) and row[0] < self.max_attempts:
+                self._db.execute('UPDATE units SET state = ?, worker = NULL WHERE id = ?', ('pending', unit_id))
+                return None
+            self._db.execute('UPDATE units SET state = ? WHERE id = ?', ('completing', unit_id))
+            return json.loads(row[1])
+
+    def set_result(self, unit_id, result, child_queries=()):
+        """Store the result tuple of a completed unit once its listing is saved, and add the given queries of child
+        operations of its resources as pending units. Both happen at once, so the queue is never finished in
+        between."""
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                self._db.executemany(
+                    'INSERT INTO units (query, state) VALUES (?, ?)',
+                    ((json.dumps(query), 'pending') for query in child_queries)
+                )
+                self._db.execute(
+                    'UPDATE units SET state = ?, result = ? WHERE id = ?', ('done', json.dumps(result), unit_id)
+                )
+                self._db.execute('COMMIT')
+            except Exception:
+                self._db.execute('ROLLBACK')
+                raise
+
+    def counts(self):
+        """Return a dict of the numbers of units in every state"""
+        with self._lock:
+            return dict(self._db.execute('SELECT state, COUNT(*) FROM units GROUP BY state').fetchall())
+
+    def finished(self):
+        counts = self.counts()
+        return not any(counts.get(state) for state in ('pending', 'leased', 'completing'))
+
+    def results(self):
+        """Return the result tuples of all completed and given up units, including those of earlier runs
+        of a resumed scan"""
+        with self._lock:
+            rows = self._db.execute('SELECT result FROM units WHERE result IS NOT NULL ORDER BY id').fetchall()
+        return [tuple(json.loads(result)) for result, in rows]
+
+    def close(self):
+        self._db.close()
+
+
+class CoordinatorRequestHandler(BaseHTTPRequestHandler):
+    """Handles POST /lease {"worker": ..., "count": ...} and POST /complete {"worker": ..., "id": ..., "record": ...}
+    of workers, and GET /status. If the coordinator has a token, requests must send it in the X-Token header."""
+
+    def _authorized(self):
+        if self.server.token is not None and not compare_digest(self.headers.get(TOKEN_HEADER, ''), self.server.token):
+            self.send_error(403, 'Invalid token')
+            return False
+        return True
+
+    def _send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # pylint:disable=invalid-name
+        if not self._authorized():
+            return
+        if self.path != '/status':
+            self.send_error(404, 'Use /status')
+            return
+        self._send_json(self.server.queue.counts())
+
+    def do_POST(self):  # pylint:disable=invalid-name
+        if not self._authorized():
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+        except ValueError as exc:
+            self.send_error(400, 'Invalid request: {}'.format(exc))
+            return
+        if self.path == '/lease':
+            units = self.server.queue.lease(request['worker'], request.get('count', 1), self.server.lease_seconds)
+            self._send_json({
+                'units': [{
+                    'id': unit_id,
+                    'query': query
+                } for unit_id, query in units],
+                'finished': not units and self.server.queue.finished(),
+            })
+        elif self.path == '/complete':
+            query = self.server.queue.complete(request['id'], request['worker'], request['record'])
+            if query is not None:
+                self.server.add_record(request['id'], query, request['record'])
+            self._send_json({})
+        else:
+            self.send_error(404, 'Use /lease or /complete')
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        if self.server.verbose > 1:
+            sys.stderr.write('{}\n'.format(format % args))
+
+
+class Coordinator(ThreadingHTTPServer):
+    """Hands out the work units of a queue to workers and merges their results into the listing files,
+    manifest and results of one run in the current directory. With expand_children, the queries of child
+    operations of the found resources are added to the queue. The availability evidence and durations of the
+    queries are collected per profile. With a token, only requests with this token are served."""
+
+    def __init__(
+        self,
+        address,
+        queue,
+        lease_seconds=LEASE_SECONDS,
+        verbose=0,
+        expand_children=False,
+        child_fanout=CHILD_FANOUT,
+        selected_operations=(),
+        token=None
+    ):
+        ThreadingHTTPServer.__init__(self, address, CoordinatorRequestHandler)
+        self.queue = queue
+        self.lease_seconds = lease_seconds
+        self.verbose = verbose
+        self.expand_children = expand_children
+        self.child_fanout = child_fanout
+        self.selected_operations = selected_operations
+        self.token = token
+        self.manifest = ListingManifest()
+        self.evidence = defaultdict(AvailabilityEvidence)
+        self.durations = defaultdict(dict)
+
+    def get_child_queries(self, record):
+        """Return the selected child queries of the listing of the given record"""
+        if not self.expand_children or 'listing' not in record:
+            return []
+        try:
+            child_queries = get_child_queries(RecordedListing.from_json(record['listing']), self.child_fanout)
+        except Exception:  # pylint:disable=broad-except
+            # The resources of the listing could not be derived, which its result reports already
+            return []
+        return [
+            child_query for child_query in child_queries
+            if not self.selected_operations or child_query[2] in self.selected_operations
+        ]
+
+    def add_outcome(self, query, record):
+        """Add the availability evidence and the duration of the given query with the given record"""
+        service, region, operation, profile = query[:4]
+        if 'listing' in record:
+            outcome = True
+        else:
+            outcome = False if is_region_unavailable(service, operation, record.get('repr', record['error'])) else None
+        self.evidence[profile].record(service, region, outcome)
+        if 'duration' in record:
+            self.durations[profile][(service, region, operation)] = record['duration']
+
+    def add_record(self, unit_id, query, record):
+        """Add the cassette record of the completed unit with the given id and query. Records of other queries
+        are rejected, so workers cannot write listings of queries they were not handed out."""
+        child_queries = []
+        try:
+            if get_record_query(record) != get_unit_query(query):
+                raise ValueError('The record of {} is no result of the query'.format(get_record_query(record)))
+            result, _ = process_record(self.verbose, record, self.manifest)
+            child_queries = self.get_child_queries(record)
+            self.add_outcome(query, record)
+        except Exception as exc:  # pylint:disable=broad-except
+            # The unit must get a result, or the scan never finishes
+            result = (RESULT_ERROR, ) + tuple(query[:4]) + (repr(exc), )
+        self.queue.set_result(unit_id, result, child_queries)
+        if self.verbose > 1:
+            print('DistributedResult: {}'.format(result))
+        else:
+            print(result[0][-1], end='')
+            sys.stdout.flush()
+
+
+def do_coordinate(
+    to_run,
+    host='127.0.0.1',
+    port=8081,
+    queue_filename='aws_list_all_queue.sqlite',
+    lease_seconds=LEASE_SECONDS,
+    verbose=0,
+    expand_children=False,
+    child_fanout=CHILD_FANOUT,
+    selected_operations=(),
+    resume=False,
+    token=None
+):
+    """Serve the given queries to workers until all are completed or given up, and print the merged results.
+    If the queue file has work units of an interrupted scan of the same queries already and resume is True, that
+    scan is resumed instead. Other existing queues are refused, and 1 is returned. Optionally, child operations are
+    queried for the resources found by their parent operations. With a token, workers must send this token."""
+    queue = WorkQueue(queue_filename)
+    resumed = not queue.add(to_run)
+    if resumed:
+        error = None
+        if not resume:
+            error = 'The queue {} has the work units of an earlier scan. Use --resume to resume it, or a new queue.'
+        elif queue.finished():
+            error = 'The scan in the queue {} is finished already. Use a new queue.'
+        elif not queue.is_planned_for(to_run):
+            error = 'The scan in the queue {} was planned for other queries. Use a new queue.'
+        if error is not None:
+            print(error.format(queue_filename))
+            queue.close()
+            return 1
+        print('Resuming the scan in {}'.format(queue_filename))
+    if token is None and not is_loopback(host):
+        print(
+            'Warning: Listening on {} without a token, so anyone who can connect can hand in results. '
+            'Use --token to require a shared token.'.format(host)
+        )
+    coordinator = Coordinator((host, port), queue, lease_seconds, verbose, expand_children, child_fanout,
+                              selected_operations, token)
+    print('Coordinating {} work units on http://{}:{}/'.format(sum(queue.counts().values()), host, port))
+    thread = Thread(target=coordinator.serve_forever)
+    thread.start()
+    try:
+        while not queue.finished():
+            sleep(1)
+            queue.expire()
+    finally:
+        coordinator.shutdown()
+        thread.join()
+        coordinator.server_close()
+        coordinator.manifest.close()
+    # A service is only unavailable in a region if all its operations were queried and were unavailable, which
+    # is unknown for the units that earlier runs of a resumed scan completed
+    all_queried = not selected_operations and not resumed
+    for profile, evidence in coordinator.evidence.items():
+        update_observed_availability(evidence.conclusions(include_unavailable=all_queried), profile=profile)
+    for profile, durations in coordinator.durations.items():
+        record_durations(durations, profile=profile)
+    results_by_type = defaultdict(list)
+    for result in queue.results():
+        results_by_type[result[0]].append(result)
+    queue.close()
+    print('...done')
+    print_results(results_by_type)
+
+
+def is_loopback(host):
+    """Return whether the given address to listen on is only reachable from this machine"""
+    try:
+        return ip_address(socket.gethostbyname(host)).is_loopback
+    except (socket.error, ValueError):
+        return False
+
+
+def run_work_unit(query):
+    """Execute the given query and return its cassette record, with the duration of the request"""
+    service, region, operation, profile = query[:4]
+    parameters = query[4] if len(query) > 4 else None
+    start_time = time()
+    listing = None
+    try:
+        listing = Listing.acquire(service, region, operation, profile, parameters)
+        duration = time() - start_time
+        # Derive the resources, which may request auxiliary responses the coordinator needs to derive them, too
+        listing.resources  # pylint:disable=pointless-statement
+    except Exception as exc:  # pylint:disable=broad-except
+        if listing is None:
+            return {'query': list(query), 'error': str(exc), 'repr': repr(exc), 'duration': time() - start_time}
+    return {'listing': listing.to_json(), 'duration': duration}
+
+
+def post(url, data, token=None):
+    body = json.dumps(data, default=encode_default).encode('utf-8')
+    headers = {'Content-Type': 'application/json'}
+    if token is not None:
+        headers[TOKEN_HEADER] = token
+    with urlopen(Request(url, body, headers)) as response:
+        return json.loads(response.read().decode('utf-8'))
+
+
+def do_work(coordinator_url, parallel=32, worker=None, verbose=0, token=None):
+    """Lease work units from the coordinator at the given URL, execute them in parallel threads and send their
+    results back as they complete, until the coordinator has no more work. The token of the coordinator, if any,
+    is sent with every request."""
+    coordinator_url = coordinator_url.rstrip('/')
+    worker = worker or '{}-{}'.format(socket.gethostname(), getpid())
+    completed = 0
+    pending = {}
+    with ThreadPoolExecutor(parallel) as executor:
+        while True:
+            if len(pending) < parallel:
+                try:
+                    response = post(
+                        coordinator_url + '/lease', {
+                            'worker': worker,
+                            'count': parallel - len(pending)
+                        }, token
+                    )
+                except (URLError, ConnectionError):
+                    if pending:
+                        raise
+                    # The coordinator stops once the scan is finished
+                    break
+                if response['finished'] and not pending:
+                    break
+                for unit in response['units']:
+                    pending[executor.submit(run_work_unit, unit['query'])] = unit
+            if not pending:
+                # Other workers hold the remaining units, which are handed out again if their leases expire
+                sleep(5)
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                unit = pending.pop(future)
+                record = future.result()
+                post(coordinator_url + '/complete', {'worker': worker, 'id': unit['id'], 'record': record}, token)
+                if verbose > 1:
+                    print('Completed {}'.format(unit['query']))
+                completed += 1
+    print('Worker {} completed {} work units'.format(worker, completed))
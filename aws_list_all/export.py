@@ -0,0 +1,129 @@
+from __future__ import print_function
+
+import json
+import os
+from queue import Queue
+from threading import Lock, Thread
+from time import strftime
+
+from .codec import encode_default, load_listing_file
+from .listing import Listing, get_arn
+
+# Columns of the exported resources. Files are partitioned by service and region, which are not repeated in them.
+EXPORT_COLUMNS = ['profile', 'service', 'region', 'operation', 'resource_type', 'id', 'arn', 'item']
+PARTITION_COLUMNS = ['service', 'region']
+
+# Number of record batches that may wait to be written before adding more listings blocks
+EXPORT_QUEUE_SIZE = 64
+
+
+def import_pyarrow():
+    """Return the pyarrow module with its dataset module loaded. It is only imported once a Parquet export is made,
+    because importing it is slow and it is an optional dependency."""
+    try:
+        import pyarrow  # pylint:disable=import-outside-toplevel
+        import pyarrow.dataset  # pylint:disable=import-outside-toplevel,unused-import
+    except ImportError:
+        raise Exception('Exporting to Parquet requires pyarrow, e.g. pip install aws-list-all[parquet]')
+    return pyarrow
+
+
+def get_rows(listing):
+    """Yield one row of EXPORT_COLUMNS for every resource of the given listing"""
+    for resource_type, resources in listing.resources.items():
+        if resource_type == 'truncated':
+            continue
+        idkey = listing.identifier_key(resource_type, resources)
+        for item in resources:
+            if isinstance(item, dict):
+                identifier = item.get(idkey) if idkey else None
+            else:
+                identifier = item
+            yield (
+                listing.profile,
+                listing.service,
+                listing.region,
+                listing.operation,
+                resource_type,
+                None if identifier is None else str(identifier),
+                get_arn(resource_type, item),
+                json.dumps(item, sort_keys=True, default=encode_default),
+            )
+
+
+class ParquetExport(object):
+    """Writes the resources of listings as they are added to a Parquet dataset in the given directory,
+    partitioned by service and region (e.g. service=ec2/region=eu-west-1/).
+
+    Every listing becomes one Arrow record batch, which is written by a background thread,
+    so only a bounded number of listings is held in memory."""
+
+    def __init__(self, directory):
+        self._pyarrow = pyarrow = import_pyarrow()
+        self.schema = pyarrow.schema([(column, pyarrow.string()) for column in EXPORT_COLUMNS])
+        self.rows = 0
+        self._error = None
+        self._finished = False
+        self._lock = Lock()
+        self._queue = Queue(EXPORT_QUEUE_SIZE)
+        self._thread = Thread(target=self._write, args=(directory, ))
+        self._thread.start()
+
+    def _write(self, directory):
+        pyarrow = self._pyarrow
+        try:
+            pyarrow.dataset.write_dataset(
+                self._batches(),
+                directory,
+                schema=self.schema,
+                format='parquet',
+                partitioning=pyarrow.dataset.partitioning(
+                    pyarrow.schema([(column, pyarrow.string()) for column in PARTITION_COLUMNS]), flavor='hive'
+                ),
+                # Runs write new files next to the files of earlier runs
+                basename_template='part-{}-{{i}}.parquet'.format(strftime('%Y%m%dT%H%M%S')),
+                existing_data_behavior='overwrite_or_ignore'
+            )
+        except Exception as exc:  # pylint:disable=broad-except
+            self._error = exc
+            # Keep consuming, so that adding listings does not block forever
+            for _ in self._batches():
+                pass
+
+    def _batches(self):
+        while not self._finished:
+            batch = self._queue.get()
+            if batch is None:
+                self._finished = True
+            else:
+                yield batch
+
+    def add(self, listing):
+        """Add the resources of the given listing to the export"""
+        columns = list(zip(*get_rows(listing)))
+        if not columns:
+            return
+        with self._lock:
+            self.rows += len(columns[0])
+        pyarrow = self._pyarrow
+        arrays = [pyarrow.array(column, pyarrow.string()) for column in columns]
+        self._queue.put(pyarrow.RecordBatch.from_arrays(arrays, schema=self.schema))
+
+    def close(self):
+        """Finish writing the export, raising any error that occurred while writing"""
+        self._queue.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        print('Exported {} resources'.format(self.rows))
+
+
+def do_export(filenames, directory):
+    """Export the resources of the given listing files to a Parquet dataset in the given directory"""
+    export = ParquetExport(directory)
+    try:
+        for filename in filenames:
+            if os.path.basename(filename).endswith('.json'):
+                export.add(Listing.from_json(load_listing_file(filename)))
+    finally:
+        export.close()
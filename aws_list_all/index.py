@@ -0,0 +1,173 @@
+from __future__ import print_function
+
+import json
+import re
+from collections import defaultdict
+
+from .changes import get_resource_noun, get_singular
+from .client import get_client
+
+# Service names in resource indexes that differ from the boto3 service names
+INDEX_SERVICES = {
+    'elasticloadbalancing': ['elb', 'elbv2'],
+    'elasticloadbalancingv2': ['elbv2'],
+    'elasticsearch': ['es', 'opensearch'],
+    'states': ['stepfunctions'],
+}
+
+# Regions in resource indexes of resources of global services
+GLOBAL_REGIONS = ('global', 'aws-global', '')
+
+INDEXES = ('resource-explorer', 'config')
+
+# Type noun of resources of all types of a service
+ALL_TYPES = '*'
+
+
+def get_index_services(index_service):
+    """Return the boto3 service names of a service name in a resource index"""
+    index_service = index_service.lower()
+    return INDEX_SERVICES.get(index_service, [index_service])
+
+
+def get_type_noun(resource_type):
+    """Return the lower-cased singular noun of a resource type of an index, e.g. securitygroup for
+    ec2:security-group (Resource Explorer) and AWS::EC2::SecurityGroup (AWS Config)"""
+    return get_singular(re.sub('[^a-z0-9]', '', re.split(':+', resource_type)[-1].lower()))
+
+
+class ResourceIndex(object):
+    """The resource types covered by a resource index, and the resource types it reports resources of, per service
+    and region. Resources of global services are reported in the region None."""
+
+    def __init__(self):
+        self.covered = defaultdict(set)
+        self.present = defaultdict(set)
+
+    def add_covered(self, index_service, region, type_noun):
+        """Add the given resource type as covered by the index in the given region"""
+        if region in GLOBAL_REGIONS:
+            region = None
+        for service in get_index_services(index_service):
+            self.covered[(service, region)].add(type_noun)
+
+    def add_present(self, index_service, region, type_noun=ALL_TYPES):
+        """Add resources of the given type (or of all types of the service) in the given region"""
+        if region in GLOBAL_REGIONS:
+            region = None
+        if type_noun != ALL_TYPES:
+            self.add_covered(index_service, region, type_noun)
+        for service in get_index_services(index_service):
+            self.present[(service, region)].add(type_noun)
+
+    def has_resources(self, service, region, operation):
+        """Return True if the index reports resources of the given listing operation, False if it reports none
+        and None if it does not cover the resource type of the operation in the region. Queries of global services
+        (region None) are covered if the type is covered in any region, and have resources if the index reports
+        resources of their type in any region."""
+        operation_noun = get_resource_noun(operation)
+        if region is None:
+            regions = [key_region for key_service, key_region in self.covered if key_service == service]
+        else:
+            regions = [region]
+        regions = [key_region for key_region in regions if operation_noun in self.covered[(service, key_region)]]
+        if not regions:
+            return None
+        if region is None:
+            regions = [key_region for key_service, key_region in self.present if key_service == service]
+        for key_region in regions:
+            present = self.present.get((service, key_region), ())
+            if ALL_TYPES in present or operation_noun in present:
+                return True
+        return False
+
+
+def search_resource_explorer(region, regions, profile=None, view_arn=None):
+    """Return the resource index of the Resource Explorer aggregator index in the given region,
+    for the given scanned regions. Supported resource types count as covered in the regions with an index."""
+    client = get_client('resource-explorer-2', region, profile)
+    view = {'ViewArn': view_arn} if view_arn else {}
+    index = ResourceIndex()
+    indexed_regions = set(GLOBAL_REGIONS)
+    for page in client.get_paginator('list_indexes').paginate():
+        indexed_regions.update(index_info['Region'] for index_info in page['Indexes'])
+    services = set()
+    for page in client.get_paginator('list_supported_resource_types').paginate():
+        for resource_type in page['ResourceTypes']:
+            services.add(resource_type['Service'])
+            for region_name in indexed_regions:
+                index.add_covered(resource_type['Service'], region_name, get_type_noun(resource_type['ResourceType']))
+    for service in sorted(services):
+        response = client.search(QueryString='service:{}'.format(service), MaxResults=1000, **view)
+        found_regions = set()
+        for resource in response['Resources']:
+            found_regions.add(resource['Region'])
+            index.add_present(service, resource['Region'], get_type_noun(resource['ResourceType']))
+        if not response['Count'].get('Complete', True):
+            # Searches return at most 1000 resources, so the other regions of services with more are probed one by
+            # one. This only tells whether a region has resources of the service, so all its types count as present.
+            for region_name in found_regions:
+                index.add_present(service, region_name)
+            for region_name in sorted((set(regions) & indexed_regions) - found_regions):
+                probe = client.search(
+                    QueryString='service:{} region:{}'.format(service, region_name), MaxResults=1, **view
+                )
+                if probe['Resources']:
+                    index.add_present(service, region_name)
+    return index
+
+
+def select_config_aggregator(region, aggregator, profile=None):
+    """Return the resource index of the AWS Config aggregator with the given name in the given region.
+    Resource types recorded in some region count as covered in all regions the aggregator reports resources in."""
+    client = get_client('config', region, profile)
+    index = ResourceIndex()
+    pages = client.get_paginator('select_aggregate_resource_config').paginate(
+        ConfigurationAggregatorName=aggregator,
+        Expression='SELECT resourceType, awsRegion, COUNT(*) GROUP BY resourceType, awsRegion'
+    )
+    recorded_types, reported_regions = set(), set()
+    for page in pages:
+        for result in page['Results']:
+            result = json.loads(result)
+            # Resource types look like AWS::EC2::Instance
+            index_service, type_noun = result['resourceType'].split('::')[1], get_type_noun(result['resourceType'])
+            recorded_types.add((index_service, type_noun))
+            reported_regions.add(result.get('awsRegion', ''))
+            index.add_present(index_service, result.get('awsRegion', ''), type_noun)
+    for index_service, type_noun in recorded_types:
+        for region_name in reported_regions:
+            index.add_covered(index_service, region_name, type_noun)
+    return index
+
+
+def get_resource_index(index, region, regions, profile=None, view_arn=None, aggregator=None):
+    """Return the resource index of the given type, or None if it cannot be read"""
+    try:
+        if index == 'resource-explorer':
+            return search_resource_explorer(region, regions, profile, view_arn)
+        return select_config_aggregator(region, aggregator, profile)
+    except Exception as exc:  # pylint:disable=broad-except
+        print('Cannot read the {} index, querying everything: {!r}'.format(index, exc))
+        return None
+
+
+def apply_resource_index(to_run, index, skip_empty=True):
+    """Return the queries of to_run in the given order, but with queries the index reports resources of first,
+    then queries of resource types the index does not cover, and finally (or not at all, if skip_empty is True)
+    the queries the index reports empty"""
+    present, uncovered, empty = [], [], []
+    for query in to_run:
+        has_resources = index.has_resources(query[0], query[1], query[2])
+        if has_resources is None:
+            uncovered.append(query)
+        elif has_resources:
+            present.append(query)
+        else:
+            empty.append(query)
+    print(
+        'The resource index reports resources for {} queries, {} are empty and {} are not covered.'.format(
+            len(present), len(empty), len(uncovered)
+        )
+    )
+    return present + uncovered + ([] if skip_empty else empty)
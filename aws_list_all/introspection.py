@@ -1,22 +1,47 @@
 from __future__ import print_function
 
+import asyncio
+import contextlib
 import re
 import importlib_resources
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
 from json import load, dump
 from multiprocessing.pool import ThreadPool
-from socket import gethostbyname, gaierror
+from socket import AF_INET, EAI_AGAIN, SOCK_STREAM, gaierror
+from time import time
 
 import boto3
+import botocore.session
+from botocore.args import ClientArgsCreator
+from botocore.client import ClientEndpointBridge
 
 from app_json_file_cache import AppCache
+from app_json_file_cache.data_cache import DataCache
 
 from .client import get_client
 
 cache = AppCache('aws_list_all')
+observed_availability_cache = DataCache('aws_list_all', 'observed_availability')
 
 VERBS_LISTINGS = ['Describe', 'Get', 'List']
 
+# Number of concurrent DNS lookups, seconds until a lookup times out, and retries of failed lookups
+DNS_PARALLEL = 128
+DNS_TIMEOUT = 5
+DNS_RETRIES = 3
+
+# IP of endpoints whose lookups timed out or failed temporarily in all retries, which neither shows that the
+# endpoint exists nor that it does not
+DNS_INCONCLUSIVE = 'inconclusive'
+
+# Services are skipped in regions where all operations were unavailable in this many consecutive queries,
+# until the observation is older than the recheck period.
+OBSERVED_UNAVAILABLE_QUERIES = 2
+OBSERVED_UNAVAILABLE_RECHECK_SECONDS = 30 * 24 * 3600
+
 SERVICE_IGNORE_LIST = [
     'alexaforbusiness',  # TODO: Mostly organization-specific calls and would need to be queried differently
     'apigatewaymanagementapi',  # This API allows management of deployed APIs, and requires an endpoint per API.
@@ -436,6 +461,66 @@ PARAMETERS_REQUIRED = {
     'xray': ['GetGroup'],
 }
 
+# Listing operations that need the identifier of a parent resource, by the listing operation of the parent.
+# Each entry is a tuple of the resource type in the parent listing, the key of the identifier in the parent
+# resources (None if the resources are identifiers), the child operation and its parameter for the identifier.
+CHILD_OPERATIONS = {
+    'apigateway': {
+        'GetRestApis': [('items', 'id', 'GetStages', 'restApiId')],
+    },
+    'apigatewayv2': {
+        'GetApis': [
+            ('Items', 'ApiId', 'GetRoutes', 'ApiId'),
+            ('Items', 'ApiId', 'GetStages', 'ApiId'),
+        ],
+    },
+    'backup': {
+        'ListBackupVaults': [
+            ('BackupVaultList', 'BackupVaultName', 'ListRecoveryPointsByBackupVault', 'BackupVaultName'),
+        ],
+    },
+    'cognito-idp': {
+        'ListUserPools': [
+            ('UserPools', 'Id', 'ListGroups', 'UserPoolId'),
+            ('UserPools', 'Id', 'ListUserPoolClients', 'UserPoolId'),
+        ],
+    },
+    'ecr': {
+        'DescribeRepositories': [('repositories', 'repositoryName', 'ListImages', 'repositoryName')],
+    },
+    'ecs': {
+        'ListClusters': [
+            ('clusterArns', None, 'ListContainerInstances', 'cluster'),
+            ('clusterArns', None, 'ListServices', 'cluster'),
+            ('clusterArns', None, 'ListTasks', 'cluster'),
+        ],
+    },
+    'efs': {
+        'DescribeFileSystems': [('FileSystems', 'FileSystemId', 'DescribeMountTargets', 'FileSystemId')],
+    },
+    'eks': {
+        'ListClusters': [
+            ('clusters', None, 'ListAddons', 'clusterName'),
+            ('clusters', None, 'ListFargateProfiles', 'clusterName'),
+            ('clusters', None, 'ListNodegroups', 'clusterName'),
+        ],
+    },
+    'elbv2': {
+        'DescribeListeners': [('Listeners', 'ListenerArn', 'DescribeRules', 'ListenerArn')],
+        'DescribeLoadBalancers': [('LoadBalancers', 'LoadBalancerArn', 'DescribeListeners', 'LoadBalancerArn')],
+        'DescribeTargetGroups': [('TargetGroups', 'TargetGroupArn', 'DescribeTargetHealth', 'TargetGroupArn')],
+    },
+    'glue': {
+        'GetDatabases': [('DatabaseList', 'Name', 'GetTables', 'DatabaseName')],
+    },
+    'kinesis': {
+        'ListStreams': [('StreamNames', None, 'ListShards', 'StreamName')],
+    },
+    'lambda': {
+        'ListFunctions': [('Functions', 'FunctionName', 'ListAliases', 'FunctionName')],
+    },
+}
+
 
 def get_services():
     """Return a list of all service names where listable resources can be present"""
@@ -451,6 +536,12 @@ def get_verbs(service):
     return set(re.sub('([A-Z])', '_\\1', x).split('_')[1] for x in client.meta.method_to_api_mapping.values())
 
 
+def get_child_operations(service, operation):
+    """Return the (resource type, identifier key, child operation, parameter) tuples of the child operations
+    to query for each resource found by the given listing operation"""
+    return CHILD_OPERATIONS.get(service, {}).get(operation, [])
+
+
 def get_listing_operations(service, region=None, selected_operations=(), profile=None):
     """Return a list of API calls which (probably) list resources created by the user
     in the given service (in contrast to AWS-managed or default resources)"""
@@ -478,9 +569,66 @@ def get_listing_operations(service, region=None, selected_operations=(), profile
     return operations
 
 
-def recreate_caches(update_packaged_values):
+def guess_identifier_key(resource_type, keys):
+    """Return the key among the given member keys of a resource that most probably holds its identifier"""
+    nouns = [resource_type]
+    # Find the last uppercase word in the resource_type and construct some guesses from that, too
+    uppercase_indices = [i for (i, c) in enumerate(resource_type) if c.isupper()]
+    if uppercase_indices and uppercase_indices[-1] > 0:
+        nouns.append(resource_type[uppercase_indices[-1]:])
+    singulars = [noun[:-3] + 'y' if noun.endswith('ies') else noun[:-1] for noun in nouns]
+    guesses = [noun + suffix for noun in singulars + nouns for suffix in ('Id', 'Identifier', 'Name', 'Arn')]
+    lower_keys = {k.lower(): k for k in keys}
+    for guess in guesses + ['id', 'SerialNumber']:
+        if guess.lower() in lower_keys:
+            return lower_keys[guess.lower()]
+    for suffix in ('Id', 'Name', 'Arn'):
+        candidates = [k for k in keys if k.endswith(suffix)]
+        if candidates:
+            # Heuristic: Shortest ID is probably the Resource ID
+            return min(candidates, key=len)
+    return None
+
+
+# The loader of this session caches the service models read for the resource identifier keys
+_MODEL_SESSION = botocore.session.get_session()
+_RESOURCE_IDENTIFIER_KEYS = {}
+
+
+def get_resource_identifier_keys(service, operation):
+    """Return a dict of the resource types in the output of the given operation to the member key that identifies
+    a resource of that type, derived (once) from the output shape in the service model. Resource types that are
+    lists of plain values or have no identifying member map to None."""
+    key = (service, operation)
+    if key not in _RESOURCE_IDENTIFIER_KEYS:
+        identifier_keys = {}
+        op_model = _MODEL_SESSION.get_service_model(service).operation_model(operation)
+        output_members = op_model.output_shape.members if op_model.output_shape else {}
+        for resource_type, shape in output_members.items():
+            if shape.type_name != 'list':
+                continue
+            if shape.member.type_name == 'structure':
+                identifier_keys[resource_type] = guess_identifier_key(resource_type, list(shape.member.members))
+            else:
+                identifier_keys[resource_type] = None
+        _RESOURCE_IDENTIFIER_KEYS[key] = identifier_keys
+    return _RESOURCE_IDENTIFIER_KEYS[key]
+
+
+def get_input_members(service, operation):
+    """Return the names of the input members of the given operation in the service model"""
+    op_model = _MODEL_SESSION.get_service_model(service).operation_model(operation)
+    return list(op_model.input_shape.members) if op_model.input_shape else []
+
+
+def recreate_caches(update_packaged_values, incremental=False):
+    # The current service regions are either from a previous run with this boto3 version or the packaged values.
+    # They are kept for endpoints whose lookups are inconclusive.
+    previous_service_regions = get_service_regions()
     get_endpoint_hosts.recalculate()
-    get_service_regions.recalculate()
+    service_regions_cache.recalculate(
+        partial(calculate_service_regions, previous_service_regions if incremental else None, previous_service_regions)
+    )
 
     if update_packaged_values:
         print('Updating packaged values at:')
@@ -502,6 +650,62 @@ def packaged_endpoint_hosts():
         return load(endpoint_hosts_packaged_json)
 
 
+def get_endpoint_urls(session, service_model, regions):
+    """Compute the endpoint URLs of the given service model in the given regions as a client would,
+    but directly from botocore's partition data instead of constructing a client for every region.
+    If the private botocore APIs this uses changed, clients are constructed after all."""
+    try:
+        config_store = session.get_component('config_store')
+        endpoint_bridge = ClientEndpointBridge(
+            session._get_internal_component('endpoint_resolver'),
+            service_signing_name=service_model.metadata.get('signingName'),
+            config_store=config_store,
+            service_signature_version=service_model.metadata.get('signatureVersion'),
+        )
+        # This mirrors the endpoint configuration of botocore's client creation, including the
+        # special cases for the legacy global endpoints of s3 and sts.
+        args_creator = ClientArgsCreator(None, None, None, session.get_component('data_loader'), None, config_store)
+        return {
+            region:
+                args_creator._compute_endpoint_config(
+                    service_model.endpoint_prefix, region, None, True, endpoint_bridge, None
+                )['endpoint_url']
+            for region in regions
+        }
+    except (TypeError, AttributeError):
+        return {
+            region: session.create_client(service_model.service_name, region_name=region).meta.endpoint_url
+            for region in regions
+        }
+
+
+def get_service_endpoint_hosts(session, service, regions):
+    """Return a dict of region names to the list of endpoint hosts for the given service"""
+    service_model = session.get_service_model(service)
+    endpoint_urls = get_endpoint_urls(session, service_model, regions)
+    # In some services, different operations must access different host prefixes ("api.", "env.").
+    # This means that the endpoint_url itself may not point to any host, defeating our heuristic.
+    # Therefore, we only pick the base URL if at least one operation accesses it, otherwise we pick the
+    # alphabetically first host prefix.
+    endpoint_prefixes = set(
+        service_model.operation_model(op_name).endpoint.get('hostPrefix') for op_name in service_model.operation_names
+        if service_model.operation_model(op_name).endpoint
+    )
+    result = {}
+    for region, endpoint_url in endpoint_urls.items():
+        if None in endpoint_prefixes or not endpoint_prefixes:
+            result[region] = [endpoint_url]
+        else:
+            assert endpoint_url.startswith("https://"), endpoint_url
+            result[region] = []
+            prefixes = sorted(endpoint_prefixes)
+            if any(pf.endswith(".") for pf in prefixes):
+                result[region] = [endpoint_url]
+            for prefix in prefixes:
+                result[region].append("https://" + prefix + endpoint_url[len("https://"):])
+    return result
+
+
 @cache('endpoint_hosts', vary={'boto3_version': boto3.__version__}, cheap_default_func=packaged_endpoint_hosts)
 def get_endpoint_hosts():
     print('Extracting endpoint list from boto3 version {} ...'.format(boto3.__version__))
@@ -511,56 +715,74 @@ def get_endpoint_hosts():
     ALL_REGIONS = sorted(EC2_REGIONS | S3_REGIONS)
     ALL_SERVICES = get_services()
 
-    result = {}
-    for service in ALL_SERVICES:
-        print('  ...looking for {} in all regions...'.format(service))
-        result[service] = {}
-        for region in ALL_REGIONS:
-            meta = get_client(service, region=region).meta
-            # In some services, different operations must access different host prefixes ("api.", "env.").
-            # This means that the endpoint_url itself may not point to any host, defeating our heuristic.
-            # Therefore, we only pick the base URL if at least one operation accesses it, otherwise we pick the
-            # alphabetically first host prefix.
-            endpoint_prefixes = set(
-                meta.service_model.operation_model(op_name).endpoint.get('hostPrefix')
-                for op_name in meta.service_model.operation_names
-                if meta.service_model.operation_model(op_name).endpoint
-            )
-            if None in endpoint_prefixes or not endpoint_prefixes:
-                result[service][region] = [meta.endpoint_url]
-            else:
-                assert meta.endpoint_url.startswith("https://"), meta.endpoint_url
-                result[service][region] = []
-                prefixes = sorted(endpoint_prefixes)
-                if any(pf.endswith(".") for pf in prefixes):
-                    result[service][region] = [meta.endpoint_url]
-                for prefix in prefixes:
-                    result[service][region].append("https://" + prefix + meta.endpoint_url[len("https://"):])
+    # A single botocore session shares the loaded partition data and models between all services.
+    # Loading the endpoint resolver once up front avoids every worker thread parsing it again.
+    session = botocore.session.get_session()
+    session._get_internal_component('endpoint_resolver')
+    with contextlib.closing(ThreadPool(16)) as pool:
+        hosts = pool.map(partial(get_service_endpoint_hosts, session, regions=ALL_REGIONS), ALL_SERVICES)
+    result = dict(zip(ALL_SERVICES, hosts))
     print('...done.')
     return result
 
 
-def get_endpoint_ip(service_region_hosts):
-    (service, region), hosts = service_region_hosts
+def get_global_services():
+    """Return the names of the services with the same endpoints in all regions of the aws partition. Their resources
+    are global, and CloudTrail may report their events in another region than the one they are queried in."""
+    regions = boto3.Session().get_available_regions('ec2')
+    return set(
+        service for service, region_hosts in get_endpoint_hosts().items()
+        if len(set(tuple(region_hosts[region]) for region in regions if region in region_hosts)) == 1
+    )
+
+
+async def resolve_endpoint_ip(semaphore, service, region, hosts, timeout=DNS_TIMEOUT, retries=DNS_RETRIES):
+    """Resolve the first resolvable host of the given endpoint hosts, retrying transient failures, and return
+    the service, region and IP, which is None if no host exists, or DNS_INCONCLUSIVE if no host could be resolved
+    but the lookups of some hosts timed out or failed temporarily in all retries"""
+    loop = asyncio.get_running_loop()
     result = None
-    for host in hosts:
-        try:
-            result = gethostbyname(host.split('/')[2])
-        except gaierror as ex:
-            if ex.errno != -5:  # -5 is "No address associated with hostname"
-                raise
-        if result:
-            break
+    async with semaphore:
+        for host in hosts:
+            hostname = host.split('/')[2]
+            for attempt in range(retries + 1):
+                try:
+                    addresses = await asyncio.wait_for(
+                        loop.getaddrinfo(hostname, 443, family=AF_INET, type=SOCK_STREAM), timeout
+                    )
+                    return (service, region, addresses[0][4][0])
+                except gaierror as ex:
+                    # Only temporary failures are retried, other errors (e.g. EAI_NONAME) mean the host does not exist
+                    if ex.errno != EAI_AGAIN:
+                        break
+                    if attempt == retries:
+                        result = DNS_INCONCLUSIVE
+                        break
+                except asyncio.TimeoutError:
+                    if attempt == retries:
+                        result = DNS_INCONCLUSIVE
+                        break
+                await asyncio.sleep(0.1 * 2**attempt)
     return (service, region, result)
 
 
-def get_service_region_ip_in_dns():
-    service_region_hosts = {}
-    for service, region_hosts in get_endpoint_hosts().items():
-        for region, hosts in region_hosts.items():
-            service_region_hosts[(service, region)] = hosts
-    print('Resolving endpoint IPs to find active endpoints...')
-    result = ThreadPool(128).map(get_endpoint_ip, service_region_hosts.items())
+async def resolve_endpoint_ips(service_region_hosts, parallel=DNS_PARALLEL):
+    # Lookups are run in the loop's executor, which must be at least as large as the allowed concurrency
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(parallel))
+    semaphore = asyncio.Semaphore(parallel)
+    return await asyncio.gather(
+        *(
+            resolve_endpoint_ip(semaphore, service, region, hosts)
+            for (service, region), hosts in service_region_hosts.items()
+        )
+    )
+
+
+def get_service_region_ip_in_dns(service_region_hosts):
+    """Given a dict of (service, region) to endpoint hosts, return a list of (service, region, ip) tuples,
+    where ip is None if no endpoint host exists and DNS_INCONCLUSIVE if the lookups were inconclusive."""
+    print('Resolving {} endpoint IPs to find active endpoints...'.format(len(service_region_hosts)))
+    result = asyncio.run(resolve_endpoint_ips(service_region_hosts))
     print('...done')
     return result
 
@@ -571,22 +793,112 @@ def packaged_service_regions():
         return load(service_regions_packaged_json)
 
 
-@cache('service_regions', vary={'boto3_version': boto3.__version__}, cheap_default_func=packaged_service_regions)
-def get_service_regions():
+def calculate_service_regions(previous_service_regions=None, fallback_service_regions=None):
+    """Find the regions of all services by resolving their endpoints in DNS.
+
+    If previous service regions are given, only (service, region) pairs of services or regions
+    that are missing from them are resolved, and the previous results are kept for all other pairs.
+
+    Pairs whose lookups are inconclusive keep their result in the previous (or else the fallback) service regions.
+    If the service is in neither, the calculation fails instead of dropping the region."""
     service_regions = {}
-    for service, region, ip in get_service_region_ip_in_dns():
-        service_regions.setdefault(service, set())
-        if ip is not None:
+    service_region_hosts = {}
+    for service, region_hosts in get_endpoint_hosts().items():
+        service_regions[service] = set()
+        for region, hosts in region_hosts.items():
+            service_region_hosts[(service, region)] = hosts
+
+    if previous_service_regions is not None:
+        known_regions = set(chain.from_iterable(previous_service_regions.values()))
+        for service, region in list(service_region_hosts):
+            if service in previous_service_regions and region in known_regions:
+                del service_region_hosts[(service, region)]
+                if region in previous_service_regions[service]:
+                    service_regions[service].add(region)
+
+    if previous_service_regions is not None:
+        fallback_service_regions = previous_service_regions
+    inconclusive = []
+    for service, region, ip in get_service_region_ip_in_dns(service_region_hosts):
+        if ip == DNS_INCONCLUSIVE:
+            if service not in (fallback_service_regions or {}):
+                inconclusive.append((service, region))
+            elif region in fallback_service_regions[service]:
+                service_regions[service].add(region)
+        elif ip is not None:
             service_regions[service].add(region)
+    if inconclusive:
+        raise RuntimeError(
+            'DNS lookups of {} endpoints without previous results were inconclusive, e.g. {} in {}'.format(
+                len(inconclusive), *inconclusive[0]
+            )
+        )
     return {service: sorted(list(regions)) for service, regions in service_regions.items()}
 
 
-def get_regions_for_service(requested_service, requested_regions=()):
+service_regions_cache = cache(
+    'service_regions', vary={'boto3_version': boto3.__version__}, cheap_default_func=packaged_service_regions
+)
+
+
+@service_regions_cache
+def get_service_regions():
+    return calculate_service_regions(fallback_service_regions=packaged_service_regions())
+
+
+def get_observed_availability():
+    """Return the observed availability of services in regions, as recorded by previous queries.
+
+    The result maps profile, service and region to the number of consecutive queries in which all operations
+    were unavailable, and the time of the last of these queries."""
+    try:
+        return observed_availability_cache.get({})
+    except KeyError:
+        return {}
+
+
+def update_observed_availability(evidence, profile=None, now=None):
+    """Merge the evidence of one query run, a dict of (service, region) to True if at least one operation
+    succeeded or False if all operations were unavailable, into the observed availability."""
+    now = time() if now is None else now
+    observed = get_observed_availability()
+    profile_observed = observed.setdefault(profile or '', {})
+    for (service, region), available in evidence.items():
+        if available:
+            profile_observed.get(service, {}).pop(region, None)
+        else:
+            previous = profile_observed.setdefault(service, {}).get(region, {})
+            profile_observed[service][region] = {
+                'unavailable_queries': previous.get('unavailable_queries', 0) + 1,
+                'checked': now,
+            }
+    for service in [service for service, regions in profile_observed.items() if not regions]:
+        del profile_observed[service]
+    observed_availability_cache.store({}, observed)
+
+
+def is_observed_unavailable(service, region, profile=None, now=None):
+    """Return True if the service was repeatedly observed to be unavailable in the region,
+    and this observation is recent enough to skip querying it"""
+    now = time() if now is None else now
+    observation = get_observed_availability().get(profile or '', {}).get(service, {}).get(region)
+    if observation is None:
+        return False
+    return (
+        observation['unavailable_queries'] >= OBSERVED_UNAVAILABLE_QUERIES
+        and now - observation['checked'] < OBSERVED_UNAVAILABLE_RECHECK_SECONDS
+    )
+
+
+def get_regions_for_service(requested_service, requested_regions=(), profile=None, skip_observed_unavailable=False):
     """Given a service name, return a list of region names where this service can have resources,
-    restricted by a possible set of regions."""
+    restricted by a possible set of regions. Optionally skip regions where the service was observed
+    to be unavailable for the given profile."""
     if requested_service in ('iam', 'cloudfront', 's3', 'route53'):
         return [None]
     regions = set(get_service_regions().get(requested_service, []))
+    if skip_observed_unavailable:
+        regions = set(region for region in regions if not is_observed_unavailable(requested_service, region, profile))
     return list(regions) if not requested_regions else list(sorted(set(regions) & set(requested_regions)))
 
 
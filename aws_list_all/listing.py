@@ -1,8 +1,36 @@
+from __future__ import print_function
+
+import json
 import pprint
+import string
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+import jmespath
 
 from .client import get_client
+from .codec import buffer_streams
+from .introspection import get_child_operations, get_input_members, get_resource_identifier_keys
+from .introspection import guess_identifier_key
+
+# Key of the tags joined onto resources by their ARN, as a dict of tag keys to values
+TAGS_KEY = 'ResourceGroupsTags'
+
+# Listing operations whose resources are derived with the help of the raw response of another listing
+# operation of the same service in the same region
+AUXILIARY_OPERATIONS = {
+    'ec2': {
+        'DescribeInternetGateways': ['DescribeVpcs'],
+    },
+    'kms': {
+        'ListKeys': ['ListAliases'],
+    },
+}
+
+
+def get_auxiliary_operations(service, operation):
+    """Return the list of operations whose responses are needed to derive the resources of the given operation"""
+    return AUXILIARY_OPERATIONS.get(service, {}).get(operation, [])
 
 
 def get_parameters():
@@ -69,37 +97,319 @@ def get_parameters():
     return parameters
 
 
-def run_raw_listing_operation(service, region, operation, profile):
-    """Execute a given operation and return its raw result"""
+# Keys of the resources that the normalisation of Listing.resources filters by, which projections keep
+FILTER_KEYS = {
+    'appstream': {
+        'DescribeImages': ['Visibility']
+    },
+    'athena': {
+        'ListWorkGroups': ['Name']
+    },
+    'cloudtrail': {
+        'DescribeTrails': ['HomeRegion', 'IsMultiRegionTrail']
+    },
+    'cloudwatch': {
+        'ListMetrics': ['Namespace']
+    },
+    'docdb': {
+        'DescribeDBClusterParameterGroups': ['DBClusterParameterGroupName'],
+        'DescribeDBParameterGroups': ['DBParameterGroupName'],
+    },
+    'ec2': {
+        'DescribeFpgaImages': ['Public'],
+        'DescribeInternetGateways': ['Attachments'],
+        'DescribeNetworkAcls': ['IsDefault'],
+        'DescribeRouteTables': ['Associations'],
+        'DescribeSecurityGroups': ['GroupName'],
+        'DescribeSubnets': ['DefaultForAz'],
+        'DescribeVpcs': ['IsDefault'],
+    },
+    'elasticache': {
+        'DescribeCacheSubnetGroups': ['CacheSubnetGroupName']
+    },
+    'events': {
+        'ListEventBuses': ['Name']
+    },
+    'iam': {
+        'ListPolicies': ['Arn']
+    },
+    'kms': {
+        'ListAliases': ['AliasName'],
+        'ListKeys': ['KeyId']
+    },
+    'neptune': {
+        'DescribeDBClusterParameterGroups': ['DBClusterParameterGroupName'],
+        'DescribeDBParameterGroups': ['DBParameterGroupName'],
+    },
+    'rds': {
+        'DescribeDBClusterParameterGroups': ['DBClusterParameterGroupName'],
+        'DescribeDBParameterGroups': ['DBParameterGroupName'],
+        'DescribeDBSecurityGroups': ['DBSecurityGroupName'],
+        'DescribeOptionGroups': ['OptionGroupName'],
+    },
+    'route53resolver': {
+        'ListResolverRuleAssociations': ['ResolverRuleId'],
+        'ListResolverRules': ['Id']
+    },
+    'ssm': {
+        'DescribePatchBaselines': ['BaselineName']
+    },
+    'workmail': {
+        'ListOrganizations': ['State']
+    },
+    'xray': {
+        'GetGroups': ['GroupName']
+    },
+}
+
+# The query profile of the run, see set_query_profile
+_QUERY_PROFILE = {}
+_PROJECTIONS = {}
+
+
+def set_query_profile(query_profile):
+    """Set the query profile of all following listing operations. A query profile is a dict of services to
+    operations to a dict with optional 'parameters', which are added to the parameters of the operation, and an
+    optional 'projection' of response keys (or '*' for all other lists in the response) to JMESPath expressions,
+    which replace every item of the list in the response by the result of the expression for it, e.g.
+
+        {"ec2": {"DescribeVolumes": {
+            "parameters": {"Filters": [{"Name": "encrypted", "Values": ["false"]}]},
+            "projection": {"Volumes": "{VolumeId: VolumeId, Size: Size}"}
+        }}}
+
+    The profile is validated once: Unknown operations and parameters unsupported by their operation are ignored,
+    as are projections of operations whose raw responses are needed to derive the resources of other operations,
+    and expressions that do not select a dict (like "{VolumeId: VolumeId}"). Projected resources always keep their
+    identifier, their ARN and the keys the listing is filtered by."""
+    _QUERY_PROFILE.clear()
+    _PROJECTIONS.clear()
+    auxiliary_operations = set((service, auxiliary_operation) for service, operations in AUXILIARY_OPERATIONS.items()
+                               for auxiliary_operations_of_operation in operations.values()
+                               for auxiliary_operation in auxiliary_operations_of_operation)
+    for service, operations in query_profile.items():
+        for operation, settings in operations.items():
+            try:
+                input_members = get_input_members(service, operation)
+            except Exception:  # pylint:disable=broad-except
+                print('Ignoring query profile of unknown operation {} {}'.format(service, operation))
+                continue
+            parameters = {}
+            for key, value in settings.get('parameters', {}).items():
+                if key in input_members:
+                    parameters[key] = value
+                else:
+                    print('Ignoring query profile parameter {} unsupported by {} {}'.format(key, service, operation))
+            _QUERY_PROFILE.setdefault(service, {})[operation] = {'parameters': parameters}
+            if settings.get('projection') and (service, operation) in auxiliary_operations:
+                print(
+                    'Ignoring query profile projection of {} {}, which other listings need'.format(service, operation)
+                )
+                continue
+            projection = {}
+            for key, expression in settings.get('projection', {}).items():
+                compiled = jmespath.compile(expression)
+                if compiled.parsed['type'] != 'multi_select_dict':
+                    print(
+                        'Ignoring query profile projection {} of {} {}, which does not select a dict'.format(
+                            expression, service, operation
+                        )
+                    )
+                    continue
+                projection[key] = compiled
+            _PROJECTIONS[(service, operation)] = projection
+
+
+# The limiters that API requests of all following listing operations wait for, see set_request_limiter
+_REQUEST_LIMITERS = []
+
+
+def set_request_limiter(limiter):
+    """Make every following API request of listing operations, including the segments of partitioned listings
+    and auxiliary requests, wait for the acquire() method of the given limiter, or of none if it is None"""
+    _REQUEST_LIMITERS[:] = [limiter] if limiter is not None else []
+
+
+def load_query_profile(filename):
+    """Set the query profile from the given JSON file"""
+    with open(filename) as profile_file:
+        set_query_profile(json.load(profile_file))
+
+
+def get_profile_parameters(service, operation):
+    """Return the parameters of the query profile for the given operation"""
+    return _QUERY_PROFILE.get(service, {}).get(operation, {}).get('parameters', {})
+
+
+def merge_parameters(parameters, additional_parameters):
+    """Return the given parameters updated with additional parameters, where lists (e.g. filters) are combined"""
+    merged = dict(parameters)
+    for key, value in additional_parameters.items():
+        if isinstance(value, list) and isinstance(merged.get(key), list):
+            merged[key] = merged[key] + value
+        else:
+            merged[key] = value
+    return merged
+
+
+def project_item(expression, item, kept_keys):
+    """Return the result of the given projection expression for the given item of a response, with the given keys
+    of the item added. Items that are no dicts, e.g. names, are not projected."""
+    if not isinstance(item, dict):
+        return item
+    projected = expression.search(item)
+    if not isinstance(projected, dict):
+        return item
+    for key in kept_keys:
+        if key in item:
+            projected.setdefault(key, item[key])
+    return projected
+
+
+def project_response(service, operation, response):
+    """Apply the projection of the query profile for the given operation to its raw response. Projected resources
+    keep their identifier and ARN, so that they stay identifiable, e.g. to join tags and to query child operations,
+    and the keys that the listing is filtered by."""
+    projection = _PROJECTIONS.get((service, operation))
+    if not projection:
+        return response
+    try:
+        identifier_keys = get_resource_identifier_keys(service, operation)
+    except Exception:  # pylint:disable=broad-except
+        identifier_keys = {}
+    child_keys = [(resource_type, key) for resource_type, key, _, _ in get_child_operations(service, operation)]
+    filter_keys = FILTER_KEYS.get(service, {}).get(operation, [])
+    projected = dict(response)
+    for key, value in response.items():
+        expression = projection.get(key, projection.get('*'))
+        if expression is not None and isinstance(value, list):
+            kept_keys = [identifier_keys.get(key)] + filter_keys
+            kept_keys += [child_key for resource_type, child_key in child_keys if resource_type == key]
+            projected[key] = [project_item(expression, item, kept_keys + [get_arn_key(key, item)]) for item in value]
+    return projected
+
+
+# Number of segments of a partitioned listing to request in parallel
+PARTITION_PARALLEL = 8
+
+
+def get_partitions():
+    """Return lists of additional parameters per operation, which split a large listing into independent
+    segments that can be requested in parallel. Together, the segments must list the same resources as the
+    operation without these parameters."""
+    return {
+        'ec2': {
+            'DescribeInstances': [{
+                'Filters': [{
+                    'Name': 'instance-state-name',
+                    'Values': [state]
+                }]
+            } for state in ('pending', 'running', 'shutting-down', 'terminated', 'stopping', 'stopped')],
+            'DescribeSnapshots': [{
+                'Filters': [{
+                    'Name': 'status',
+                    'Values': [status]
+                }]
+            } for status in ('pending', 'completed', 'error', 'recoverable', 'recovering')],
+            'DescribeVolumes': [{
+                'Filters': [{
+                    'Name': 'status',
+                    'Values': [status]
+                }]
+            } for status in ('creating', 'available', 'in-use', 'deleting', 'deleted', 'error')],
+        },
+        'logs': {
+            # Log group names consist of these characters
+            'DescribeLogGroups': [{
+                'logGroupNamePrefix': character
+            } for character in string.ascii_letters + string.digits + '._-/#'],
+        },
+    }
+
+
+def merge_responses(responses):
+    """Merge the raw responses of the segments of a partitioned listing into one response"""
+    merged = {'ResponseMetadata': responses[0]['ResponseMetadata']}
+    for response in responses:
+        for key, value in response.items():
+            if key == 'ResponseMetadata':
+                continue
+            if isinstance(value, list):
+                merged.setdefault(key, []).extend(value)
+            elif value or key not in merged:
+                # Keep pagination markers of truncated segments, so that the merged listing is truncated, too
+                merged[key] = value
+    return merged
+
+
+def run_raw_listing_operation(service, region, operation, profile, parameters=None):
+    """Execute a given operation, optionally with additional parameters, and return its raw result"""
     client = get_client(service, region, profile)
     api_to_method_mapping = dict((v, k) for k, v in client.meta.method_to_api_mapping.items())
-    parameters = get_parameters().get(service, {}).get(operation, {})
     op_model = client.meta.service_model.operation_model(operation)
+    parameters = merge_parameters(
+        dict(get_parameters().get(service, {}).get(operation, {}), **(parameters or {})),
+        get_profile_parameters(service, operation)
+    )
     required_members = op_model.input_shape.required_members if op_model.input_shape else []
     if "MaxResults" in required_members:
         # Current limit for cognito identity pools is 60
         parameters["MaxResults"] = 10
-    return getattr(client, api_to_method_mapping[operation])(**parameters)
+    for limiter in _REQUEST_LIMITERS:
+        limiter.acquire()
+    # Streaming bodies are buffered, so that the response can be recorded and saved
+    response = buffer_streams(getattr(client, api_to_method_mapping[operation])(**parameters))
+    # Project the response right away, so that only the projected response is kept and saved
+    return project_response(service, operation, response)
+
+
+def get_arn_key(resource_type, item):
+    """Return the key of the ARN of the given resource, if it has one"""
+    if not isinstance(item, dict):
+        return None
+    arn_keys = [key for key in item if key.lower().endswith('arn') and isinstance(item[key], str)]
+    # Prefer the ARN of the resource itself over ARNs of related resources, e.g. FunctionArn over RoleArn
+    return guess_identifier_key(resource_type, arn_keys) if arn_keys else None
+
+
+def get_arn(resource_type, item):
+    """Return the ARN of the given resource, if it has one"""
+    if isinstance(item, str):
+        return item if item.startswith('arn:') else None
+    arn_key = get_arn_key(resource_type, item)
+    return item[arn_key] if arn_key else None
 
 
 class Listing(object):
     """Represents a listing operation on an AWS service and its result"""
 
-    def __init__(self, service, region, operation, response, profile):
+    def __init__(
+        self, service, region, operation, response, profile, auxiliary_responses=None, parameters=None, tags=None
+    ):
         self.service = service
         self.region = region
         self.operation = operation
         self.response = response
         self.profile = profile
+        self.auxiliary_responses = auxiliary_responses or {}
+        self.parameters = parameters or {}
+        self.tags = tags or {}
 
     def to_json(self):
-        return {
+        data = {
             'service': self.service,
             'region': self.region,
             'profile': self.profile,
             'operation': self.operation,
             'response': self.response,
         }
+        if self.auxiliary_responses:
+            data['auxiliary_responses'] = self.auxiliary_responses
+        if self.parameters:
+            data['parameters'] = self.parameters
+        if self.tags:
+            data['tags'] = self.tags
+        return data
 
     @classmethod
     def from_json(cls, data):
@@ -108,9 +418,20 @@ class Listing(object):
             region=data.get('region'),
             profile=data.get('profile'),
             operation=data.get('operation'),
-            response=data.get('response')
+            response=data.get('response'),
+            auxiliary_responses=data.get('auxiliary_responses'),
+            parameters=data.get('parameters'),
+            tags=data.get('tags')
         )
 
+    def auxiliary_response(self, operation):
+        """Return the raw response of the given auxiliary operation, requesting it from AWS if it is not known yet"""
+        if operation not in self.auxiliary_responses:
+            self.auxiliary_responses[operation] = run_raw_listing_operation(
+                self.service, self.region, operation, self.profile
+            )
+        return self.auxiliary_responses[operation]
+
     @property
     def resource_types(self):
         """The list of resource types (Keys with list content) in the response"""
@@ -126,6 +447,19 @@ class Listing(object):
         with open(filename, 'w') as outfile:
             outfile.write(pprint.pformat(self.resources).encode('utf-8'))
 
+    def identifier_key(self, resource_type, resources=()):
+        """Return the key identifying the resources of the given type, from the service model if possible
+        and else guessed once from the keys of the first of the given resources"""
+        try:
+            identifier_keys = get_resource_identifier_keys(self.service, self.operation)
+        except Exception:  # pylint:disable=broad-except
+            # The service or operation is unknown to the installed botocore
+            identifier_keys = {}
+        if resource_type in identifier_keys:
+            return identifier_keys[resource_type]
+        first = resources[0] if resources else None
+        return guess_identifier_key(resource_type, list(first)) if isinstance(first, dict) else None
+
     def __str__(self):
         opdesc = '{} {} {} {}'.format(self.service, self.region, self.operation, self.profile)
         if len(self.resource_types) == 0 or self.resource_total_count == 0:
@@ -133,12 +467,31 @@ class Listing(object):
         return opdesc + ', '.join('#{}: {}'.format(key, len(listing)) for key, listing in self.resources.items())
 
     @classmethod
-    def acquire(cls, service, region, operation, profile):
-        """Acquire the given listing by making an AWS request"""
-        response = run_raw_listing_operation(service, region, operation, profile)
+    def acquire(cls, service, region, operation, profile, parameters=None):
+        """Acquire the given listing by making an AWS request. If the listing is truncated and can be
+        partitioned, its segments are requested in parallel and merged instead."""
+        response = run_raw_listing_operation(service, region, operation, profile, parameters)
         if response['ResponseMetadata']['HTTPStatusCode'] != 200:
             raise Exception('Bad AWS HTTP Status Code', response)
-        return cls(service, region, operation, response, profile)
+        listing = cls(service, region, operation, response, profile, parameters=parameters)
+        segments = get_partitions().get(service, {}).get(operation)
+        if segments and not parameters and 'truncated' in listing.resources:
+            listing.response = cls.acquire_segments(service, region, operation, profile, segments)
+        return listing
+
+    @staticmethod
+    def acquire_segments(service, region, operation, profile, segments):
+        """Request the given segments of a listing in parallel and return their merged raw response"""
+        with ThreadPoolExecutor(PARTITION_PARALLEL) as executor:
+            responses = list(
+                executor.map(
+                    lambda segment: run_raw_listing_operation(service, region, operation, profile, segment), segments
+                )
+            )
+        for response in responses:
+            if response['ResponseMetadata']['HTTPStatusCode'] != 200:
+                raise Exception('Bad AWS HTTP Status Code', response)
+        return merge_responses(responses)
 
     @property
     def resources(self):  # pylint:disable=too-many-branches
@@ -237,7 +590,7 @@ class Listing(object):
 
         # Special handling for service-level kms keys; derived from alias name.
         if self.service == 'kms' and self.operation == 'ListKeys':
-            list_aliases = run_raw_listing_operation(self.service, self.region, 'ListAliases', self.profile)
+            list_aliases = self.auxiliary_response('ListAliases')
             service_key_ids = [
                 k.get('TargetKeyId') for k in list_aliases.get('Aliases', [])
                 if k.get('AliasName').lower().startswith('alias/aws')
@@ -349,7 +702,7 @@ class Listing(object):
 
         # Filter default Internet Gateways
         if self.service == 'ec2' and self.operation == 'DescribeInternetGateways':
-            describe_vpcs = run_raw_listing_operation(self.service, self.region, 'DescribeVpcs', self.profile)
+            describe_vpcs = self.auxiliary_response('DescribeVpcs')
             vpcs = {v['VpcId']: v for v in describe_vpcs.get('Vpcs', [])}
             internet_gateways = []
             for ig in response['InternetGateways']:
@@ -381,6 +734,13 @@ class Listing(object):
         if (self.service, self.operation) in (
             ('applicationcostprofiler', 'ListReportDefinitions'),
             ('connectcampaigns', 'ListCampaigns'),
+            ('ecr', 'ListImages'),
+            ('ecs', 'ListContainerInstances'),
+            ('ecs', 'ListServices'),
+            ('ecs', 'ListTasks'),
+            ('eks', 'ListAddons'),
+            ('eks', 'ListFargateProfiles'),
+            ('eks', 'ListNodegroups'),
             ('inspector', 'ListFindings'),
             ('iot-data', 'ListRetainedMessages'),
             ('logs', 'DescribeLogGroups'),
@@ -396,7 +756,20 @@ class Listing(object):
             if not isinstance(value, list):
                 raise Exception('No listing: {} is no list:'.format(key), response)
 
+        # Join the tags of the resources by their ARN, without changing the raw response
+        if self.tags:
+            for key, value in response.items():
+                response[key] = [self._with_tags(key, item) for item in value]
+
         if not complete:
             response['truncated'] = [True]
 
         return response
+
+    def _with_tags(self, resource_type, item):
+        if not isinstance(item, dict) or TAGS_KEY in item:
+            return item
+        arn = get_arn(resource_type, item)
+        if arn not in self.tags:
+            return item
+        return dict(item, **{TAGS_KEY: self.tags[arn]})
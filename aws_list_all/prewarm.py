@@ -0,0 +1,141 @@
+from __future__ import print_function
+
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from time import time
+from urllib.parse import urlparse
+
+from .client import get_client, is_work_done
+from .introspection import get_endpoint_hosts
+
+# Warming connections uses private APIs of botocore and urllib3, so it is only done with the major versions of
+# urllib3 it was written for and if the APIs exist. Otherwise, only the clients are created ahead of their queries.
+CAN_WARM_CONNECTIONS = False
+try:
+    from botocore.httpsession import URLLib3Session
+    from urllib3 import HTTPConnectionPool, __version__ as URLLIB3_VERSION
+    CAN_WARM_CONNECTIONS = (
+        URLLIB3_VERSION.split('.')[0] in ('1', '2')
+        and all(hasattr(URLLib3Session, name) for name in ('_get_connection_manager', '_setup_ssl_cert'))
+        and all(hasattr(HTTPConnectionPool, name) for name in ('_get_conn', '_put_conn'))
+    )
+except ImportError:
+    pass
+
+# Number of connections opened in parallel. Opening connections is cheap for the client, so this can be larger
+# than the number of parallel queries, which lets warming stay ahead of the queries.
+PREWARM_PARALLEL = 64
+
+# Maximum number of warmed endpoints whose queries are not done yet. This bounds the clients the prewarmer adds
+# to the client cache well below its size cap, so that warmed clients are not evicted before their queries run.
+PREWARM_WINDOW = 64
+
+# Seconds between checks whether the queries have caught up with the warmed endpoints
+PREWARM_POLL_SECONDS = 0.1
+
+
+def get_warm_urls(client, endpoint_hosts):
+    """Return the URLs of the given endpoint hosts of the service and region of the client that share its endpoint,
+    including host prefixes of some operations, or only its endpoint URL if they do not (e.g. for custom endpoints)"""
+    endpoint_url = client.meta.endpoint_url
+    netloc = urlparse(endpoint_url).netloc
+    return [host for host in endpoint_hosts if urlparse(host).netloc.endswith(netloc)] or [endpoint_url]
+
+
+def warm_connection(client, url):
+    """Open a connection (resolving its host and doing the TLS handshake) to the given URL and put it into the
+    connection pool of the client, where the first request to that URL takes it from.
+
+    This mirrors how botocore's URLLib3Session selects and configures the connection pool of a request."""
+    # pylint:disable=protected-access
+    http_session = client._endpoint.http_session
+    manager = http_session._get_connection_manager(url, http_session._proxy_config.proxy_url_for(url))
+    pool = manager.connection_from_url(url)
+    http_session._setup_ssl_cert(pool, url, http_session._verify)
+    connection = pool._get_conn()
+    try:
+        connection.connect()
+    except Exception:
+        connection.close()
+        raise
+    finally:
+        pool._put_conn(connection)
+
+
+def warm_endpoint(endpoint, endpoint_hosts):
+    """Create the client of the given (service, region, profile) endpoint and warm its connections,
+    unless its queries are done already. Returns the number of warmed and failed connections."""
+    service, region, profile = endpoint
+    warmed = failed = 0
+    try:
+        client = get_client(service, region, profile, unless_done=True)
+        if client is None or not CAN_WARM_CONNECTIONS:
+            return 0, 0
+        for url in get_warm_urls(client, endpoint_hosts.get(service, {}).get(region) or []):
+            try:
+                warm_connection(client, url)
+                warmed += 1
+            except Exception:  # pylint:disable=broad-except
+                # The first query of the endpoint will fail or connect itself
+                failed += 1
+    except Exception:  # pylint:disable=broad-except
+        failed += 1
+    return warmed, failed
+
+
+class Prewarmer(object):
+    """Creates the clients and opens connections to the endpoints of the given queries in a background thread,
+    in the order of the queries, so that the first request to each endpoint finds a warm connection. At most
+    window warmed endpoints are ahead of the queries, i.e. have queries that are not done yet."""
+
+    def __init__(self, to_run, parallel=PREWARM_PARALLEL, window=PREWARM_WINDOW, verbose=0):
+        self.endpoints = list(dict.fromkeys((query[0], query[1], query[3]) for query in to_run))
+        self.parallel = parallel
+        self.window = window
+        self.verbose = verbose
+        self.warmed = self.failed = 0
+        self._stopped = Event()
+        self._thread = Thread(target=self._warm, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _wait_for_window(self, ahead):
+        """Wait until fewer than window of the given warmed endpoints are not done, and return those,
+        or None if the prewarmer was stopped"""
+        while True:
+            ahead = [endpoint for endpoint in ahead if not is_work_done(*endpoint)]
+            if len(ahead) < self.window:
+                return ahead
+            if self._stopped.wait(PREWARM_POLL_SECONDS):
+                return None
+
+    def _warm(self):
+        start_time = time()
+        endpoint_hosts = get_endpoint_hosts()
+        futures = []
+        ahead = []
+        with ThreadPoolExecutor(self.parallel) as executor:
+            for endpoint in self.endpoints:
+                ahead = self._wait_for_window(ahead)
+                if ahead is None:
+                    break
+                ahead.append(endpoint)
+                futures.append(executor.submit(warm_endpoint, endpoint, endpoint_hosts))
+        for future in futures:
+            warmed, failed = future.result()
+            self.warmed += warmed
+            self.failed += failed
+        if self.verbose > 0:
+            print(
+                'Warmed {} connections to {} endpoints in {:.1f}s ({} failed)'.format(
+                    self.warmed, len(futures),
+                    time() - start_time, self.failed
+                )
+            )
+
+    def join(self):
+        """Stop warming further endpoints and wait for the warming ones"""
+        self._stopped.set()
+        self._thread.join()
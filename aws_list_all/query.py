@@ -1,24 +1,49 @@
 from __future__ import print_function
 
 import json
+import os
 import sys
-import contextlib
-from collections import defaultdict
-from datetime import datetime
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
 from functools import partial
-from multiprocessing.pool import ThreadPool
-from random import shuffle
+from hashlib import sha1
+from threading import Lock
 from time import time
 from traceback import print_exc
 
-from .introspection import get_listing_operations, get_regions_for_service
-from .listing import Listing
+from .changes import FULL_SWEEP_INTERVAL, plan_changed_queries, record_scan
+from .client import expect_work, finish_work, print_client_stats
+from .codec import dump_listing_file, load_listing_file
+from .export import ParquetExport
+from .index import apply_resource_index, get_resource_index
+from .introspection import (
+    get_child_operations, get_listing_operations, get_regions_for_service, update_observed_availability
+)
+from .listing import Listing, get_auxiliary_operations
+from .prewarm import Prewarmer
+from .record import Recorder, RecordedListing, get_cassette_filenames, read_cassette_file
+from .report import MANIFEST_FILENAME, ListingManifest, RunReport, get_listing_mtime, get_manifest_entry, read_manifest
+from .schedule import (
+    SCHEDULE_BATCH_SIZES, SCHEDULES, get_endpoint, get_recorded_durations, order_dependencies_first, record_durations,
+    simulate_schedules
+)
+from .store import SnapshotStore
+from .tags import TagIndex
 
 RESULT_NOTHING = '---'
 RESULT_SOMETHING = '+++'
 RESULT_ERROR = '!!!'
 RESULT_NO_ACCESS = '>:|'
 
+# Names of the result types in run reports
+RESULT_CLASSIFICATIONS = {
+    RESULT_NOTHING: 'nothing',
+    RESULT_SOMETHING: 'something',
+    RESULT_NO_ACCESS: 'no_access',
+    RESULT_ERROR: 'error',
+}
+
 # List of requests with legitimate, persistent errors that indicate that no listable resources are present.
 #
 # If the request would never return listable resources, it should not be done and be listed in one of the lists
@@ -129,7 +154,6 @@ RESULT_IGNORE_ERRORS = {
         # Not available in this region
         'DescribeElasticGpus':
             'not available in this region',
-
     },
     'fms': {
         'ListMemberAccounts': 'not currently delegated by AWS FM',
@@ -312,122 +336,613 @@ NOT_AVAILABLE_FOR_ACCOUNT_STRINGS = [
 
 NOT_AVAILABLE_STRINGS = NOT_AVAILABLE_FOR_REGION_STRINGS + NOT_AVAILABLE_FOR_ACCOUNT_STRINGS
 
+# Errors that show that a service is not available in a region, as opposed to errors of the credentials (which
+# also occur in regions that are not enabled for the account), of the account or of features that are not enabled
+REGION_UNAVAILABLE_STRINGS = (
+    'is not supported in this region',
+    'is not available in this region',
+    'not supported in the called region.',
+    'Operation not available in this region',
+    # Endpoints that resolve, but do not accept connections or do not serve the right certificate
+    'Could not connect to the endpoint URL',
+    'SSLError',
+    'SSL validation failed',
+)
+
+# Services whose ignored errors in RESULT_IGNORE_ERRORS show that they are not available in an advertised region
+REGION_UNAVAILABLE_IGNORED_SERVICES = ('autoscaling-plans', 'cloud9', 'config')
 
-def do_query(services, selected_regions=(), selected_operations=(), verbose=0, parallel=32, selected_profile=None):
-    """For the given services, execute all selected operations (default: all) in selected regions
-    (default: all)"""
+# Maximum number of child queries per child operation and parent listing
+CHILD_FANOUT = 100
+
+# Seconds a listing waits for the auxiliary response of another query of the run before requesting it itself
+AUXILIARY_TIMEOUT = 60
+
+
+class AvailabilityEvidence(object):
+    """Collects evidence whether services are available in regions from the outcomes of their operations"""
+
+    def __init__(self):
+        self._lock = Lock()
+        self._outcomes = defaultdict(set)
+
+    def record(self, service, region, outcome):
+        """Record an operation outcome: True on success, False if unavailable, None on any other error"""
+        if region is None:
+            return
+        with self._lock:
+            self._outcomes[(service, region)].add(outcome)
+
+    def conclusions(self, include_unavailable=True):
+        """Return a dict of (service, region) to True if at least one operation succeeded, or False if all
+        operations were unavailable. Inconclusive pairs are left out."""
+        result = {}
+        for key, outcomes in self._outcomes.items():
+            if True in outcomes:
+                result[key] = True
+            elif outcomes == {False} and include_unavailable:
+                result[key] = False
+        return result
+
+
+class SharedResponses(object):
+    """Raw responses of the queries in a run that other listings of the same run depend on"""
+
+    def __init__(self, to_run):
+        planned = set(tuple(query) for query in to_run)
+        self._futures = {}
+        for service, region, operation, profile in planned:
+            for auxiliary_operation in get_auxiliary_operations(service, operation):
+                key = (service, region, auxiliary_operation, profile)
+                if key in planned:
+                    self._futures[key] = Future()
+
+    def publish(self, what, response=None, exception=None):
+        """Make the raw response (or the exception) of the given query available to its dependents"""
+        if len(what) > 4:
+            # Queries with parameters, e.g. child queries, are never needed by other queries
+            return
+        future = self._futures.get(tuple(what))
+        if future is None or future.done():
+            return
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(response)
+
+    def collect(self, listing, timeout=AUXILIARY_TIMEOUT):
+        """Wait for and return the auxiliary responses of the given listing that are acquired in this run.
+        Auxiliary responses of queries outside the run, of failed queries and of queries that do not finish within
+        the timeout (e.g. because they were not started yet) are left out, and are requested by the listing itself."""
+        responses = {}
+        for operation in get_auxiliary_operations(listing.service, listing.operation):
+            future = self._futures.get((listing.service, listing.region, operation, listing.profile))
+            if future is None:
+                continue
+            try:
+                if future.exception(timeout) is None:
+                    responses[operation] = future.result()
+            except FutureTimeoutError:
+                pass
+        return responses
+
+
+def plan_queries(
+    services,
+    selected_regions=(),
+    selected_operations=(),
+    verbose=0,
+    selected_profile=None,
+    use_observed_availability=True
+):
+    """Return a list of [service, region, operation, profile] queries to execute for the given services,
+    selected operations (default: all) and selected regions (default: all)"""
     to_run = []
-    print('Building set of queries to execute...')
     for service in services:
-        for region in get_regions_for_service(service, selected_regions):
+        for region in get_regions_for_service(
+            service, selected_regions, selected_profile, skip_observed_unavailable=use_observed_availability
+        ):
             for operation in get_listing_operations(service, region, selected_operations, selected_profile):
                 if verbose > 0:
                     region_name = region or 'n/a'
                     print('Service: {: <28} | Region: {:<15} | Operation: {}'.format(service, region_name, operation))
 
                 to_run.append([service, region, operation, selected_profile])
-    shuffle(to_run)  # Distribute requests across endpoints
+    return to_run
+
+
+def do_query(
+    services,
+    selected_regions=(),
+    selected_operations=(),
+    verbose=0,
+    parallel=32,
+    selected_profile=None,
+    use_observed_availability=True,
+    schedule='longest-first',
+    simulate=False,
+    expand_children=False,
+    child_fanout=CHILD_FANOUT,
+    report_filename=None,
+    store_directory=None,
+    record_directory=None,
+    export_directory=None,
+    changes_only=False,
+    cloudtrail_directory=None,
+    full_sweep_interval=FULL_SWEEP_INTERVAL,
+    resource_index=None,
+    index_region='us-east-1',
+    index_view=None,
+    config_aggregator=None,
+    skip_empty=True,
+    tags=False,
+    prewarm=True
+):
+    """For the given services, execute all selected operations (default: all) in selected regions
+    (default: all). Optionally, child operations are queried for the resources found by their parent operations.
+
+    If a report file name is given, results are streamed to this run report instead of being collected,
+    and only a summary of the results is printed at the end. If a store directory is given, the listings are also
+    added to the snapshot store in this directory. If a record directory is given, the raw responses of all queries
+    are recorded to a cassette in this directory for reprocessing. If an export directory is given, the resources
+    are exported to a Parquet dataset in this directory.
+
+    With changes_only, only the queries affected by changes reported by CloudTrail (or the CloudTrail logs in
+    the given directory) since the last such run of their service and region, and the queries that failed in it,
+    are executed, unless the last full sweep of their service and region is too long ago.
+
+    With a resource index (resource-explorer or config), queries of service/region pairs the index reports resources
+    in are executed first, and queries of services it does not cover afterwards. Queries of pairs the index reports
+    empty are skipped, or executed last if skip_empty is False.
+
+    With tags, the tags of all resources are fetched in bulk from the Resource Groups Tagging API once per region
+    and joined onto the resources by their ARN.
+
+    With prewarm, the clients and connections of the endpoints are created and opened in the background
+    while the queries run, ahead of their first query."""
+    start_time = time()
+    print('Building set of queries to execute...')
+    to_run = plan_queries(
+        services, selected_regions, selected_operations, verbose, selected_profile, use_observed_availability
+    )
+    if changes_only:
+        to_run, scan_scopes = plan_changed_queries(
+            to_run, selected_profile, cloudtrail_directory, full_sweep_interval, now=start_time
+        )
+    recorded_durations = get_recorded_durations(selected_profile)
+    if simulate:
+        print('...done.')
+        simulate_schedules(to_run, recorded_durations, parallel)
+        return
+    # Distribute requests across endpoints, and start long requests first so they do not dominate the end of the run
+    to_run = SCHEDULES[schedule](to_run, recorded_durations)
+    index = None
+    if resource_index:
+        regions = sorted(set(query[1] for query in to_run if query[1]))
+        index = get_resource_index(
+            resource_index, index_region, regions, selected_profile, index_view, config_aggregator
+        )
+        if index is not None:
+            to_run = apply_resource_index(to_run, index, skip_empty)
+    # Queries whose responses other queries need must be started first in the final order, or their dependents
+    # would wait for them
+    to_run = order_dependencies_first(to_run)
+    prewarmer = Prewarmer(to_run, verbose=verbose).start() if prewarm else None
     results_by_type = defaultdict(list)
+    report = RunReport(report_filename, RESULT_CLASSIFICATIONS) if report_filename else None
+    evidence = AvailabilityEvidence()
+    durations = {}
+    failed = []
+    shared_responses = SharedResponses(to_run)
+    child_queries = deque() if expand_children else None
+    manifest = ListingManifest()
+    store = SnapshotStore(store_directory) if store_directory else None
+    recorder = Recorder(record_directory) if record_directory else None
+    export = ParquetExport(export_directory) if export_directory else None
+    run = partial(
+        acquire_listing,
+        verbose,
+        evidence=evidence,
+        shared_responses=shared_responses,
+        child_queries=child_queries,
+        child_fanout=child_fanout,
+        manifest=manifest,
+        store=store,
+        recorder=recorder,
+        export=export,
+        tag_index=TagIndex() if tags else None
+    )
     print('...done. Executing queries...')
-    # the `with` block is a workaround for a bug: https://bugs.python.org/issue35629
-    with contextlib.closing(ThreadPool(parallel)) as pool:
-        for result in pool.imap_unordered(partial(acquire_listing, verbose), to_run):
-            results_by_type[result[0]].append(result)
+    batch_size = SCHEDULE_BATCH_SIZES.get(schedule, 1)
+    try:
+        for result, duration in execute_queries(to_run, run, parallel, child_queries, selected_operations, batch_size):
+            durations[tuple(result[1:4])] = duration
+            if result[0] == RESULT_ERROR:
+                failed.append(result[1:4])
+            if report is not None:
+                report.add(result, duration)
+            else:
+                results_by_type[result[0]].append(result)
             if verbose > 1:
                 print('ExecutedQueryResult: {}'.format(result))
             else:
                 print(result[0][-1], end='')
                 sys.stdout.flush()
+    finally:
+        if report is not None:
+            report.close()
+    manifest.close()
+    if recorder is not None:
+        recorder.close()
     print('...done')
-    for result_type in (RESULT_NOTHING, RESULT_SOMETHING, RESULT_NO_ACCESS, RESULT_ERROR):
-        for result in sorted(results_by_type[result_type]):
-            print(*result)
+    if export is not None:
+        export.close()
+    if store is not None:
+        store.close()
+    # A service is only unavailable in a region if all its operations were queried and were unavailable, which
+    # is not known if only some operations were selected, or were skipped by the resource index or unchanged
+    all_queried = not selected_operations and (index is None or not skip_empty) and not changes_only
+    update_observed_availability(evidence.conclusions(include_unavailable=all_queried), profile=selected_profile)
+    record_durations(durations, profile=selected_profile)
+    if prewarmer is not None:
+        prewarmer.join()
+    print_client_stats()
+    if changes_only:
+        record_scan(start_time, scan_scopes, failed, profile=selected_profile)
+    if report is not None:
+        report.print_summary()
+        return
+    print_results(results_by_type)
+
+
+def execute_queries(
+    to_run, run, parallel=32, child_queries=None, selected_operations=(), batch_size=1, evict_done=True
+):
+    """Execute the given queries with the run function in parallel threads, and yield the result and duration
+    of each query as it completes. Child queries appended to child_queries by the run function are started
+    before the remaining queries. With evict_done, clients are closed as soon as all queries using them are done,
+    otherwise they stay cached for later runs in the same process.
+
+    Up to batch_size consecutive queries of the same endpoint are executed in sequence by one thread, so that
+    they reuse its warm connection."""
+    queue = deque(to_run)
+    pending = {}
+    if evict_done:
+        expect_work(to_run)
+    with ThreadPoolExecutor(parallel) as executor:
+        while queue or pending:
+            # Keep a bounded number of queries in flight, so that child queries can be started before the rest
+            while queue and len(pending) < 2 * parallel:
+                batch = [queue.popleft()]
+                while queue and len(batch) < batch_size and get_endpoint(queue[0]) == get_endpoint(batch[0]):
+                    batch.append(queue.popleft())
+                pending[executor.submit(timed_calls, run, batch)] = batch
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            finished = [query for future in done for query in pending.pop(future)]
+            for future in done:
+                for result in future.result():
+                    yield result
+            while child_queries:
+                child_query = child_queries.pop()
+                if not selected_operations or child_query[2] in selected_operations:
+                    if evict_done:
+                        expect_work([child_query])
+                    queue.appendleft(child_query)
+            # Child queries are registered first, so that the clients they need are kept
+            for query in finished if evict_done else ():
+                finish_work(query[0], query[1], query[3])
+
+
+def timed_call(func, *args):
+    """Call the given function and return its result and the duration of the call"""
+    start_time = time()
+    result = func(*args)
+    return result, time() - start_time
+
+
+def timed_calls(func, queries):
+    """Call the given function for each of the given queries in sequence, and return a list of their results
+    and durations"""
+    return [timed_call(func, query) for query in queries]
 
 
-def acquire_listing(verbose, what):
-    """Given a service, region and operation execute the operation, serialize and save the result and
-    return a tuple of strings describing the result."""
-    service, region, operation, profile = what
+def get_child_queries(listing, fanout=CHILD_FANOUT):
+    """Return the queries of the child operations for the resources of the given listing,
+    with at most fanout queries per child operation"""
+    resources = listing.resources
+    child_queries = []
+    for resource_type, key, child_operation, parameter in get_child_operations(listing.service, listing.operation):
+        identifiers = []
+        for resource in resources.get(resource_type, []):
+            identifier = resource.get(key) if key else resource
+            if identifier and identifier not in identifiers:
+                identifiers.append(identifier)
+        for identifier in identifiers[:fanout]:
+            child_queries.append([
+                listing.service, listing.region, child_operation, listing.profile, {
+                    parameter: identifier
+                }
+            ])
+    return child_queries
+
+
+def get_listing_filename(service, region, operation, profile, parameters=None):
+    """Return the name of the file to save the listing of the given query to"""
+    if not parameters:
+        return '{}_{}_{}_{}.json'.format(service, operation, region, profile)
+    parameters_hash = sha1(json.dumps(parameters, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+    return '{}_{}_{}_{}_{}.json'.format(service, operation, region, profile, parameters_hash)
+
+
+def acquire_listing(
+    verbose,
+    what,
+    evidence=None,
+    shared_responses=None,
+    child_queries=None,
+    child_fanout=CHILD_FANOUT,
+    manifest=None,
+    store=None,
+    recorder=None,
+    export=None,
+    tag_index=None
+):
+    """Given a service, region and operation (and optionally parameters) execute the operation, serialize and save
+    the result and return a tuple of strings describing the result. If given, the availability evidence is updated
+    with the outcome, the raw response is shared with (or auxiliary responses are taken from) other queries of the
+    run, and queries for child operations of the found resources are appended to child_queries. Written listing
+    files are added to the manifest and the snapshot store, raw responses are recorded with the recorder, and
+    resources are added to the export, if given. With a tag index, the tags of the resources are joined onto them."""
+    service, region, operation, profile = what[:4]
+    parameters = what[4] if len(what) > 4 else None
+    description = get_description(parameters)
     start_time = time()
+    listing = None
     try:
         if verbose > 1:
             print(what, 'starting request...')
-        listing = Listing.acquire(service, region, operation, profile)
+        listing = Listing.acquire(service, region, operation, profile, parameters)
+        if shared_responses is not None:
+            shared_responses.publish(what, response=listing.response)
+            listing.auxiliary_responses.update(shared_responses.collect(listing))
         duration = time() - start_time
         if verbose > 1:
             print(what, '...request successful')
             print("timing [success]:", duration, what)
-        if listing.resource_total_count > 0:
-            with open('{}_{}_{}_{}.json'.format(service, operation, region, profile), 'w') as jsonfile:
-                json.dump(listing.to_json(), jsonfile, default=datetime.isoformat)
-            return (RESULT_SOMETHING, service, region, operation, profile, ', '.join(listing.resource_types))
-        else:
-            return (RESULT_NOTHING, service, region, operation, profile, ', '.join(listing.resource_types))
+        if evidence is not None:
+            evidence.record(service, region, True)
+        if child_queries is not None:
+            child_queries.extend(get_child_queries(listing, child_fanout))
+        if tag_index is not None:
+            tag_index.enrich(listing)
+        result = save_listing(listing, description, manifest, store, export)
+        if recorder is not None:
+            record_query(recorder, what, listing)
+        return result
     except Exception as exc:  # pylint:disable=broad-except
+        if shared_responses is not None:
+            shared_responses.publish(what, exception=exc)
         duration = time() - start_time
         if verbose > 1:
             print(what, '...exception:', exc)
             print("timing [failure]:", duration, what)
         if verbose > 2:
             print_exc()
-        result_type = RESULT_NO_ACCESS if 'AccessDeniedException' in str(exc) else RESULT_ERROR
-
-        ignored_err = RESULT_IGNORE_ERRORS.get(service, {}).get(operation)
-        if ignored_err is not None:
-            if not isinstance(ignored_err, list):
-                ignored_err = list(ignored_err)
-            for ignored_str_err in ignored_err:
-                if ignored_str_err in str(exc):
-                    result_type = RESULT_NOTHING
-
-        for not_available_string in NOT_AVAILABLE_STRINGS:
-            if not_available_string in str(exc):
-                result_type = RESULT_NOTHING
-
-        return (result_type, service, region, operation, profile, repr(exc))
-
-
-def do_list_files(filenames, verbose=0):
-    """Print out a rudimentary summary of the Listing objects contained in the given files"""
-    for listing_filename in filenames:
-        listing = Listing.from_json(json.load(open(listing_filename, 'rb')))
-        resources = listing.resources
-        truncated = False
-        if 'truncated' in resources:
-            truncated = resources['truncated']
-            del resources['truncated']
-        for resource_type, value in resources.items():
-            len_string = '> {}'.format(len(value)) if truncated else str(len(value))
-            print(listing.service, listing.region, listing.operation, resource_type, len_string)
-            if verbose > 0:
-                for item in value:
-                    idkey = None
-                    if isinstance(item, dict):
-                        guesses = [resource_type[:-1] + "Id", "id", "SerialNumber"]
-                        # Find the last uppercase word in the resource_type and construct some guesses from that
-                        uppercase_indices = [i for (i, c) in enumerate(resource_type) if c.isupper()]
-                        if uppercase_indices:
-                            last_word_in_resource_type = resource_type[uppercase_indices[-1]:]
-                            guesses.append(last_word_in_resource_type[:-1] + "Id")
-                            guesses.append(last_word_in_resource_type + "Id")
-                        for guess in guesses:
-                            if guess in item:
-                                idkey = guess
-                                break
-                        if idkey is None:
-                            for heuristic in [
-                                lambda x: x.endswith('Id'),
-                                lambda x: x.endswith('Name'),
-                            ]:
-                                idkeys = [k for k in item.keys() if heuristic(k)]
-                                if idkeys:
-                                    # Heuristic: Shortest ID is probably the Resource ID
-                                    idkeys.sort(key=len)
-                                    idkey = idkeys[0]
-                                    break
-                    if idkey:
-                        print('    - ', item.get(idkey, ', '.join(item.keys())))
-                    else:
-                        print('    - ', item)
-                if truncated:
-                    print('    - ... (more items, query truncated)')
+        if recorder is not None:
+            # Listings whose resources could not be derived are recorded, too, so they can be reprocessed
+            record_query(recorder, what, listing, exc)
+        result_type = get_error_result_type(service, operation, str(exc))
+        if evidence is not None:
+            region_unavailable = is_region_unavailable(service, operation, repr(exc))
+            evidence.record(service, region, False if region_unavailable else None)
+        return (result_type, service, region, operation, profile, ' '.join(filter(None, (description, repr(exc)))))
+
+
+def record_query(recorder, what, listing=None, exc=None):
+    """Record the listing of the given query, or its exception if it has no listing. Recording failures, e.g. of
+    unserializable responses, are printed instead of aborting the scan."""
+    try:
+        if listing is not None:
+            recorder.add(listing)
+        else:
+            recorder.add_error(what, exc)
+    except Exception as record_exc:  # pylint:disable=broad-except
+        print(what, 'cannot be recorded:', repr(record_exc))
+
+
+def get_error_result_type(service, operation, message):
+    """Return the result type of a query of the given operation that failed with the given error message"""
+    result_type = RESULT_NO_ACCESS if 'AccessDeniedException' in message else RESULT_ERROR
+
+    if is_ignored_error(service, operation, message):
+        result_type = RESULT_NOTHING
+
+    for not_available_string in NOT_AVAILABLE_STRINGS:
+        if not_available_string in message:
+            result_type = RESULT_NOTHING
+    return result_type
+
+
+def is_ignored_error(service, operation, message):
+    """Return whether the given error message of the given operation is ignored by RESULT_IGNORE_ERRORS"""
+    ignored_err = RESULT_IGNORE_ERRORS.get(service, {}).get(operation)
+    if ignored_err is None:
+        return False
+    if not isinstance(ignored_err, list):
+        ignored_err = [ignored_err]
+    return any(ignored_str_err in message for ignored_str_err in ignored_err)
+
+
+def is_region_unavailable(service, operation, message):
+    """Return whether the given error message (the repr of the exception, which names its class) of the given
+    operation shows that the service is not available in the region"""
+    if service in REGION_UNAVAILABLE_IGNORED_SERVICES and is_ignored_error(service, operation, message):
+        return True
+    return any(region_unavailable_string in message for region_unavailable_string in REGION_UNAVAILABLE_STRINGS)
+
+
+def get_description(parameters):
+    """Return the description of the parameters of a child query"""
+    return ' '.join('{}={}'.format(k, v) for k, v in sorted(parameters.items())) if parameters else ''
+
+
+def save_listing(listing, description='', manifest=None, store=None, export=None):
+    """Save the given listing to its listing file if it contains resources, and return its result tuple"""
+    service, region, operation, profile = listing.service, listing.region, listing.operation, listing.profile
+    resource_types = ' '.join(filter(None, (', '.join(listing.resource_types), description)))
+    if listing.resource_total_count > 0:
+        listing_filename = get_listing_filename(service, region, operation, profile, listing.parameters)
+        dump_listing_file(listing.to_json(), listing_filename)
+        if manifest is not None:
+            manifest.add(listing_filename, listing)
+        if store is not None:
+            store.add(listing_filename, listing)
+        if export is not None:
+            export.add(listing)
+        return (RESULT_SOMETHING, service, region, operation, profile, resource_types)
+    else:
+        return (RESULT_NOTHING, service, region, operation, profile, resource_types)
+
+
+def process_record(verbose, record, manifest=None):
+    """Derive and save the listing of the given cassette record, and return its result tuple and the manifest
+    entry of the saved listing file (or None). The entry is also added to the manifest, if given."""
+    if 'listing' not in record:
+        service, region, operation, profile = record['query'][:4]
+        parameters = record['query'][4] if len(record['query']) > 4 else None
+        result_type = get_error_result_type(service, operation, record['error'])
+        detail = ' '.join(filter(None, (get_description(parameters), record['repr'])))
+        return (result_type, service, region, operation, profile, detail), None
+    listing = RecordedListing.from_json(record['listing'])
+    description = get_description(listing.parameters)
+    try:
+        result = save_listing(listing, description)
+    except Exception as exc:  # pylint:disable=broad-except
+        if verbose > 2:
+            print_exc()
+        result_type = get_error_result_type(listing.service, listing.operation, str(exc))
+        detail = ' '.join(filter(None, (description, repr(exc))))
+        result = (result_type, listing.service, listing.region, listing.operation, listing.profile, detail)
+    entry = None
+    if result[0] == RESULT_SOMETHING:
+        listing_filename = get_listing_filename(*result[1:5], parameters=listing.parameters)
+        entry = get_manifest_entry(listing_filename, listing)
+        if manifest is not None:
+            manifest.add_entry(entry)
+    return result, entry
+
+
+def reprocess_cassette_file(verbose, cassette_filename):
+    """Derive and save the listings of all records in the given cassette file, and return a list of their
+    result tuples and the manifest entries of the saved listing files"""
+    return [process_record(verbose, record) for record in read_cassette_file(cassette_filename)]
+
+
+def do_reprocess(cassette_directory, verbose=0, parallel=None):
+    """Derive and save the listings of a recorded run from its cassette without making any AWS requests,
+    processing the files of the cassette in parallel processes (default: one per CPU)"""
+    results_by_type = defaultdict(list)
+    manifest = ListingManifest()
+    with ProcessPoolExecutor(parallel or os.cpu_count() or 1) as executor:
+        cassette_filenames = get_cassette_filenames(cassette_directory)
+        for results in executor.map(partial(reprocess_cassette_file, verbose), cassette_filenames):
+            for result, entry in results:
+                if entry is not None:
+                    manifest.add_entry(entry)
+                results_by_type[result[0]].append(result)
+                if verbose > 1:
+                    print('ReprocessedResult: {}'.format(result))
+    manifest.close()
+    print_results(results_by_type)
+
+
+def print_results(results_by_type):
+    """Print the given results, sorted by result type"""
+    for result_type in (RESULT_NOTHING, RESULT_SOMETHING, RESULT_NO_ACCESS, RESULT_ERROR):
+        for result in sorted(results_by_type[result_type]):
+            print(*result)
+
+
+def format_listing_file(listing_filename, verbose=0):
+    """Return the lines of a rudimentary summary of the Listing object contained in the given file"""
+    listing = Listing.from_json(load_listing_file(listing_filename))
+    lines = []
+    resources = listing.resources
+    truncated = False
+    if 'truncated' in resources:
+        truncated = resources['truncated']
+        del resources['truncated']
+    for resource_type, value in resources.items():
+        len_string = '> {}'.format(len(value)) if truncated else str(len(value))
+        lines.append(
+            ' '.join(map(str, (listing.service, listing.region, listing.operation, resource_type, len_string)))
+        )
+        if verbose > 0:
+            idkey = listing.identifier_key(resource_type, value)
+            for item in value:
+                if idkey and isinstance(item, dict):
+                    lines.append('    -  {}'.format(item.get(idkey, ', '.join(item.keys()))))
+                else:
+                    lines.append('    -  {}'.format(item))
+            if truncated:
+                lines.append('    - ... (more items, query truncated)')
+    return lines
+
+
+def format_manifest_entry(entry):
+    """Return the summary lines of a listing file from its entry in a run manifest"""
+    return [
+        ' '.join(
+            map(
+                str, (
+                    entry['service'], entry['region'], entry['operation'], resource_type,
+                    '> {}'.format(count) if entry['truncated'] else str(count)
+                )
+            )
+        ) for resource_type, count in entry['counts'].items()
+    ]
+
+
+def do_list_files(filenames, verbose=0, parallel=None, summary_only=False):
+    """Print out a rudimentary summary of the Listing objects contained in the given files, in the given order.
+
+    Files are parsed in a pool of parallel processes (default: one per CPU) with a bounded number of files in flight.
+    With summary_only, the resource counts are taken from the run manifests next to the files where possible, i.e. for
+    files that were not modified since their manifest entry was written (watch and serve do not keep a manifest)."""
+    filenames = [filename for filename in filenames if os.path.basename(filename) != MANIFEST_FILENAME]
+    manifests = {}
+    if summary_only:
+        for directory in set(os.path.dirname(filename) for filename in filenames):
+            manifests[directory] = read_manifest(directory or '.')
+
+    def lines_from_manifest(filename):
+        entry = manifests.get(os.path.dirname(filename), {}).get(os.path.basename(filename))
+        if entry and entry.get('mtime') is not None and entry['mtime'] == get_listing_mtime(filename):
+            return entry
+        return None
+
+    parallel = parallel or os.cpu_count() or 1
+    if parallel == 1:
+        for filename in filenames:
+            entry = lines_from_manifest(filename)
+            for line in format_manifest_entry(entry) if entry else format_listing_file(filename, verbose):
+                print(line)
+        return
+
+    with ProcessPoolExecutor(parallel) as executor:
+        in_flight = deque()
+        for filename in filenames + [None]:
+            if filename is not None:
+                entry = lines_from_manifest(filename)
+                if entry:
+                    in_flight.append(format_manifest_entry(entry))
+                else:
+                    in_flight.append(executor.submit(format_listing_file, filename, verbose))
+            # Print finished results in order, and wait for the oldest file when too many are in flight
+            while in_flight and (
+                filename is None or len(in_flight) > 4 * parallel or not isinstance(in_flight[0], Future)
+                or in_flight[0].done()
+            ):
+                lines = in_flight.popleft()
+                for line in lines.result() if isinstance(lines, Future) else lines:
+                    print(line)
@@ -0,0 +1,66 @@
+from __future__ import print_function
+
+import gzip
+import json
+import os
+from threading import Lock
+from zlib import crc32
+
+from .codec import encode_default
+from .listing import Listing
+
+# Number of files a cassette is split into, which is also the number of processes that can reprocess it in parallel
+CASSETTE_SHARDS = 16
+
+
+class RecordedListing(Listing):
+    """A listing from a cassette, which never makes AWS requests for missing auxiliary responses"""
+
+    def auxiliary_response(self, operation):
+        if operation not in self.auxiliary_responses:
+            raise Exception('No recorded response of auxiliary operation', operation)
+        return self.auxiliary_responses[operation]
+
+
+class Recorder(object):
+    """Records the raw responses of all queries of a run (or their errors) to a cassette directory of
+    gzipped JSON lines files, so that the run can be reprocessed without making any AWS requests"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self._shards = [(Lock(), gzip.open(os.path.join(directory, 'cassette-{:02}.jsonl.gz'.format(shard)), 'wt'))
+                        for shard in range(CASSETTE_SHARDS)]
+
+    def _write(self, what, record):
+        service, region = what[:2]
+        lock, shard_file = self._shards[crc32('{} {}'.format(service, region).encode('utf-8')) % CASSETTE_SHARDS]
+        line = json.dumps(record, default=encode_default) + '\n'
+        with lock:
+            shard_file.write(line)
+
+    def add(self, listing):
+        """Record the raw response and auxiliary responses of the given listing"""
+        self._write((listing.service, listing.region), {'listing': listing.to_json()})
+
+    def add_error(self, what, exc):
+        """Record the failure of the given query"""
+        self._write(what, {'query': list(what), 'error': str(exc), 'repr': repr(exc)})
+
+    def close(self):
+        for _, shard_file in self._shards:
+            shard_file.close()
+
+
+def get_cassette_filenames(directory):
+    """Return the names of the files of the cassette in the given directory"""
+    return sorted(
+        os.path.join(directory, filename) for filename in os.listdir(directory)
+        if filename.startswith('cassette-') and filename.endswith('.jsonl.gz')
+    )
+
+
+def read_cassette_file(filename):
+    """Yield the records of the given cassette file"""
+    with gzip.open(filename, 'rt') as cassette_file:
+        for line in cassette_file:
+            yield json.loads(line)
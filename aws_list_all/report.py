@@ -0,0 +1,152 @@
+from __future__ import print_function
+
+import csv
+import heapq
+import json
+import os
+from collections import Counter
+from threading import Lock
+from time import time
+
+REPORT_FIELDS = ['result', 'classification', 'service', 'region', 'operation', 'profile', 'detail', 'duration', 'time']
+
+# Number of slowest queries to show in the summary
+SLOWEST_QUERIES = 10
+
+
+class RunReport(object):
+    """Writes a record for every query result to a JSONL or CSV run report as the results arrive,
+    and keeps only constant-size aggregates of the results for the final summary"""
+
+    def __init__(self, filename, classifications):
+        self.classifications = classifications
+        self.counts = Counter()
+        self.total_duration = 0.0
+        self.slowest = []
+        self.start_time = time()
+        self._file = open(filename, 'w', newline='') if filename.endswith('.csv') else open(filename, 'w')
+        if filename.endswith('.csv'):
+            self._writer = csv.DictWriter(self._file, REPORT_FIELDS)
+            self._writer.writeheader()
+            self._write = self._writer.writerow
+        else:
+            self._write = lambda record: self._file.write(json.dumps(record) + '\n')
+
+    def add(self, result, duration):
+        """Write the given result tuple and its duration to the report and add it to the aggregates"""
+        result_type, service, region, operation, profile, detail = result
+        self._write({
+            'result': result_type,
+            'classification': self.classifications[result_type],
+            'service': service,
+            'region': region,
+            'operation': operation,
+            'profile': profile,
+            'detail': detail,
+            'duration': round(duration, 3),
+            'time': round(time(), 3),
+        })
+        self.counts[result_type] += 1
+        self.total_duration += duration
+        item = (duration, service, region or 'n/a', operation)
+        if len(self.slowest) < SLOWEST_QUERIES:
+            heapq.heappush(self.slowest, item)
+        else:
+            heapq.heappushpop(self.slowest, item)
+
+    def close(self):
+        self._file.close()
+
+    def print_summary(self):
+        """Print the summary of all results from the aggregates"""
+        print(
+            '{} queries in {:.1f}s ({:.1f}s of query time)'.format(
+                sum(self.counts.values()),
+                time() - self.start_time, self.total_duration
+            )
+        )
+        for result_type, classification in self.classifications.items():
+            print(result_type, self.counts[result_type], classification)
+        print('Slowest queries:')
+        for duration, service, region, operation in sorted(self.slowest, reverse=True):
+            print('  {:.1f}s {} {} {}'.format(duration, service, region, operation))
+
+
+# Name of the manifest of listing files that is written next to them by every query run
+MANIFEST_FILENAME = 'aws_list_all_manifest.jsonl'
+
+
+class ListingManifest(object):
+    """Appends an entry with the resource counts of every written listing file to the run manifest,
+    so that summaries of large runs can be shown without parsing every listing file again. Entries are appended
+    as files are written, so that an interrupted run leaves no outdated entries, and the manifest is compacted
+    to the latest entry of every file when the run is done."""
+
+    def __init__(self, directory='.'):
+        self.directory = directory
+        self._lock = Lock()
+        self._file = open(os.path.join(directory, MANIFEST_FILENAME), 'a')
+
+    def add(self, filename, listing):
+        """Append the entry for the given listing file"""
+        self.add_entry(get_manifest_entry(filename, listing))
+
+    def add_entry(self, entry):
+        with self._lock:
+            self._file.write(json.dumps(entry) + '\n')
+            self._file.flush()
+
+    def close(self):
+        """Close the manifest and replace it with a fresh one that has only the latest entry of every file"""
+        with self._lock:
+            self._file.close()
+        entries = read_manifest(self.directory)
+        filename = os.path.join(self.directory, MANIFEST_FILENAME)
+        with open(filename + '.tmp', 'w') as manifest_file:
+            for entry in entries.values():
+                manifest_file.write(json.dumps(entry) + '\n')
+        os.replace(filename + '.tmp', filename)
+
+
+def get_listing_mtime(filename):
+    """Return the modification time of the given listing file, or None if it does not exist"""
+    try:
+        return os.path.getmtime(filename)
+    except OSError:
+        return None
+
+
+def get_manifest_entry(filename, listing):
+    """Return the manifest entry with the resource counts of the given listing file. The entry records the
+    modification time of the file, so that entries of files written again without the manifest can be told apart."""
+    resources = listing.resources
+    return {
+        'filename': os.path.basename(filename),
+        'service': listing.service,
+        'region': listing.region,
+        'operation': listing.operation,
+        'profile': listing.profile,
+        'counts': {
+            key: len(value)
+            for key, value in resources.items() if key != 'truncated'
+        },
+        'truncated': bool(resources.get('truncated', False)),
+        'mtime': get_listing_mtime(filename),
+    }
+
+
+def read_manifest(directory='.'):
+    """Return a dict of listing file names to their latest manifest entries in the given directory"""
+    entries = {}
+    try:
+        with open(os.path.join(directory, MANIFEST_FILENAME)) as manifest_file:
+            for line in manifest_file:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Skip a partially written last line of an interrupted run
+                    continue
+                entries[entry['filename']] = entry
+    except IOError:
+        pass
+    return entries
@@ -0,0 +1,218 @@
+from __future__ import print_function
+
+import heapq
+import math
+from collections import defaultdict
+from random import shuffle
+
+from app_json_file_cache.data_cache import DataCache
+
+from .listing import get_auxiliary_operations
+
+duration_cache = DataCache('aws_list_all', 'query_durations')
+
+# Weight of the newest measurement when merging it into the recorded duration of a query
+DURATION_SMOOTHING = 0.5
+
+# Queries within a factor of this of each other are considered equally long and spread across endpoints
+DURATION_BUCKET_FACTOR = 2.0
+
+# Number of queries of one endpoint executed in sequence by one worker with the locality schedule
+LOCALITY_BATCH_SIZE = 4
+
+# Seconds after which AWS endpoints close idle connections, and the estimated duration of a TLS handshake,
+# for simulating the connection reuse of schedules
+CONNECTION_IDLE_TIMEOUT = 20.0
+HANDSHAKE_DURATION = 0.1
+
+
+def get_recorded_durations(profile=None):
+    """Return a dict of (service, region, operation) to the recorded duration of that query in seconds"""
+    try:
+        recorded = duration_cache.get({}).get(profile or '', {})
+    except KeyError:
+        return {}
+    return {(service, region or None, operation): duration
+            for service, regions in recorded.items()
+            for region, operations in regions.items()
+            for operation, duration in operations.items()}
+
+
+def record_durations(durations, profile=None):
+    """Merge a dict of (service, region, operation) to measured durations into the recorded durations"""
+    try:
+        recorded = duration_cache.get({})
+    except KeyError:
+        recorded = {}
+    profile_recorded = recorded.setdefault(profile or '', {})
+    for (service, region, operation), duration in durations.items():
+        operations = profile_recorded.setdefault(service, {}).setdefault(region or '', {})
+        if operation in operations:
+            duration = DURATION_SMOOTHING * duration + (1 - DURATION_SMOOTHING) * operations[operation]
+        operations[operation] = duration
+    duration_cache.store({}, recorded)
+
+
+def estimate_durations(to_run, durations):
+    """Return the estimated duration of each query, using the mean recorded duration for unknown queries"""
+    known = [durations[tuple(query[:3])] for query in to_run if tuple(query[:3]) in durations]
+    default = sum(known) / len(known) if known else 1.0
+    return [durations.get(tuple(query[:3]), default) for query in to_run]
+
+
+def order_random(to_run, durations=None):
+    """Return the queries in random order"""
+    ordered = list(to_run)
+    shuffle(ordered)
+    return ordered
+
+
+def order_longest_first(to_run, durations):
+    """Return the queries ordered longest-processing-time-first by their recorded durations.
+
+    Queries of similar duration are interleaved across endpoints, so that no endpoint is hit by many
+    queries in close succession."""
+    buckets = defaultdict(lambda: defaultdict(list))
+    for query, duration in zip(to_run, estimate_durations(to_run, durations)):
+        bucket = math.floor(math.log(max(duration, 1e-3), DURATION_BUCKET_FACTOR))
+        buckets[bucket][tuple(query[:2])].append((duration, query))
+
+    ordered = []
+    for bucket in sorted(buckets, reverse=True):
+        endpoint_queues = list(buckets[bucket].values())
+        shuffle(endpoint_queues)
+        for queue in endpoint_queues:
+            queue.sort(key=lambda item: item[0])
+        # Round-robin across endpoints, longest queries of each endpoint first
+        while endpoint_queues:
+            for queue in endpoint_queues:
+                ordered.append(queue.pop()[1])
+            endpoint_queues = [queue for queue in endpoint_queues if queue]
+    return ordered
+
+
+def get_endpoint(query):
+    """Return the endpoint of a query, which has its own client and connection pool"""
+    return query[0], query[1], query[3]
+
+
+def order_endpoint_batches(to_run, durations, batch_size=LOCALITY_BATCH_SIZE):
+    """Return the queries grouped into consecutive batches of up to batch_size queries of the same endpoint,
+    which are executed in sequence on one warm connection. The batches are interleaved across endpoints,
+    so that every endpoint gets at most one batch per round, with the endpoints with the longest queries first."""
+    endpoint_queues = defaultdict(list)
+    for query, duration in zip(to_run, estimate_durations(to_run, durations)):
+        endpoint_queues[get_endpoint(query)].append((duration, query))
+    queues = []
+    for queue in endpoint_queues.values():
+        queue.sort(key=lambda item: item[0], reverse=True)
+        queues.append([[query for _, query in queue[i:i + batch_size]] for i in range(0, len(queue), batch_size)])
+    queues.sort(key=lambda batches: sum(estimate_durations(sum(batches, []), durations)), reverse=True)
+
+    ordered = []
+    depth = 0
+    while any(depth < len(batches) for batches in queues):
+        for batches in queues:
+            if depth < len(batches):
+                ordered.extend(batches[depth])
+        depth += 1
+    return ordered
+
+
+def get_batches(ordered, batch_size):
+    """Split the ordered queries into batches of up to batch_size consecutive queries of the same endpoint"""
+    batches = []
+    for query in ordered:
+        if batches and len(batches[-1]) < batch_size and get_endpoint(batches[-1][0]) == get_endpoint(query):
+            batches[-1].append(query)
+        else:
+            batches.append([query])
+    return batches
+
+
+def order_dependencies_first(to_run):
+    """Return the queries in the given order, but with queries whose responses are needed by other queries
+    moved in front of their first dependent query, so they are always started first."""
+    planned = set(tuple(query) for query in to_run)
+    moved = set()
+    ordered = []
+    for query in to_run:
+        service, region, operation, profile = query
+        if tuple(query) in moved:
+            continue
+        for auxiliary_operation in get_auxiliary_operations(service, operation):
+            auxiliary_query = (service, region, auxiliary_operation, profile)
+            if auxiliary_query in planned and auxiliary_query not in moved:
+                ordered.append(list(auxiliary_query))
+                moved.add(auxiliary_query)
+        ordered.append(query)
+        moved.add(tuple(query))
+    return ordered
+
+
+SCHEDULES = {
+    'random': order_random,
+    'longest-first': order_longest_first,
+    'locality': order_endpoint_batches,
+}
+
+# Number of consecutive queries of the same endpoint that are executed in sequence by one worker, per schedule
+SCHEDULE_BATCH_SIZES = {
+    'locality': LOCALITY_BATCH_SIZE,
+}
+
+
+def simulate_connections(batches, estimates, parallel):
+    """Return the time until all queries are done and the number of TLS handshakes if workers take the given
+    batches of queries in order and execute the queries of each batch in sequence. A request reuses an idle
+    connection to its endpoint unless the endpoint closed it after CONNECTION_IDLE_TIMEOUT seconds."""
+    workers = [0.0] * max(parallel, 1)
+    idle_connections = defaultdict(list)
+    handshakes = 0
+    makespan = 0.0
+    for batch in batches:
+        start = heapq.heappop(workers)
+        now = start
+        for query in batch:
+            idle = idle_connections[get_endpoint(query)]
+            # Connections are idle from the end of their last request, which may be later than now
+            reusable = [since for since in idle if since <= now and now - since <= CONNECTION_IDLE_TIMEOUT]
+            if reusable:
+                idle.remove(max(reusable))
+            else:
+                handshakes += 1
+                now += HANDSHAKE_DURATION
+            now += estimates[tuple(query)]
+            idle.append(now)
+        heapq.heappush(workers, now)
+        makespan = max(makespan, now)
+    return makespan, handshakes
+
+
+def simulate_schedules(to_run, durations, parallel, repetitions=20):
+    """Print the expected makespan of each schedule, based on the recorded durations"""
+    known = sum(1 for query in to_run if tuple(query[:3]) in durations)
+    print('Simulating {} queries with {} workers ({} with recorded durations)...'.format(len(to_run), parallel, known))
+    estimates = dict(zip(map(tuple, to_run), estimate_durations(to_run, durations)))
+    print(
+        'Sum of query durations: {:.1f}s, longest query: {:.1f}s'.format(
+            sum(estimates.values()),
+            max(estimates.values()) if estimates else 0.0
+        )
+    )
+    for name, order in sorted(SCHEDULES.items()):
+        batch_size = SCHEDULE_BATCH_SIZES.get(name, 1)
+        makespans = []
+        handshakes = []
+        for _ in range(repetitions):
+            batches = get_batches(order(to_run, durations), batch_size)
+            makespan, schedule_handshakes = simulate_connections(batches, estimates, parallel)
+            makespans.append(makespan)
+            handshakes.append(schedule_handshakes)
+        print(
+            '{: <14} expected makespan {:.1f}s (best {:.1f}s, worst {:.1f}s), {:.2f} handshakes per request'.format(
+                name,
+                sum(makespans) / len(makespans), min(makespans), max(makespans),
+                sum(handshakes) / len(handshakes) / max(len(to_run), 1)
+            )
+        )
@@ -0,0 +1,134 @@
+from __future__ import print_function
+
+import json
+import os
+import socket
+import sys
+from concurrent.futures import Future
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import TCPServer
+from threading import Lock
+from time import time
+from urllib.parse import parse_qs, urlparse
+
+from .introspection import get_services, update_observed_availability
+from .query import (
+    RESULT_CLASSIFICATIONS, AvailabilityEvidence, SharedResponses, acquire_listing, execute_queries, plan_queries
+)
+from .report import REPORT_FIELDS
+from .schedule import get_recorded_durations, order_dependencies_first, order_longest_first, record_durations
+
+# Seconds after which a cached query plan is made again, e.g. to take newly observed service availability into account
+PLAN_TTL = 3600
+
+
+class UnixHTTPServer(ThreadingHTTPServer):
+    """An HTTP server listening on a Unix domain socket"""
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 0
+
+
+class ScanServer(object):
+    """Executes scan requests within one long-running process, so that boto3 clients, service models,
+    query plans and caches stay loaded between scans"""
+
+    def __init__(self, parallel=32, profile=None, verbose=0, plan_ttl=PLAN_TTL):
+        self.parallel = parallel
+        self.profile = profile
+        self.verbose = verbose
+        self.plan_ttl = plan_ttl
+        self._plans = {}
+        self._lock = Lock()
+
+    def get_plan(self, services, regions, operations, now=None):
+        """Return the (cached) queries of a scan. Plans are made outside of the lock, so that scans with other
+        plans are not blocked, and concurrent requests for the same plan wait for the one that makes it."""
+        key = (tuple(services), tuple(regions), tuple(operations))
+        now = time() if now is None else now
+        with self._lock:
+            expires, future = self._plans.get(key, (0, None))
+            planning = future is None or expires <= now
+            if planning:
+                future = Future()
+                self._plans[key] = (now + self.plan_ttl, future)
+        if planning:
+            try:
+                future.set_result(plan_queries(services, regions, operations, 0, self.profile, True))
+            except Exception as exc:  # pylint:disable=broad-except
+                # Failed plans are not cached
+                with self._lock:
+                    if self._plans.get(key, (0, None))[1] is future:
+                        del self._plans[key]
+                future.set_exception(exc)
+        return [list(query) for query in future.result()]
+
+    def scan(self, to_run, operations=()):
+        """Execute the queries of a scan and yield the result and duration of each query as it completes"""
+        to_run = order_dependencies_first(order_longest_first(to_run, get_recorded_durations(self.profile)))
+        evidence = AvailabilityEvidence()
+        durations = {}
+        run = partial(acquire_listing, self.verbose, evidence=evidence, shared_responses=SharedResponses(to_run))
+        # Clients stay cached between scans, only capped by the size of the client cache
+        for result, duration in execute_queries(to_run, run, self.parallel, evict_done=False):
+            durations[tuple(result[1:4])] = duration
+            yield result, duration
+        with self._lock:
+            update_observed_availability(evidence.conclusions(include_unavailable=not operations), profile=self.profile)
+            record_durations(durations, profile=self.profile)
+
+
+class ScanRequestHandler(BaseHTTPRequestHandler):
+    """Handles GET /query?service=...&region=...&operation=... by streaming one JSON line per query result"""
+
+    def do_GET(self):  # pylint:disable=invalid-name
+        url = urlparse(self.path)
+        if url.path != '/query':
+            self.send_error(404, 'Use /query?service=...&region=...&operation=...')
+            return
+        arguments = parse_qs(url.query)
+        services = arguments.get('service') or get_services()
+        operations = arguments.get('operation', ())
+        try:
+            to_run = self.server.scans.get_plan(services, arguments.get('region', ()), operations)
+        except Exception as exc:  # pylint:disable=broad-except
+            self.send_error(400, 'Cannot plan scan: {}'.format(exc))
+            return
+        # Results are streamed, so the response ends when the connection is closed
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        for result, duration in self.server.scans.scan(to_run, operations):
+            record = dict(zip(REPORT_FIELDS, result[:1] + (RESULT_CLASSIFICATIONS[result[0]], ) + result[1:]))
+            record['duration'] = round(duration, 3)
+            self.wfile.write((json.dumps(record) + '\n').encode('utf-8'))
+            self.wfile.flush()
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        if self.server.scans.verbose > 0:
+            sys.stderr.write('{}\n'.format(format % args))
+
+
+def do_serve(host='127.0.0.1', port=8080, socket_path=None, parallel=32, profile=None, verbose=0):
+    """Serve scan requests over HTTP on the given local port or Unix socket until interrupted"""
+    if socket_path:
+        server = UnixHTTPServer(socket_path, ScanRequestHandler)
+        print('Serving scan requests on unix socket {}'.format(socket_path))
+    else:
+        server = ThreadingHTTPServer((host, port), ScanRequestHandler)
+        print('Serving scan requests on http://{}:{}/query'.format(host, port))
+    server.scans = ScanServer(parallel, profile, verbose)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path:
+            os.unlink(socket_path)
@@ -0,0 +1,95 @@
+from __future__ import print_function
+
+import gzip
+import json
+import os
+from datetime import datetime, timezone
+from hashlib import sha256
+from tempfile import NamedTemporaryFile
+from threading import Lock
+
+from .codec import encode_default
+
+
+def normalize_listing(listing):
+    """Return the canonical JSON representation of the resources of a listing, without volatile response metadata"""
+    resources = listing.resources
+    return json.dumps({
+        'service': listing.service,
+        'region': listing.region,
+        'operation': listing.operation,
+        'profile': listing.profile,
+        'parameters': listing.parameters,
+        'resources': resources,
+    },
+                      sort_keys=True,
+                      default=encode_default).encode('utf-8')
+
+
+class SnapshotStore(object):
+    """A content-addressed store of normalized listings, where every distinct listing is written only once.
+
+    Each run is recorded as a manifest of listing file names to the hashes of their content, so that a listing
+    is known to be unchanged since the previous run by its hash alone."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.objects_directory = os.path.join(directory, 'objects')
+        self.runs_directory = os.path.join(directory, 'runs')
+        for path in (self.objects_directory, self.runs_directory):
+            os.makedirs(path, exist_ok=True)
+        runs = self.get_runs()
+        self.previous = self.load_run(runs[-1]) if runs else {}
+        self.listings = {}
+        self.written = 0
+        self._lock = Lock()
+
+    def object_filename(self, digest):
+        return os.path.join(self.objects_directory, digest[:2], digest[2:] + '.json.gz')
+
+    def add(self, listing_filename, listing):
+        """Store the listing saved to the given file name if its content is not stored yet, and return its hash"""
+        content = normalize_listing(listing)
+        digest = sha256(content).hexdigest()
+        object_filename = self.object_filename(digest)
+        written = False
+        if not os.path.exists(object_filename):
+            object_directory = os.path.dirname(object_filename)
+            os.makedirs(object_directory, exist_ok=True)
+            # Write to a temporary file first, so that objects are never seen partially written
+            with NamedTemporaryFile(dir=object_directory, delete=False) as object_file:
+                with gzip.GzipFile(fileobj=object_file, mode='wb', mtime=0) as compressed:
+                    compressed.write(content)
+            os.replace(object_file.name, object_filename)
+            written = True
+        with self._lock:
+            self.listings[os.path.basename(listing_filename)] = digest
+            self.written += written
+        return digest
+
+    def load(self, digest):
+        """Return the normalized listing with the given hash"""
+        with gzip.open(self.object_filename(digest), 'rb') as object_file:
+            return json.loads(object_file.read().decode('utf-8'))
+
+    def get_runs(self):
+        """Return the names of all recorded runs, oldest first"""
+        return sorted(filename[:-len('.json')] for filename in os.listdir(self.runs_directory))
+
+    def load_run(self, run):
+        """Return the dict of listing file names to hashes of the given run"""
+        with open(os.path.join(self.runs_directory, run + '.json')) as run_file:
+            return json.load(run_file)['listings']
+
+    def close(self):
+        """Record the manifest of this run and print how many listings changed since the previous run"""
+        run = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%fZ')
+        with open(os.path.join(self.runs_directory, run + '.json'), 'w') as run_file:
+            json.dump({'listings': self.listings}, run_file, sort_keys=True)
+        unchanged = sum(1 for filename, digest in self.listings.items() if self.previous.get(filename) == digest)
+        print(
+            'Snapshot {}: {} listings, {} unchanged since the previous run, {} new objects stored'.format(
+                run, len(self.listings), unchanged, self.written
+            )
+        )
+        return run
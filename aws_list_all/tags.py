@@ -0,0 +1,59 @@
+from __future__ import print_function
+
+from threading import Lock
+
+from .client import get_client
+from .listing import get_arn
+
+# The Resource Groups Tagging API returns the tags of global resources, e.g. IAM roles, in this region
+GLOBAL_TAGS_REGION = 'us-east-1'
+
+
+def get_tag_mapping(region, profile=None):
+    """Return a dict of the ARNs of all tagged resources in the given region to dicts of their tags,
+    paging through the Resource Groups Tagging API"""
+    client = get_client('resourcegroupstaggingapi', region, profile)
+    tags_by_arn = {}
+    for page in client.get_paginator('get_resources').paginate(ResourcesPerPage=100):
+        for mapping in page['ResourceTagMappingList']:
+            tags_by_arn[mapping['ResourceARN']] = {tag['Key']: tag['Value'] for tag in mapping.get('Tags', [])}
+    return tags_by_arn
+
+
+class TagIndex(object):
+    """ARN to tags indexes of every (profile, region), each built with bulk GetResources requests the first time
+    a listing of the region is enriched, and shared by all listings of the run"""
+
+    def __init__(self, get_mapping=get_tag_mapping):
+        self._get_mapping = get_mapping
+        self._indexes = {}
+        self._locks = {}
+        self._lock = Lock()
+
+    def get(self, region, profile=None):
+        """Return the ARN to tags index of the given region and profile"""
+        key = (profile, region)
+        with self._lock:
+            lock = self._locks.setdefault(key, Lock())
+        with lock:
+            if key not in self._indexes:
+                try:
+                    self._indexes[key] = self._get_mapping(region, profile)
+                except Exception as exc:  # pylint:disable=broad-except
+                    # Listings of the region are saved without tags rather than failing
+                    print('Cannot get tags in {}: {!r}'.format(region, exc))
+                    self._indexes[key] = {}
+            return self._indexes[key]
+
+    def enrich(self, listing):
+        """Attach the tags of the resources of the given listing to it, so that they are joined onto its resources"""
+        index = self.get(listing.region or GLOBAL_TAGS_REGION, listing.profile)
+        if not index:
+            return
+        tags = {}
+        for resource_type, resources in listing.resources.items():
+            for item in resources:
+                arn = get_arn(resource_type, item)
+                if arn in index:
+                    tags[arn] = index[arn]
+        listing.tags = tags
@@ -0,0 +1,153 @@
+import gzip
+import json
+
+from . import changes
+from .changes import get_resource_noun, plan_changed_queries, read_log_directory, record_scan, select_changed_queries
+
+TO_RUN = [
+    ['ec2', 'eu-west-1', 'DescribeInstances', None],
+    ['ec2', 'eu-west-1', 'DescribeSecurityGroups', None],
+    ['ec2', 'eu-west-2', 'DescribeInstances', None],
+    ['ec2', 'eu-west-2', 'DescribeSecurityGroups', None],
+    ['iam', None, 'ListRoles', None],
+    ['iam', None, 'ListUsers', None],
+]
+
+
+def get_last_scans(last_scan):
+    last_scans = {}
+    for service, region in set((query[0], query[1]) for query in TO_RUN):
+        last_scans.setdefault(service, {})[region or ''] = {'scan': last_scan, 'full_sweep': last_scan}
+    return last_scans
+
+
+def test_get_resource_noun():
+    assert get_resource_noun('RunInstances') == 'instance'
+    assert get_resource_noun('DescribeInstances') == 'instance'
+    assert get_resource_noun('ListPolicies') == 'policy'
+    assert get_resource_noun('DescribeAddresses') == get_resource_noun('AllocateAddress') == 'address'
+
+
+def test_select_changed_queries():
+    events = [
+        ('ec2', 'eu-west-1', 'AuthorizeSecurityGroupIngress'),
+        ('ec2', 'eu-west-2', 'CreateTags'),
+        ('iam', 'us-east-1', 'CreateRole'),
+    ]
+    assert select_changed_queries(TO_RUN, events) == [
+        ['ec2', 'eu-west-1', 'DescribeSecurityGroups', None],
+        # No listing matches tags, so all listings of the service in the region are affected
+        ['ec2', 'eu-west-2', 'DescribeInstances', None],
+        ['ec2', 'eu-west-2', 'DescribeSecurityGroups', None],
+        ['iam', None, 'ListRoles', None],
+    ]
+
+
+def test_select_changed_queries_of_side_effects():
+    to_run = [
+        ['ec2', 'eu-west-1', 'DescribeInstances', None],
+        ['ec2', 'eu-west-1', 'DescribeNetworkInterfaces', None],
+        ['ec2', 'eu-west-1', 'DescribeReservedInstances', None],
+        ['ec2', 'eu-west-1', 'DescribeSnapshots', None],
+        ['ec2', 'eu-west-1', 'DescribeVolumes', None],
+        ['organizations', 'eu-west-1', 'ListAccounts', None],
+    ]
+    events = [
+        ('ec2', 'eu-west-1', 'RunInstances'),
+        ('organizations', 'us-east-1', 'CreateAccount'),
+    ]
+    # Reserved instances are not launched instances
+    assert select_changed_queries(to_run, events, global_services={'organizations'}) == [
+        ['ec2', 'eu-west-1', 'DescribeInstances', None],
+        ['ec2', 'eu-west-1', 'DescribeNetworkInterfaces', None],
+        ['ec2', 'eu-west-1', 'DescribeVolumes', None],
+        ['organizations', 'eu-west-1', 'ListAccounts', None],
+    ]
+    assert select_changed_queries(to_run, [('ec2', 'eu-west-1', 'CreateImage')]) == [
+        ['ec2', 'eu-west-1', 'DescribeSnapshots', None],
+    ]
+
+
+def test_plan_changed_queries(tmpdir, monkeypatch):
+    records = [
+        {
+            'eventTime': '2020-01-01T11:50:00Z',
+            'eventSource': 'ec2.amazonaws.com',
+            'eventName': 'RunInstances',
+            'awsRegion': 'eu-west-1',
+            'readOnly': False
+        },
+        {
+            'eventTime': '2020-01-01T12:00:00Z',
+            'eventSource': 'ec2.amazonaws.com',
+            'eventName': 'DescribeInstances',
+            'awsRegion': 'eu-west-2',
+            'readOnly': True
+        },
+        {
+            'eventTime': '2019-12-31T00:00:00Z',
+            'eventSource': 'iam.amazonaws.com',
+            'eventName': 'CreateRole',
+            'awsRegion': 'us-east-1'
+        },
+    ]
+    with gzip.open(str(tmpdir.join('log.json.gz')), 'wt') as log_file:
+        json.dump({'Records': records}, log_file)
+    last_scan = 1577880000  # 2020-01-01T12:00:00Z
+    events = list(read_log_directory(str(tmpdir), last_scan - 3600))
+    assert events == [('ec2', 'eu-west-1', 'RunInstances', last_scan - 600)]
+
+    monkeypatch.setattr(changes, 'get_last_scans', lambda profile: get_last_scans(last_scan))
+    to_run, scopes = plan_changed_queries(TO_RUN, cloudtrail_directory=str(tmpdir), now=last_scan + 600)
+    assert to_run == [['ec2', 'eu-west-1', 'DescribeInstances', None]]
+    assert not any(scopes.values())
+    to_run, scopes = plan_changed_queries(TO_RUN, cloudtrail_directory=str(tmpdir), now=last_scan + 2 * 86400)
+    assert to_run == TO_RUN
+    assert scopes == {('ec2', 'eu-west-1'): True, ('ec2', 'eu-west-2'): True, ('iam', None): True}
+
+
+def test_plan_changed_queries_of_global_services(monkeypatch):
+    looked_up = []
+
+    def lookup_events(region, since, profile=None):
+        looked_up.append(region)
+        if region == 'us-east-1':
+            yield ('iam', region, 'CreateRole', 1577880300)
+
+    monkeypatch.setattr(changes, 'lookup_events', lookup_events)
+    monkeypatch.setattr(changes, 'get_last_scans', lambda profile: get_last_scans(1577880000))
+    to_run, scopes = plan_changed_queries(TO_RUN, now=1577880600)
+    # Events of global services are read from us-east-1, even if no other query is in that region
+    assert looked_up == ['eu-west-1', 'eu-west-2', 'us-east-1']
+    assert to_run == [['iam', None, 'ListRoles', None]]
+
+
+class FakeCache(object):
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data
+
+    def store(self, key, data):
+        self.data = data
+
+
+def test_record_scan_of_scopes(tmpdir, monkeypatch):
+    monkeypatch.setattr(changes, 'last_scan_cache', FakeCache())
+    record_scan(1577880000, {('ec2', 'eu-west-1'): True, ('ec2', 'eu-west-2'): True, ('iam', None): True})
+    # A scan of ec2 in eu-west-1 neither advances the event window of the other scopes nor their full sweeps
+    record_scan(1577883600, {('ec2', 'eu-west-1'): False}, failed=[('ec2', 'eu-west-1', 'DescribeSecurityGroups')])
+    assert changes.get_last_scans()['ec2']['eu-west-2'] == {'scan': 1577880000, 'full_sweep': 1577880000, 'pending': []}
+    assert changes.get_last_scans()['ec2']['eu-west-1'] == {
+        'scan': 1577883600,
+        'full_sweep': 1577880000,
+        'pending': ['DescribeSecurityGroups']
+    }
+    # Failed queries are queried again, even without events
+    to_run, scopes = plan_changed_queries(TO_RUN, cloudtrail_directory=str(tmpdir), now=1577884000)
+    assert to_run == [['ec2', 'eu-west-1', 'DescribeSecurityGroups', None]]
+    assert scopes == {('ec2', 'eu-west-1'): False, ('ec2', 'eu-west-2'): False, ('iam', None): False}
+    record_scan(1577884000, scopes)
+    assert changes.get_last_scans()['ec2']['eu-west-1']['pending'] == []
@@ -0,0 +1,46 @@
+from . import client
+from .client import expect_work, finish_work, get_client, get_client_stats
+
+
+class FakeClient(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession(object):
+
+    def __init__(self, region_name=None, profile_name=None):
+        pass
+
+    def client(self, service):
+        return FakeClient()
+
+
+def test_client_eviction(monkeypatch):
+    monkeypatch.setattr(client.boto3, 'Session', FakeSession)
+    monkeypatch.setattr(client, 'MAX_CLIENTS', 2)
+    monkeypatch.setattr(client, '_CLIENTS', client.OrderedDict())
+    monkeypatch.setattr(client, '_REMAINING_WORK', {})
+    monkeypatch.setattr(client, '_DONE_WORK', set())
+    monkeypatch.setattr(client, '_CLIENT_STATS', {'created': 0, 'evicted_done': 0, 'evicted_lru': 0, 'max_cached': 0})
+    expect_work([['ec2', 'eu-west-1', 'DescribeVpcs', None], ['ec2', 'eu-west-1', 'DescribeSubnets', None]])
+    ec2 = get_client('ec2', 'eu-west-1')
+    assert get_client('ec2', 'eu-west-1') is ec2
+    finish_work('ec2', 'eu-west-1')
+    assert not ec2.closed
+    finish_work('ec2', 'eu-west-1')
+    assert ec2.closed
+    assert get_client('ec2', 'eu-west-1', unless_done=True) is None
+    assert get_client('ec2', 'eu-west-1') is not ec2
+
+    # Without registered work, the least recently used clients are dropped above the size cap
+    s3 = get_client('s3', 'eu-west-1')
+    get_client('ec2', 'eu-west-1')
+    get_client('sqs', 'eu-west-1')
+    assert get_client('s3', 'eu-west-1') is not s3
+    stats = get_client_stats()
+    assert (stats['created'], stats['evicted_done'], stats['evicted_lru'], stats['max_cached']) == (5, 1, 2, 2)
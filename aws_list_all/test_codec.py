@@ -0,0 +1,49 @@
+from datetime import datetime
+from decimal import Decimal
+from io import BytesIO
+
+from dateutil.tz import tzutc
+
+from .codec import CODECS, buffer_streams, encode_default, has_large_integer
+
+
+def test_encode_default():
+    assert encode_default(datetime(2020, 1, 2, tzinfo=tzutc())) == '2020-01-02T00:00:00+00:00'
+    assert encode_default(Decimal('3')) == 3
+    assert encode_default(Decimal('0.5')) == 0.5
+    assert encode_default(b'text') == 'text'
+    assert encode_default(b'\xff\x00') == '/wA='
+    assert encode_default(BytesIO(b'body')) == 'body'
+
+
+def test_codecs_round_trip(tmpdir):
+    data = {'response': {'Items': [{'Created': datetime(2020, 1, 2, 3, 4, 5, tzinfo=tzutc()), 'Size': Decimal(7)}]}}
+    expected = {'response': {'Items': [{'Created': '2020-01-02T03:04:05+00:00', 'Size': 7}]}}
+    for name, codec in CODECS.items():
+        filename = str(tmpdir.join(name + '.json'))
+        codec.dump(data, filename)
+        assert codec.load(filename) == expected
+
+
+def test_codecs_round_trip_large_integers(tmpdir):
+    data = {'response': {'Items': [{'Size': 2**70, 'Count': Decimal(2**64), 'Id': 'a'}]}}
+    for name, codec in CODECS.items():
+        filename = str(tmpdir.join(name + '.json'))
+        codec.dump(data, filename)
+        assert codec.load(filename) == {'response': {'Items': [{'Size': 2**70, 'Count': 2**64, 'Id': 'a'}]}}
+
+
+def test_has_large_integer():
+    assert not has_large_integer(b'{"Size": 9223372036854775807, "Min": -9223372036854775808}')
+    assert has_large_integer(b'{"Size": 9223372036854775808}')
+    assert has_large_integer(b'{"Size": 9999999999999999999}')
+    assert has_large_integer(b'{"Size": -9223372036854775809}')
+
+
+def test_codecs_round_trip_streams(tmpdir):
+    for name, codec in CODECS.items():
+        # The large integer makes orjson fall back to the standard library, which must still find the body
+        response = buffer_streams({'Body': BytesIO(b'body'), 'Size': 2**70})
+        filename = str(tmpdir.join(name + '.json'))
+        codec.dump({'response': response}, filename)
+        assert codec.load(filename) == {'response': {'Body': 'body', 'Size': 2**70}}
@@ -0,0 +1,28 @@
+import json
+
+from .diff import do_diff
+from .listing import Listing
+
+
+def write_listing(directory, region, repositories):
+    response = {'ResponseMetadata': {}, 'repositories': repositories}
+    listing = Listing('ecr', region, 'DescribeRepositories', response, None)
+    with open(str(directory.join('ecr_DescribeRepositories_{}_None.json'.format(region))), 'w') as jsonfile:
+        json.dump(listing.to_json(), jsonfile)
+
+
+def test_do_diff(tmpdir, capsys):
+    old, new = tmpdir.mkdir('old'), tmpdir.mkdir('new')
+    write_listing(old, 'eu-west-1', [{'repositoryName': 'a'}, {'repositoryName': 'b', 'imageTagMutability': 'x'}])
+    write_listing(old, 'eu-west-2', [{'repositoryName': 'c'}])
+    write_listing(new, 'eu-west-1', [{'repositoryName': 'b', 'imageTagMutability': 'y'}, {'repositoryName': 'd'}])
+    write_listing(new, 'eu-west-3', [{'repositoryName': 'e'}])
+    assert do_diff(str(old), str(new), verbose=1) == 5
+    assert capsys.readouterr().out.splitlines() == [
+        '- ecr eu-west-1 DescribeRepositories repositories a',
+        '~ ecr eu-west-1 DescribeRepositories repositories b imageTagMutability',
+        '+ ecr eu-west-1 DescribeRepositories repositories d',
+        '- ecr eu-west-2 DescribeRepositories repositories c',
+        '+ ecr eu-west-3 DescribeRepositories repositories e',
+        '2 added, 2 removed, 1 changed',
+    ]
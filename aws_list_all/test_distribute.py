@@ -0,0 +1,150 @@
+import os
+from threading import Thread
+from urllib.error import HTTPError
+
+import pytest
+
+from . import listing
+from .distribute import Coordinator, WorkQueue, do_coordinate, do_work, post
+
+TO_RUN = [['ecr', region, 'DescribeRepositories', None] for region in ('eu-west-1', 'eu-west-2', 'eu-west-3')]
+
+
+def test_work_queue(tmpdir):
+    filename = str(tmpdir.join('queue.sqlite'))
+    queue = WorkQueue(filename, max_attempts=2)
+    assert queue.add(TO_RUN)
+    assert queue.is_planned_for(list(reversed(TO_RUN)))
+    assert not queue.is_planned_for(TO_RUN[:2])
+    assert [query for _, query in queue.lease('a', 2, 10, now=0)] == TO_RUN[:2]
+    (third, _), = queue.lease('b', 2, 10, now=1)
+    # Throttled units are handed out again, and expired leases are taken over by other workers
+    assert not queue.complete(third, 'b', {'query': TO_RUN[2], 'error': 'ThrottlingException', 'repr': ''})
+    assert [unit_id for unit_id, _ in queue.lease('b', 3, 10, now=11)] == [1, 2, 3]
+    assert not queue.complete(1, 'a', {'listing': {}})
+    assert queue.complete(1, 'b', {'listing': {}})
+    queue.set_result(1, ('+++', 'ecr', 'eu-west-1', 'DescribeRepositories', None, ''))
+    queue.close()
+
+    # The queue is resumed, and units are given up after too many attempts
+    queue = WorkQueue(filename, max_attempts=2)
+    assert not queue.add(TO_RUN)
+    assert queue.lease('c', 2, 10, now=22) == []
+    assert queue.finished()
+    assert [result[0] for result in queue.results()] == ['+++', '!!!', '!!!']
+
+
+def test_do_coordinate_refuses_other_scans(tmpdir, capsys):
+    filename = str(tmpdir.join('queue.sqlite'))
+    queue = WorkQueue(filename)
+    queue.add(TO_RUN)
+    queue.close()
+    # Existing queues are only resumed on request, and only for the queries they were planned for
+    assert do_coordinate(TO_RUN, port=0, queue_filename=filename) == 1
+    assert 'Use --resume' in capsys.readouterr().out
+    assert do_coordinate(TO_RUN[:2], port=0, queue_filename=filename, resume=True) == 1
+    assert 'planned for other queries' in capsys.readouterr().out
+
+
+def test_coordinator_rejects_records_of_other_queries(monkeypatch, tmpdir):
+    monkeypatch.chdir(tmpdir)
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')))
+    queue.add(TO_RUN[:1])
+    coordinator = Coordinator(('127.0.0.1', 0), queue)
+    try:
+        (unit_id, _), = queue.lease('a', 1)
+        record = {
+            'listing': {
+                'service': 'ecr',
+                'region': 'us-east-1',
+                'operation': 'DescribeRepositories',
+                'profile': None,
+                'response': {
+                    'ResponseMetadata': {
+                        'HTTPStatusCode': 200
+                    },
+                    'repositories': [{
+                        'repositoryName': 'r'
+                    }]
+                }
+            }
+        }
+        query = queue.complete(unit_id, 'a', record)
+        assert query == TO_RUN[0]
+        coordinator.add_record(unit_id, query, record)
+    finally:
+        coordinator.server_close()
+        coordinator.manifest.close()
+    assert [result[:3] for result in queue.results()] == [('!!!', 'ecr', 'eu-west-1')]
+    assert not [filename for filename in os.listdir(str(tmpdir)) if filename.startswith('ecr_')]
+
+
+def test_coordinator_token(tmpdir):
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')))
+    coordinator = Coordinator(('127.0.0.1', 0), queue, token='secret')
+    Thread(target=coordinator.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{}/lease'.format(coordinator.server_port)
+        with pytest.raises(HTTPError) as exc_info:
+            post(url, {'worker': 'a'})
+        assert exc_info.value.code == 403
+        assert post(url, {'worker': 'a'}, 'secret') == {'units': [], 'finished': True}
+    finally:
+        coordinator.shutdown()
+        coordinator.server_close()
+        coordinator.manifest.close()
+
+
+def run_scan(queue, token=None, **kwargs):
+    """Run the units of the given queue with two workers, and return the coordinator"""
+    coordinator = Coordinator(('127.0.0.1', 0), queue, token=token, **kwargs)
+    Thread(target=coordinator.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{}/'.format(coordinator.server_port)
+        workers = [Thread(target=do_work, args=(url, 2, worker), kwargs={'token': token}) for worker in ('a', 'b')]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+    finally:
+        coordinator.shutdown()
+        coordinator.server_close()
+        coordinator.manifest.close()
+    return coordinator
+
+
+def test_distributed_scan(monkeypatch, tmpdir):
+    monkeypatch.chdir(tmpdir)
+
+    def run_raw_listing_operation(service, region, operation, profile, parameters=None):
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}, 'repositories': [{'repositoryName': region}]}
+
+    monkeypatch.setattr(listing, 'run_raw_listing_operation', run_raw_listing_operation)
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')))
+    queue.add(TO_RUN)
+    coordinator = run_scan(queue, token='secret')
+    assert queue.finished()
+    assert sorted(result[2] for result in queue.results()
+                  if result[0] == '+++') == ['eu-west-1', 'eu-west-2', 'eu-west-3']
+    assert len([filename for filename in os.listdir(str(tmpdir)) if filename.startswith('ecr_')]) == 3
+    assert coordinator.evidence[None].conclusions() == {('ecr', region): True for _, region, _, _ in TO_RUN}
+    assert set(coordinator.durations[None]) == set(tuple(query[:3]) for query in TO_RUN)
+
+
+def test_distributed_child_queries(monkeypatch, tmpdir):
+    monkeypatch.chdir(tmpdir)
+
+    def run_raw_listing_operation(service, region, operation, profile, parameters=None):
+        if operation == 'ListClusters':
+            return {'ResponseMetadata': {'HTTPStatusCode': 200}, 'clusterArns': ['arn:1', 'arn:2', 'arn:3']}
+        if operation == 'ListServices':
+            return {'ResponseMetadata': {'HTTPStatusCode': 200}, 'serviceArns': [parameters['cluster'] + '/s']}
+        raise Exception('This operation is not supported in this region')
+
+    monkeypatch.setattr(listing, 'run_raw_listing_operation', run_raw_listing_operation)
+    queue = WorkQueue(str(tmpdir.join('queue.sqlite')))
+    queue.add([['ecs', 'eu-west-1', 'ListClusters', None]])
+    run_scan(queue, expand_children=True, child_fanout=2, selected_operations=['ListClusters', 'ListServices'])
+    assert queue.finished()
+    assert sorted(result[3] for result in queue.results()
+                  if result[0] == '+++') == ['ListClusters', 'ListServices', 'ListServices']
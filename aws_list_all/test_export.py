@@ -0,0 +1,46 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from .export import ParquetExport, get_arn
+from .listing import Listing
+
+
+def test_get_arn():
+    assert get_arn('clusterArns', 'arn:aws:ecs:eu-west-1:1:cluster/a') == 'arn:aws:ecs:eu-west-1:1:cluster/a'
+    assert get_arn('Functions', {'FunctionName': 'f', 'FunctionArn': 'arn:f', 'RoleArn': 'arn:r'}) == 'arn:f'
+    assert get_arn('Keys', {'KeyId': 'k', 'KeyArn': 'arn:k'}) == 'arn:k'
+    assert get_arn('Functions', {'FunctionName': 'f'}) is None
+
+
+def test_parquet_export(tmpdir):
+    dataset = pytest.importorskip('pyarrow.dataset')
+    export = ParquetExport(str(tmpdir))
+    for region in ('eu-west-1', 'eu-west-2'):
+        response = {'ResponseMetadata': {}, 'repositories': [{'repositoryName': 'a', 'repositoryArn': 'arn:a'}]}
+        export.add(Listing('ecr', region, 'DescribeRepositories', response, None))
+    export.close()
+    table = dataset.dataset(str(tmpdir), format='parquet', partitioning='hive').to_table()
+    assert sorted(table.column('region').to_pylist()) == ['eu-west-1', 'eu-west-2']
+    assert table.column('id').to_pylist() == ['a', 'a']
+    assert table.column('arn').to_pylist() == ['arn:a', 'arn:a']
+
+
+def test_import_without_pyarrow():
+    # Importing pyarrow fails if its module is None, which needs a fresh interpreter
+    code = '\n'.join([
+        'import sys',
+        'import aws_list_all.query',
+        'assert "pyarrow" not in sys.modules',
+        'sys.modules["pyarrow"] = None',
+        'from aws_list_all.export import ParquetExport',
+        'try:',
+        '    ParquetExport(".")',
+        'except Exception as exc:',
+        '    assert "requires pyarrow" in str(exc)',
+        'else:',
+        '    raise AssertionError("ParquetExport without pyarrow")',
+    ])
+    subprocess.check_call([sys.executable, '-c', code], cwd=os.path.dirname(os.path.dirname(__file__)))
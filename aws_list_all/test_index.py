@@ -0,0 +1,109 @@
+import json
+
+from . import index as index_module
+from .index import ResourceIndex, apply_resource_index, get_index_services, get_type_noun, select_config_aggregator
+
+TO_RUN = [
+    ['ec2', 'eu-west-1', 'DescribeInstances', None],
+    ['ec2', 'eu-west-2', 'DescribeInstances', None],
+    ['ec2', 'eu-west-2', 'DescribeKeyPairs', None],
+    ['elbv2', 'eu-west-1', 'DescribeLoadBalancers', None],
+    ['iam', None, 'ListRoles', None],
+    ['s3', None, 'ListBuckets', None],
+    ['xray', 'eu-west-1', 'GetGroups', None],
+]
+
+
+class FakePaginator(object):
+
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return self.pages
+
+
+class FakeConfigClient(object):
+
+    def get_paginator(self, name):
+        results = [
+            {
+                'resourceType': 'AWS::EC2::Instance',
+                'awsRegion': 'eu-west-2',
+                'COUNT(*)': 3
+            },
+            {
+                'resourceType': 'AWS::ElasticLoadBalancing::LoadBalancer',
+                'awsRegion': 'eu-west-1',
+                'COUNT(*)': 1
+            },
+            {
+                'resourceType': 'AWS::IAM::Role',
+                'awsRegion': 'global',
+                'COUNT(*)': 12
+            },
+            {
+                'resourceType': 'AWS::S3::Bucket',
+                'awsRegion': 'eu-west-1',
+                'COUNT(*)': 2
+            },
+        ]
+        return FakePaginator([{'Results': [json.dumps(result) for result in results]}])
+
+
+def test_get_index_services():
+    assert get_index_services('EC2') == ['ec2']
+    assert get_index_services('elasticloadbalancingv2') == ['elbv2']
+
+
+def test_get_type_noun():
+    assert get_type_noun('ec2:security-group') == 'securitygroup'
+    assert get_type_noun('AWS::EC2::SecurityGroup') == 'securitygroup'
+    assert get_type_noun('AWS::IAM::Policy') == 'policy'
+
+
+def test_select_config_aggregator(monkeypatch):
+    monkeypatch.setattr(index_module, 'get_client', lambda *args: FakeConfigClient())
+    index = select_config_aggregator('us-east-1', 'organization')
+    assert index.has_resources('ec2', 'eu-west-2', 'DescribeInstances')
+    assert not index.has_resources('ec2', 'eu-west-1', 'DescribeInstances')
+    # Key pairs are not recorded, so their listing is not covered by the index even in regions without instances
+    assert index.has_resources('ec2', 'eu-west-1', 'DescribeKeyPairs') is None
+    # Nouns match exactly, so reserved instances are not covered by the instances
+    assert index.has_resources('ec2', 'eu-west-2', 'DescribeReservedInstances') is None
+    # The aggregator reports no resources in eu-central-1, so it is not covered
+    assert index.has_resources('ec2', 'eu-central-1', 'DescribeInstances') is None
+    assert index.has_resources('iam', None, 'ListRoles')
+    assert index.has_resources('elb', 'eu-west-1', 'DescribeLoadBalancers')
+    # Buckets of the global s3 listing are reported in their regions
+    assert index.has_resources('s3', None, 'ListBuckets')
+    assert index.has_resources('xray', 'eu-west-1', 'GetGroups') is None
+
+
+def test_apply_resource_index():
+    index = ResourceIndex()
+    index.add_covered('elasticloadbalancing', 'eu-west-1', 'loadbalancer')
+    index.add_covered('ec2', 'eu-west-1', 'instance')
+    index.add_covered('s3', 'eu-west-1', 'bucket')
+    index.add_present('ec2', 'eu-west-2', 'instance')
+    index.add_present('iam', 'global', 'role')
+    assert apply_resource_index(TO_RUN, index) == [
+        ['ec2', 'eu-west-2', 'DescribeInstances', None],
+        ['iam', None, 'ListRoles', None],
+        ['ec2', 'eu-west-2', 'DescribeKeyPairs', None],
+        ['xray', 'eu-west-1', 'GetGroups', None],
+    ]
+    assert apply_resource_index(TO_RUN, index, skip_empty=False)[4:] == [
+        ['ec2', 'eu-west-1', 'DescribeInstances', None],
+        ['elbv2', 'eu-west-1', 'DescribeLoadBalancers', None],
+        ['s3', None, 'ListBuckets', None],
+    ]
+    index.add_present('s3', 'eu-west-1', 'bucket')
+    assert ['s3', None, 'ListBuckets', None] in apply_resource_index(TO_RUN, index)
+
+
+def test_apply_resource_index_unreported_region():
+    index = ResourceIndex()
+    index.add_present('ec2', 'eu-west-2', 'instance')
+    # Instances are only covered in eu-west-2, so the eu-west-1 listing is always queried
+    assert ['ec2', 'eu-west-1', 'DescribeInstances', None] in apply_resource_index(TO_RUN, index)
@@ -1,6 +1,15 @@
+import asyncio
+from socket import EAI_AGAIN, EAI_NONAME, gaierror
+
+import botocore.session
+import pytest
+from botocore.args import ClientArgsCreator
+
+from . import introspection
 from .introspection import (
-    get_endpoint_hosts, get_listing_operations, get_regions_for_service, get_service_regions, get_services,
-    introspect_regions_for_service
+    DNS_INCONCLUSIVE, calculate_service_regions, get_endpoint_hosts, get_listing_operations, get_regions_for_service,
+    get_resource_identifier_keys, get_service_endpoint_hosts, get_service_regions, get_services, get_endpoint_urls,
+    guess_identifier_key, introspect_regions_for_service, resolve_endpoint_ip
 )
 
 
@@ -20,6 +29,35 @@ def test_get_endpoint_hosts():
     assert not services_with_no_endpoint
 
 
+def test_get_service_endpoint_hosts():
+    session = botocore.session.get_session()
+    assert get_service_endpoint_hosts(session, 'ec2', ['eu-west-1']) == {
+        'eu-west-1': ['https://ec2.eu-west-1.amazonaws.com']
+    }
+    # Services with legacy global endpoints must resolve like a client would
+    assert get_service_endpoint_hosts(session, 's3', ['us-east-1']) == {
+        'us-east-1': ['https://s3.amazonaws.com', 'https://{RequestRoute}.s3.amazonaws.com']
+    }
+
+
+def test_get_endpoint_urls_fallback(monkeypatch):
+    session = botocore.session.get_session()
+    service_model = session.get_service_model('s3')
+    regions = ['us-east-1', 'eu-west-1']
+    endpoint_urls = get_endpoint_urls(session, service_model, regions)
+
+    class RenamedClientArgsCreator(ClientArgsCreator):
+        # The private API changed in another botocore version
+        _compute_endpoint_config = None
+
+    monkeypatch.setattr(introspection, 'ClientArgsCreator', RenamedClientArgsCreator)
+    # Clients are constructed instead, which resolve the same endpoints
+    assert get_endpoint_urls(session, service_model, regions) == endpoint_urls == {
+        'us-east-1': 'https://s3.amazonaws.com',
+        'eu-west-1': 'https://s3.eu-west-1.amazonaws.com',
+    }
+
+
 def test_get_service_regions():
     services = get_services()
     regions = get_service_regions()
@@ -30,11 +68,45 @@ def test_get_service_regions():
     assert services_with_no_region == expected_no_region
 
 
+def test_calculate_service_regions_incremental():
+    # With complete previous results, nothing needs to be resolved and the previous results are kept
+    regions = get_service_regions()
+    assert calculate_service_regions(regions) == regions
+
+
+def test_calculate_service_regions_inconclusive(monkeypatch):
+    monkeypatch.setattr(
+        introspection, 'get_endpoint_hosts', lambda: {
+            'svc': {
+                'eu-west-1': ['https://svc.eu-west-1.amazonaws.com'],
+                'eu-west-2': ['https://svc.eu-west-2.amazonaws.com'],
+            }
+        }
+    )
+    monkeypatch.setattr(
+        introspection, 'get_service_region_ip_in_dns',
+        lambda hosts: [(service, region, DNS_INCONCLUSIVE) for service, region in sorted(hosts)]
+    )
+    # Inconclusive lookups keep the previous results
+    assert calculate_service_regions(fallback_service_regions={'svc': ['eu-west-2']}) == {'svc': ['eu-west-2']}
+    with pytest.raises(RuntimeError):
+        calculate_service_regions(fallback_service_regions={})
+
+
 def test_get_regions_for_service():
     requested_regions = ('us-east-2', 'eu-west-1', 'nonexistent')
     assert set(get_regions_for_service('ec2', requested_regions=requested_regions)) == set(('us-east-2', 'eu-west-1'))
 
 
+def test_get_resource_identifier_keys():
+    assert get_resource_identifier_keys('ec2', 'DescribeVpcs') == {'Vpcs': 'VpcId'}
+    assert get_resource_identifier_keys('lambda', 'ListFunctions') == {'Functions': 'FunctionName'}
+    assert get_resource_identifier_keys('rds', 'DescribeDBInstances') == {'DBInstances': 'DBInstanceIdentifier'}
+    assert get_resource_identifier_keys('ecs', 'ListClusters') == {'clusterArns': None}
+    assert guess_identifier_key('repositories', ['registryId', 'repositoryName', 'repositoryArn']) == 'repositoryName'
+    assert guess_identifier_key('Things', ['Owner', 'Description']) is None
+
+
 def test_introspect_regions_for_service():
     introspect_regions_for_service()
 
@@ -109,3 +181,31 @@ def test_get_listing_operations():
         'using "aws-list-all introspect list-operations --service X"'
     )
     assert services_with_no_listings - expected_no_listings == set(), 'Some services have no listings, please check!'
+
+
+def test_resolve_endpoint_ip(monkeypatch):
+    errors = {
+        'missing.eu-west-1.amazonaws.com': [EAI_NONAME] * 3,
+        'flaky.eu-west-1.amazonaws.com': [EAI_AGAIN, EAI_AGAIN],
+        'found.eu-west-1.amazonaws.com': [],
+    }
+
+    async def getaddrinfo(self, hostname, port, **kwargs):
+        if errors[hostname]:
+            raise gaierror(errors[hostname].pop(0), 'Lookup failed')
+        return [(None, None, None, None, ('10.0.0.1', port))]
+
+    monkeypatch.setattr(asyncio.BaseEventLoop, 'getaddrinfo', getaddrinfo)
+
+    async def resolve(hosts, retries):
+        return await resolve_endpoint_ip(asyncio.Semaphore(1), 'svc', 'eu-west-1', hosts, retries=retries)
+
+    # Hosts that do not exist or keep failing are skipped for the next host instead of raising
+    hosts = ['https://missing.eu-west-1.amazonaws.com']
+    assert asyncio.run(resolve(hosts, retries=1)) == ('svc', 'eu-west-1', None)
+    # Hosts that keep failing temporarily may exist
+    hosts.append('https://flaky.eu-west-1.amazonaws.com')
+    assert asyncio.run(resolve(hosts, retries=1)) == ('svc', 'eu-west-1', DNS_INCONCLUSIVE)
+    errors['flaky.eu-west-1.amazonaws.com'] = [EAI_AGAIN]
+    hosts.append('https://found.eu-west-1.amazonaws.com')
+    assert asyncio.run(resolve(hosts, retries=0)) == ('svc', 'eu-west-1', '10.0.0.1')
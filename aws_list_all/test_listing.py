@@ -0,0 +1,174 @@
+import boto3
+from botocore.stub import Stubber
+
+from . import listing
+from .listing import Listing, merge_responses, project_response, run_raw_listing_operation, set_query_profile
+
+
+def test_merge_responses():
+    merged = merge_responses([
+        {
+            'ResponseMetadata': {
+                'HTTPStatusCode': 200
+            },
+            'Reservations': [{
+                'ReservationId': 'r-1'
+            }]
+        },
+        {
+            'ResponseMetadata': {
+                'HTTPStatusCode': 200
+            },
+            'Reservations': [],
+            'NextToken': 'abc'
+        },
+        {
+            'ResponseMetadata': {
+                'HTTPStatusCode': 200
+            },
+            'Reservations': [{
+                'ReservationId': 'r-2'
+            }],
+            'NextToken': ''
+        },
+    ])
+    assert merged['Reservations'] == [{'ReservationId': 'r-1'}, {'ReservationId': 'r-2'}]
+    resources = Listing('ec2', 'eu-west-1', 'DescribeInstances', merged, None).resources
+    assert resources == {'Reservations': [{'ReservationId': 'r-1'}, {'ReservationId': 'r-2'}], 'truncated': [True]}
+
+
+def test_query_profile(monkeypatch, capsys):
+    client = boto3.client('ec2', region_name='eu-west-1', aws_access_key_id='a', aws_secret_access_key='b')
+    monkeypatch.setattr(listing, 'get_client', lambda *args: client)
+    set_query_profile({
+        'ec2': {
+            'DescribeVolumes': {
+                'parameters': {
+                    'Filters': [{
+                        'Name': 'encrypted',
+                        'Values': ['false']
+                    }],
+                    'Unsupported': True
+                },
+                'projection': {
+                    'Volumes': '{VolumeId: VolumeId, Size: Size}'
+                },
+            }
+        }
+    })
+    try:
+        with Stubber(client) as stubber:
+            stubber.add_response(
+                'describe_volumes',
+                {'Volumes': [{
+                    'VolumeId': 'vol-1',
+                    'Size': 8,
+                    'Encrypted': False,
+                    'State': 'in-use'
+                }]},
+                {'Filters': [{
+                    'Name': 'status',
+                    'Values': ['in-use']
+                }, {
+                    'Name': 'encrypted',
+                    'Values': ['false']
+                }]}
+            )
+            response = run_raw_listing_operation(
+                'ec2', 'eu-west-1', 'DescribeVolumes', None, {'Filters': [{
+                    'Name': 'status',
+                    'Values': ['in-use']
+                }]}
+            )
+    finally:
+        set_query_profile({})
+    assert response['Volumes'] == [{'VolumeId': 'vol-1', 'Size': 8}]
+    # Unsupported parameters are reported once, when the profile is set
+    assert capsys.readouterr().out.count('Ignoring query profile parameter Unsupported') == 1
+
+
+def test_query_profile_projection():
+    set_query_profile({
+        'lambda': {
+            'ListFunctions': {
+                'projection': {
+                    'Functions': '{Runtime: Runtime}'
+                }
+            }
+        },
+        'kms': {
+            'ListAliases': {
+                'projection': {
+                    'Aliases': '{AliasName: AliasName}'
+                }
+            }
+        },
+    })
+    try:
+        functions = {'Functions': [{'FunctionName': 'f', 'FunctionArn': 'arn:f', 'Runtime': 'python3.11', 'Role': 'r'}]}
+        aliases = {'Aliases': [{'AliasName': 'alias/a', 'TargetKeyId': 'k'}]}
+        # Projected resources keep their identifier and ARN
+        assert project_response('lambda', 'ListFunctions', functions) == {
+            'Functions': [{
+                'FunctionName': 'f',
+                'FunctionArn': 'arn:f',
+                'Runtime': 'python3.11'
+            }]
+        }
+        # Responses that other listings are derived from are not projected
+        assert project_response('kms', 'ListAliases', aliases) == aliases
+    finally:
+        set_query_profile({})
+
+
+def test_query_profile_projection_of_filtered_listings(capsys):
+    set_query_profile({
+        'ec2': {
+            'DescribeSecurityGroups': {
+                'projection': {
+                    'SecurityGroups': '{Description: Description}'
+                }
+            }
+        },
+        'lambda': {
+            'ListFunctions': {
+                'projection': {
+                    'Functions': 'FunctionName'
+                }
+            }
+        },
+    })
+    try:
+        groups = {
+            'ResponseMetadata': {
+                'HTTPStatusCode': 200
+            },
+            'SecurityGroups': [
+                {
+                    'GroupId': 'sg-1',
+                    'GroupName': 'default',
+                    'Description': 'default VPC security group'
+                },
+                {
+                    'GroupId': 'sg-2',
+                    'GroupName': 'web',
+                    'Description': 'web servers',
+                    'VpcId': 'vpc-1'
+                },
+            ]
+        }
+        projected = project_response('ec2', 'DescribeSecurityGroups', groups)
+        # The group name is kept, so that the default security group is still filtered
+        assert Listing('ec2', 'eu-west-1', 'DescribeSecurityGroups', projected, None).resources == {
+            'SecurityGroups': [{
+                'GroupId': 'sg-2',
+                'GroupName': 'web',
+                'Description': 'web servers'
+            }]
+        }
+        # Projections that do not select a dict are rejected when the profile is set
+        assert 'Ignoring query profile projection FunctionName' in capsys.readouterr().out
+        functions = {'Functions': [{'FunctionName': 'f', 'Runtime': 'python3.11'}]}
+        assert project_response('lambda', 'ListFunctions', functions) == functions
+    finally:
+        set_query_profile({})
@@ -0,0 +1,81 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from time import sleep
+
+import boto3
+
+from . import prewarm
+from .prewarm import Prewarmer, get_warm_urls, warm_connection
+
+
+class LogsHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):  # pylint:disable=invalid-name
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'{"logGroups": []}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-amz-json-1.1')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):  # pylint:disable=redefined-builtin
+        pass
+
+
+class CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    connections = 0
+
+    def get_request(self):
+        self.connections += 1
+        return ThreadingHTTPServer.get_request(self)
+
+
+def test_get_warm_urls():
+    client = boto3.client(
+        'iot-data',
+        region_name='eu-west-1',
+        endpoint_url='https://data-ats.iot.eu-west-1.amazonaws.com',
+        aws_access_key_id='a',
+        aws_secret_access_key='b'
+    )
+    hosts = ['https://data-ats.iot.eu-west-1.amazonaws.com', 'https://other.eu-west-1.amazonaws.com']
+    assert get_warm_urls(client, hosts) == hosts[:1]
+    assert get_warm_urls(client, []) == ['https://data-ats.iot.eu-west-1.amazonaws.com']
+
+
+def test_warm_connection():
+    server = CountingServer(('127.0.0.1', 0), LogsHandler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{}'.format(server.server_port)
+        client = boto3.client(
+            'logs', region_name='eu-west-1', endpoint_url=url, aws_access_key_id='a', aws_secret_access_key='b'
+        )
+        warm_connection(client, url)
+        assert client.describe_log_groups()['logGroups'] == []
+        # The request used the warmed connection
+        assert server.connections == 1
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_prewarmer_window(monkeypatch):
+    warmed = []
+    done = set()
+    monkeypatch.setattr(prewarm, 'get_endpoint_hosts', lambda: {})
+    monkeypatch.setattr(prewarm, 'warm_endpoint', lambda endpoint, endpoint_hosts: warmed.append(endpoint) or (1, 0))
+    monkeypatch.setattr(prewarm, 'is_work_done', lambda *endpoint: endpoint in done)
+    to_run = [['ecr', region, 'DescribeRepositories', None] for region in ('eu-west-1', 'eu-west-2', 'eu-west-3')]
+    prewarmer = Prewarmer(to_run, window=2).start()
+    sleep(0.3)
+    # Endpoints are only warmed up to the window ahead of the queries that are not done
+    assert warmed == [('ecr', 'eu-west-1', None), ('ecr', 'eu-west-2', None)]
+    done.add(('ecr', 'eu-west-1', None))
+    sleep(0.3)
+    assert len(warmed) == 3
+    prewarmer.join()
+    assert prewarmer.warmed == 3
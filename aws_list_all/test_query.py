@@ -0,0 +1,157 @@
+import os
+from threading import Thread
+
+from botocore.exceptions import ClientError, EndpointConnectionError, SSLError
+
+from . import listing as listing_module
+from . import query as query_module
+from .index import ResourceIndex
+from .listing import Listing
+from .query import (
+    AvailabilityEvidence, SharedResponses, acquire_listing, do_list_files, format_manifest_entry, get_child_queries,
+    get_listing_filename, is_region_unavailable, save_listing
+)
+from .report import ListingManifest, read_manifest
+
+
+def test_availability_evidence():
+    evidence = AvailabilityEvidence()
+    evidence.record('cloud9', 'eu-west-1', True)
+    evidence.record('cloud9', 'eu-west-1', False)
+    evidence.record('cloud9', 'eu-north-1', False)
+    evidence.record('cloud9', 'eu-north-1', False)
+    evidence.record('ec2', 'eu-west-1', False)
+    evidence.record('ec2', 'eu-west-1', None)
+    evidence.record('iam', None, False)
+    assert evidence.conclusions() == {('cloud9', 'eu-west-1'): True, ('cloud9', 'eu-north-1'): False}
+    assert evidence.conclusions(include_unavailable=False) == {('cloud9', 'eu-west-1'): True}
+
+
+def test_availability_evidence_of_errors(monkeypatch):
+
+    def acquire(service, region, operation, profile, parameters):
+        raise Exception(messages[region])
+
+    messages = {
+        'eu-west-1':
+            'An error occurred (UnrecognizedClientException) when calling the ListEnvironments operation: '
+            'The security token included in the request is invalid.',
+        'eu-west-2': 'An error occurred (SubscriptionRequiredException): Macie is not enabled',
+        'eu-west-3': 'An error occurred (UnsupportedOperation): This operation is not supported in this region',
+    }
+    monkeypatch.setattr(Listing, 'acquire', staticmethod(acquire))
+    evidence = AvailabilityEvidence()
+    for region in sorted(messages):
+        acquire_listing(0, ['cloud9', region, 'ListEnvironments', None], evidence)
+    assert evidence.conclusions() == {('cloud9', 'eu-west-3'): False}
+
+
+def test_is_region_unavailable():
+    ssl_error = SSLError(endpoint_url='https://cloud9.ap-northeast-3.amazonaws.com/', error='CERTIFICATE_VERIFY_FAILED')
+    assert is_region_unavailable('cloud9', 'ListEnvironments', repr(ssl_error))
+    connection_error = EndpointConnectionError(endpoint_url='https://cloud9.ap-northeast-3.amazonaws.com/')
+    assert is_region_unavailable('cloud9', 'ListEnvironments', repr(connection_error))
+    access_denied = ClientError({'Error': {'Code': 'AccessDeniedException'}}, 'DescribeScalingPlans')
+    assert is_region_unavailable('autoscaling-plans', 'DescribeScalingPlans', repr(access_denied))
+    # Access denied to other services is a matter of permissions
+    assert not is_region_unavailable('ec2', 'DescribeInstances', repr(access_denied))
+    invalid_token = ClientError({'Error': {'Code': 'UnrecognizedClientException'}}, 'ListEnvironments')
+    assert not is_region_unavailable('cloud9', 'ListEnvironments', repr(invalid_token))
+
+
+def test_get_child_queries():
+    response = {'ResponseMetadata': {}, 'clusterArns': ['arn:1', 'arn:2', 'arn:2', 'arn:3']}
+    listing = Listing('ecs', 'eu-west-1', 'ListClusters', response, None)
+    child_queries = get_child_queries(listing, fanout=2)
+    assert sorted(q[2] for q in child_queries) == sorted(['ListContainerInstances', 'ListServices', 'ListTasks'] * 2)
+    assert set(q[4]['cluster'] for q in child_queries) == {'arn:1', 'arn:2'}
+    assert get_child_queries(Listing('ecs', 'eu-west-1', 'ListTaskDefinitions', {'ResponseMetadata': {}}, None)) == []
+
+
+def test_listing_manifest(tmpdir):
+    manifest = ListingManifest(str(tmpdir))
+    response = {'ResponseMetadata': {}, 'repositories': [{'repositoryName': 'a'}, {'repositoryName': 'b'}]}
+    manifest.add('data/ecr.json', Listing('ecr', 'eu-west-1', 'DescribeRepositories', response, None))
+    manifest.add('data/ecr.json', Listing('ecr', 'eu-west-1', 'DescribeRepositories', response, None))
+    manifest.close()
+    entries = read_manifest(str(tmpdir))
+    assert list(entries) == ['ecr.json']
+    # The manifests of later runs keep only the latest entry of every file
+    manifest = ListingManifest(str(tmpdir))
+    manifest.add('data/ecr.json', Listing('ecr', 'eu-west-1', 'DescribeRepositories', response, None))
+    manifest.add('data/sqs.json', Listing('sqs', 'eu-west-1', 'ListQueues', {'ResponseMetadata': {}}, None))
+    manifest.close()
+    assert len(tmpdir.join('aws_list_all_manifest.jsonl').readlines()) == 2
+    assert sorted(read_manifest(str(tmpdir))) == ['ecr.json', 'sqs.json']
+    assert format_manifest_entry(entries['ecr.json']) == ['ecr eu-west-1 DescribeRepositories repositories 2']
+    entries['ecr.json']['truncated'] = True
+    assert format_manifest_entry(entries['ecr.json']) == ['ecr eu-west-1 DescribeRepositories repositories > 2']
+
+
+def test_summary_only_skips_stale_manifest_entries(tmpdir, monkeypatch, capsys):
+    monkeypatch.chdir(tmpdir)
+    response = {'ResponseMetadata': {}, 'repositories': [{'repositoryName': 'a'}, {'repositoryName': 'b'}]}
+    manifest = ListingManifest()
+    save_listing(Listing('ecr', 'eu-west-1', 'DescribeRepositories', response, None), manifest=manifest)
+    manifest.close()
+    filename = get_listing_filename('ecr', 'eu-west-1', 'DescribeRepositories', None)
+    with monkeypatch.context() as context:
+        context.setattr(query_module, 'format_listing_file', None)
+        do_list_files([filename], parallel=1, summary_only=True)
+    assert capsys.readouterr().out == 'ecr eu-west-1 DescribeRepositories repositories 2\n'
+    # Watch and serve write listing files without the manifest, so its entry no longer applies
+    response['repositories'].append({'repositoryName': 'c'})
+    save_listing(Listing('ecr', 'eu-west-1', 'DescribeRepositories', response, None))
+    os.utime(filename, (0, 0))
+    do_list_files([filename], parallel=1, summary_only=True)
+    assert capsys.readouterr().out == 'ecr eu-west-1 DescribeRepositories repositories 3\n'
+
+
+def test_do_query_orders_dependencies_after_index(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    regions = ['eu-west-1', 'eu-west-2', 'eu-west-3', 'eu-north-1']
+    executed = []
+
+    def run_raw_listing_operation(service, region, operation, profile, parameters=None):
+        executed.append((region, operation))
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}, 'Keys': [], 'Aliases': []}
+
+    index = ResourceIndex()
+    for region in regions:
+        index.add_present('kms', region, 'key')
+    monkeypatch.setattr(listing_module, 'run_raw_listing_operation', run_raw_listing_operation)
+    monkeypatch.setattr(
+        query_module, 'plan_queries', lambda *args: [['kms', region, operation, None] for region in regions
+                                                     for operation in ('ListKeys', 'ListAliases')]
+    )
+    monkeypatch.setattr(query_module, 'get_resource_index', lambda *args: index)
+    monkeypatch.setattr(query_module, 'get_recorded_durations', lambda profile: {})
+    monkeypatch.setattr(query_module, 'record_durations', lambda durations, profile: None)
+    monkeypatch.setattr(query_module, 'update_observed_availability', lambda conclusions, profile: None)
+    thread = Thread(
+        target=query_module.do_query,
+        args=(['kms'], ),
+        kwargs={
+            'parallel': 1,
+            'resource_index': 'config',
+            'prewarm': False
+        },
+        daemon=True
+    )
+    thread.start()
+    thread.join(30)
+    assert not thread.is_alive()
+    # The auxiliary ListAliases of every region is executed before the ListKeys that needs it
+    for region in regions:
+        assert executed.index((region, 'ListAliases')) < executed.index((region, 'ListKeys'))
+
+
+def test_shared_responses_timeout():
+    to_run = [['kms', 'eu-west-1', 'ListKeys', None], ['kms', 'eu-west-1', 'ListAliases', None]]
+    listing = Listing('kms', 'eu-west-1', 'ListKeys', {'ResponseMetadata': {}, 'Keys': []}, None)
+    shared_responses = SharedResponses(to_run)
+    # A producer that is never executed does not block its dependents
+    assert shared_responses.collect(listing, timeout=0.1) == {}
+    aliases = {'ResponseMetadata': {}, 'Aliases': []}
+    shared_responses.publish(to_run[1], response=aliases)
+    assert shared_responses.collect(listing, timeout=0.1) == {'ListAliases': aliases}
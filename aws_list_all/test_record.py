@@ -0,0 +1,47 @@
+import pytest
+
+from .listing import Listing
+from .query import RESULT_ERROR, RESULT_NO_ACCESS, RESULT_SOMETHING, acquire_listing, reprocess_cassette_file
+from .record import RecordedListing, Recorder, get_cassette_filenames
+
+
+def test_reprocess_cassette(tmpdir, monkeypatch):
+    recorder = Recorder(str(tmpdir.join('cassette')))
+    response = {'ResponseMetadata': {'HTTPStatusCode': 200}, 'repositories': [{'repositoryName': 'a'}]}
+    recorder.add(Listing('ecr', 'eu-west-1', 'DescribeRepositories', response, None))
+    recorder.add_error(['lambda', 'eu-west-1', 'ListFunctions', None], Exception('AccessDeniedException'))
+    recorder.close()
+
+    monkeypatch.chdir(tmpdir)
+    results = []
+    for cassette_filename in get_cassette_filenames(str(tmpdir.join('cassette'))):
+        results.extend(result for result, _ in reprocess_cassette_file(0, cassette_filename))
+    assert sorted(result[0] for result in results) == [RESULT_SOMETHING, RESULT_NO_ACCESS]
+    assert tmpdir.join('ecr_DescribeRepositories_eu-west-1_None.json').check()
+
+
+def test_recorded_listing_makes_no_requests():
+    listing = RecordedListing('kms', 'eu-west-1', 'ListKeys', {'ResponseMetadata': {}, 'Keys': []}, None)
+    with pytest.raises(Exception, match='No recorded response'):
+        listing.auxiliary_response('ListAliases')
+
+
+class BrokenRecorder(object):
+
+    def add(self, listing):
+        raise TypeError('Object of type bytes is not JSON serializable')
+
+    def add_error(self, what, exc):
+        raise TypeError('Object of type bytes is not JSON serializable')
+
+
+def test_recording_errors_do_not_abort(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    response = {'ResponseMetadata': {'HTTPStatusCode': 200}, 'repositories': [{'repositoryName': 'a'}]}
+    listing = Listing('ecr', 'eu-west-1', 'DescribeRepositories', response, None)
+    monkeypatch.setattr(Listing, 'acquire', staticmethod(lambda *args: listing))
+    result = acquire_listing(0, ['ecr', 'eu-west-1', 'DescribeRepositories', None], recorder=BrokenRecorder())
+    assert result[0] == RESULT_SOMETHING
+    monkeypatch.setattr(Listing, 'acquire', staticmethod(lambda *args: listing.no_such_attribute))
+    result = acquire_listing(0, ['ecr', 'eu-west-1', 'DescribeRepositories', None], recorder=BrokenRecorder())
+    assert result[0] == RESULT_ERROR
@@ -0,0 +1,46 @@
+import csv
+import json
+
+from .query import RESULT_CLASSIFICATIONS, RESULT_ERROR, RESULT_NOTHING, RESULT_SOMETHING
+from .report import RunReport
+
+RESULTS = [
+    ((RESULT_SOMETHING, 'ec2', 'eu-west-1', 'DescribeVpcs', None, ''), 0.5),
+    ((RESULT_NOTHING, 'ec2', 'eu-west-2', 'DescribeVpcs', None, ''), 0.25),
+    ((RESULT_ERROR, 'iam', None, 'ListRoles', None, 'Exception()'), 2.0),
+]
+
+
+def test_run_report_jsonl(tmpdir, capsys):
+    filename = str(tmpdir.join('report.jsonl'))
+    report = RunReport(filename, RESULT_CLASSIFICATIONS)
+    for result, duration in RESULTS:
+        report.add(result, duration)
+    report.close()
+    with open(filename) as report_file:
+        records = [json.loads(line) for line in report_file]
+    assert [(record['result'], record['region'], record['duration'])
+            for record in records] == [(RESULT_SOMETHING, 'eu-west-1', 0.5), (RESULT_NOTHING, 'eu-west-2', 0.25),
+                                       (RESULT_ERROR, None, 2.0)]
+    assert [record['classification'] for record in records] == [
+        RESULT_CLASSIFICATIONS[result_type] for result_type in (RESULT_SOMETHING, RESULT_NOTHING, RESULT_ERROR)
+    ]
+    assert report.counts == {RESULT_SOMETHING: 1, RESULT_NOTHING: 1, RESULT_ERROR: 1}
+    assert report.total_duration == 2.75
+    report.print_summary()
+    summary = capsys.readouterr().out
+    assert '3 queries' in summary
+    assert summary.index('2.0s iam n/a ListRoles') < summary.index('0.5s ec2 eu-west-1 DescribeVpcs')
+
+
+def test_run_report_csv(tmpdir):
+    filename = str(tmpdir.join('report.csv'))
+    report = RunReport(filename, RESULT_CLASSIFICATIONS)
+    for result, duration in RESULTS:
+        report.add(result, duration)
+    report.close()
+    with open(filename, newline='') as report_file:
+        rows = list(csv.DictReader(report_file))
+    assert [(row['service'], row['operation'], row['detail']) for row in rows] == [('ec2', 'DescribeVpcs', ''),
+                                                                                   ('ec2', 'DescribeVpcs', ''),
+                                                                                   ('iam', 'ListRoles', 'Exception()')]
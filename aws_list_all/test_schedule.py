@@ -0,0 +1,70 @@
+from .schedule import (
+    get_batches, order_dependencies_first, order_endpoint_batches, order_longest_first, order_random,
+    simulate_connections
+)
+
+
+def test_order_longest_first():
+    to_run = [
+        ['ec2', 'eu-west-1', 'DescribeVpcs', None],
+        ['ec2', 'eu-west-1', 'DescribeImages', None],
+        ['ec2', 'eu-west-1', 'DescribeSubnets', None],
+        ['logs', 'eu-west-1', 'DescribeLogGroups', None],
+        ['sns', 'eu-west-1', 'ListTopics', None],
+    ]
+    durations = {
+        ('ec2', 'eu-west-1', 'DescribeVpcs'): 0.2,
+        ('ec2', 'eu-west-1', 'DescribeImages'): 30.0,
+        ('ec2', 'eu-west-1', 'DescribeSubnets'): 0.3,
+        ('logs', 'eu-west-1', 'DescribeLogGroups'): 25.0,
+    }
+    ordered = order_longest_first(to_run, durations)
+    assert sorted(ordered) == sorted(to_run)
+    # The two long queries come first, the unknown query is estimated with the mean duration
+    assert {q[2] for q in ordered[:2]} == {'DescribeImages', 'DescribeLogGroups'}
+    assert ordered[2][2] == 'ListTopics'
+    # The short queries come last
+    assert {q[2] for q in ordered[3:]} == {'DescribeVpcs', 'DescribeSubnets'}
+
+
+def test_order_dependencies_first():
+    to_run = [
+        ['kms', 'eu-west-1', 'ListKeys', None],
+        ['ec2', 'eu-west-1', 'DescribeVpcs', None],
+        ['kms', 'eu-west-1', 'ListAliases', None],
+        ['ec2', 'eu-west-1', 'DescribeInternetGateways', None],
+        ['kms', 'us-east-1', 'ListKeys', None],
+    ]
+    assert order_dependencies_first(to_run) == [
+        ['kms', 'eu-west-1', 'ListAliases', None],
+        ['kms', 'eu-west-1', 'ListKeys', None],
+        ['ec2', 'eu-west-1', 'DescribeVpcs', None],
+        ['ec2', 'eu-west-1', 'DescribeInternetGateways', None],
+        ['kms', 'us-east-1', 'ListKeys', None],
+    ]
+
+
+def test_order_endpoint_batches():
+    to_run = [['ec2', 'eu-west-1', 'Describe{}'.format(i), None] for i in range(6)]
+    to_run += [['sns', 'eu-west-1', 'ListTopics', None], ['sqs', 'eu-west-1', 'ListQueues', None]]
+    durations = {('ec2', 'eu-west-1', 'Describe{}'.format(i)): 0.1 for i in range(5)}
+    durations[('ec2', 'eu-west-1', 'Describe5')] = 10.0
+    ordered = order_endpoint_batches(to_run, durations, batch_size=4)
+    assert sorted(ordered) == sorted(to_run)
+    batches = get_batches(ordered, 4)
+    # ec2 takes longest, so its first batch starts with its longest query, and its second batch comes after
+    # one batch of each other endpoint
+    assert [len(batch) for batch in batches] == [4, 1, 1, 2]
+    assert batches[0][0][2] == 'Describe5'
+    assert {batch[0][0] for batch in batches[1:3]} == {'sns', 'sqs'}
+
+
+def test_simulate_connections():
+    to_run = [[service, region, 'List', None] for service in ('ec2', 'sns', 'sqs') for region in ('a', 'b', 'c')] * 4
+    to_run = [query[:2] + ['List{}'.format(i)] + query[3:] for i, query in enumerate(to_run)]
+    estimates = {tuple(query): 3.0 for query in to_run}
+    _, locality_handshakes = simulate_connections(get_batches(order_endpoint_batches(to_run, {}), 4), estimates, 4)
+    _, random_handshakes = simulate_connections(get_batches(order_random(to_run), 1), estimates, 4)
+    # Every endpoint needs one connection with the locality schedule
+    assert locality_handshakes == 9
+    assert random_handshakes > locality_handshakes
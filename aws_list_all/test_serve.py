@@ -0,0 +1,96 @@
+import json
+from http.server import ThreadingHTTPServer
+from threading import Thread
+from urllib.request import urlopen
+
+import pytest
+
+from . import client, listing, serve
+from .query import execute_queries
+from .serve import ScanRequestHandler, ScanServer
+
+
+def test_scan_request(monkeypatch, tmpdir):
+    monkeypatch.chdir(tmpdir)
+    planned = []
+
+    def plan_queries(services, regions, operations, verbose, profile, use_observed_availability):
+        planned.append(services)
+        return [['ecr', region, 'DescribeRepositories', profile] for region in regions]
+
+    def run_raw_listing_operation(service, region, operation, profile, parameters=None):
+        return {'ResponseMetadata': {'HTTPStatusCode': 200}, 'repositories': [{'repositoryName': region}]}
+
+    monkeypatch.setattr(serve, 'plan_queries', plan_queries)
+    monkeypatch.setattr(serve, 'record_durations', lambda durations, profile: None)
+    monkeypatch.setattr(serve, 'update_observed_availability', lambda conclusions, profile: None)
+    monkeypatch.setattr(listing, 'run_raw_listing_operation', run_raw_listing_operation)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ScanRequestHandler)
+    server.scans = ScanServer(parallel=2)
+    Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        url = 'http://127.0.0.1:{}/query?service=ecr&region=eu-west-1&region=eu-west-2'.format(server.server_port)
+        for _ in range(2):
+            records = [json.loads(line) for line in urlopen(url)]
+            assert sorted(record['region'] for record in records) == ['eu-west-1', 'eu-west-2']
+            assert all(record['result'] == '+++' for record in records)
+        # The plan is made once and kept for later scans
+        assert planned == [['ecr']]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_get_plan_ttl(monkeypatch):
+    planned = []
+
+    def plan_queries(services, regions, operations, verbose, profile, use_observed_availability):
+        planned.append(services)
+        if services == ['broken']:
+            raise Exception('Unknown service')
+        return [['ecr', 'eu-west-1', 'DescribeRepositories', profile]]
+
+    monkeypatch.setattr(serve, 'plan_queries', plan_queries)
+    scans = ScanServer(plan_ttl=60)
+    assert scans.get_plan(['ecr'], (), (), now=0) == scans.get_plan(['ecr'], (), (), now=59)
+    assert len(planned) == 1
+    # Expired plans are made again
+    scans.get_plan(['ecr'], (), (), now=60)
+    assert len(planned) == 2
+    # Failed plans are not cached
+    for _ in range(2):
+        with pytest.raises(Exception, match='Unknown service'):
+            scans.get_plan(['broken'], (), (), now=0)
+    assert len(planned) == 4
+
+
+class FakeClient(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSession(object):
+
+    def client(self, service):
+        return FakeClient()
+
+
+def test_scans_keep_clients(monkeypatch):
+    monkeypatch.setattr(client.boto3, 'Session', lambda region_name=None, profile_name=None: FakeSession())
+    monkeypatch.setattr(client, '_CLIENTS', client.OrderedDict())
+    monkeypatch.setattr(client, '_REMAINING_WORK', {})
+    monkeypatch.setattr(client, '_DONE_WORK', set())
+    to_run = [['ecr', 'eu-west-1', 'DescribeRepositories', None]]
+
+    def run(query):
+        return client.get_client(query[0], query[1], query[3])
+
+    first = [result for result, _ in execute_queries(to_run, run, evict_done=False)]
+    second = [result for result, _ in execute_queries(to_run, run, evict_done=False)]
+    # Clients of server scans are reused by later scans
+    assert first == second
+    assert not first[0].closed
+    list(execute_queries(to_run, run))
+    assert first[0].closed
@@ -0,0 +1,24 @@
+from .listing import Listing
+from .store import SnapshotStore
+
+
+def make_listing(repositories, request_id):
+    response = {'ResponseMetadata': {'RequestId': request_id}, 'repositories': repositories}
+    return Listing('ecr', 'eu-west-1', 'DescribeRepositories', response, None)
+
+
+def test_snapshot_store(tmpdir, capsys):
+    store = SnapshotStore(str(tmpdir))
+    first = store.add('ecr.json', make_listing([{'repositoryName': 'a'}], '1'))
+    store.add('ecr_2.json', make_listing([{'repositoryName': 'b'}], '2'))
+    store.close()
+
+    store = SnapshotStore(str(tmpdir))
+    # Only the volatile response metadata differs, so the listing is unchanged and not stored again
+    assert store.add('ecr.json', make_listing([{'repositoryName': 'a'}], '3')) == first
+    store.add('ecr_2.json', make_listing([{'repositoryName': 'c'}], '4'))
+    store.close()
+    assert capsys.readouterr().out.splitlines(
+    )[-1].endswith('2 listings, 1 unchanged since the previous run, 1 new objects stored')
+    assert len(store.get_runs()) == 2
+    assert store.load(first)['resources'] == {'repositories': [{'repositoryName': 'a'}]}
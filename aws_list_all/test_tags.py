@@ -0,0 +1,50 @@
+from .listing import TAGS_KEY, Listing
+from .tags import TagIndex
+
+RESPONSE = {
+    'ResponseMetadata': {
+        'HTTPStatusCode': 200
+    },
+    'Functions': [
+        {
+            'FunctionName': 'a',
+            'FunctionArn': 'arn:aws:lambda:eu-west-1:1:function:a',
+            'Role': 'arn:aws:iam::1:role/r'
+        },
+        {
+            'FunctionName': 'b',
+            'FunctionArn': 'arn:aws:lambda:eu-west-1:1:function:b'
+        },
+    ],
+}
+
+
+def test_enrich():
+    requests = []
+
+    def get_mapping(region, profile):
+        requests.append((region, profile))
+        return {'arn:aws:lambda:eu-west-1:1:function:a': {'team': 'x'}, 'arn:aws:iam::1:role/r': {'team': 'y'}}
+
+    index = TagIndex(get_mapping)
+    listing = Listing('lambda', 'eu-west-1', 'ListFunctions', RESPONSE, None)
+    index.enrich(listing)
+    index.enrich(Listing('lambda', 'eu-west-1', 'ListFunctions', RESPONSE, None))
+    assert requests == [('eu-west-1', None)]
+    assert listing.tags == {'arn:aws:lambda:eu-west-1:1:function:a': {'team': 'x'}}
+    functions = listing.resources['Functions']
+    assert functions[0][TAGS_KEY] == {'team': 'x'}
+    assert TAGS_KEY not in functions[1]
+    # The raw response is left unchanged, and the tags are kept in listing files
+    assert TAGS_KEY not in RESPONSE['Functions'][0]
+    assert Listing.from_json(listing.to_json()).resources == listing.resources
+
+
+def test_enrich_without_tags():
+
+    def get_mapping(region, profile):
+        raise Exception('AccessDenied')
+
+    listing = Listing('lambda', 'eu-west-1', 'ListFunctions', RESPONSE, None)
+    TagIndex(get_mapping).enrich(listing)
+    assert listing.tags == {}
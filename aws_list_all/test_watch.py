@@ -0,0 +1,75 @@
+import boto3
+
+from . import listing as listing_module
+from .listing import Listing, set_request_limiter
+from .watch import RateLimiter, Watcher, get_refresh_interval
+
+
+def make_listing(repositories):
+    response = {'ResponseMetadata': {}, 'repositories': [{'repositoryName': name} for name in repositories]}
+    return Listing('ecr', 'eu-west-1', 'DescribeRepositories', response, None)
+
+
+def test_get_refresh_interval():
+    assert get_refresh_interval('ec2', 'DescribeInstances') == 120
+    assert get_refresh_interval('ec2', 'DescribeVpcs') == 300
+    assert get_refresh_interval('glacier', 'ListVaults', default=7200) == 7200
+
+
+def test_watcher(tmpdir, monkeypatch):
+    monkeypatch.chdir(tmpdir)
+    query = ('ecr', 'eu-west-1', 'DescribeRepositories', None)
+    watcher = Watcher([query], default_interval=60, now=0)
+    assert watcher.pop_due(0) == query
+    assert watcher.pop_due(0) is None
+    # The first listing is the baseline, and unchanged listings are no changes
+    assert watcher.process(query, make_listing(['a']), now=0) is None
+    assert watcher.next_due() == 60
+    assert watcher.pop_due(60) == query
+    assert watcher.process(query, make_listing(['a']), now=60) is None
+    assert watcher.pop_due(120) == query
+    event = watcher.process(query, make_listing(['a', 'b']), now=120)
+    assert event['previous_counts'] == {'repositories': 1}
+    assert event['counts'] == {'repositories': 2}
+    # Failed refreshes are retried on the next interval
+    assert watcher.pop_due(180) == query
+    assert watcher.process(query, None, now=180) is None
+    assert watcher.next_due() == 240
+
+
+class CountingLimiter(object):
+
+    def __init__(self):
+        self.acquired = 0
+
+    def acquire(self):
+        self.acquired += 1
+
+
+def test_rate_limiter():
+    # Rates below one request per second still allow single requests
+    limiter = RateLimiter(0.5)
+    limiter.acquire()
+    assert limiter.tokens < 1
+
+
+def test_request_limiter_counts_segments(monkeypatch):
+
+    class FakeClient(object):
+
+        class meta(object):  # pylint:disable=invalid-name
+            method_to_api_mapping = {'describe_log_groups': 'DescribeLogGroups'}
+            service_model = boto3.client('logs', region_name='eu-west-1').meta.service_model
+
+        def describe_log_groups(self, **parameters):
+            return {'ResponseMetadata': {'HTTPStatusCode': 200}, 'logGroups': []}
+
+    monkeypatch.setattr(listing_module, 'get_client', lambda *args: FakeClient())
+    limiter = CountingLimiter()
+    set_request_limiter(limiter)
+    try:
+        segments = listing_module.get_partitions()['logs']['DescribeLogGroups']
+        Listing.acquire_segments('logs', 'eu-west-1', 'DescribeLogGroups', None, segments)
+    finally:
+        set_request_limiter(None)
+    assert limiter.acquired == len(segments)
@@ -0,0 +1,175 @@
+from __future__ import print_function
+
+import heapq
+import json
+import sys
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from hashlib import sha256
+from threading import Lock
+from time import sleep, time
+
+from .listing import Listing, set_request_limiter
+from .query import save_listing
+from .store import normalize_listing
+
+# Seconds between refreshes of listings of services whose resources change often (default: DEFAULT_REFRESH_INTERVAL)
+DEFAULT_REFRESH_INTERVAL = 3600
+REFRESH_INTERVALS = {
+    'autoscaling': 300,
+    'ec2': 300,
+    'ecs': 300,
+    'eks': 600,
+    'elbv2': 600,
+    'lambda': 300,
+    'rds': 900,
+    's3': 900,
+    'sqs': 900,
+}
+
+# Refresh intervals of single operations that differ from the interval of their service
+OPERATION_REFRESH_INTERVALS = {
+    'ec2': {
+        'DescribeInstances': 120,
+        'DescribeImages': 3600,
+        'DescribeSnapshots': 1800,
+    },
+    'iam': {
+        'ListAccessKeys': 900,
+    },
+}
+
+
+def get_refresh_interval(service, operation, default=DEFAULT_REFRESH_INTERVAL):
+    """Return the seconds between refreshes of the given listing"""
+    if operation in OPERATION_REFRESH_INTERVALS.get(service, {}):
+        return OPERATION_REFRESH_INTERVALS[service][operation]
+    return REFRESH_INTERVALS.get(service, default)
+
+
+class RateLimiter(object):
+    """A token bucket that allows at most rate requests per second on average, and bursts of up to rate requests
+    (but at least one request, so that rates below one request per second can be acquired)"""
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.capacity = max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.last = time()
+        self._lock = Lock()
+
+    def acquire(self):
+        """Wait until a request may be made"""
+        while True:
+            with self._lock:
+                now = time()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait_time = (1 - self.tokens) / self.rate
+            sleep(wait_time)
+
+
+class Watcher(object):
+    """Refreshes listings continuously on their refresh intervals, saves listings whose normalized content changed
+    and returns change events for them"""
+
+    def __init__(self, to_run, default_interval=DEFAULT_REFRESH_INTERVAL, now=None):
+        self.default_interval = default_interval
+        self.digests = {}
+        self.counts = {}
+        now = time() if now is None else now
+        self.schedule = [(now, index, tuple(query)) for index, query in enumerate(to_run)]
+        heapq.heapify(self.schedule)
+
+    def next_due(self):
+        return self.schedule[0][0] if self.schedule else None
+
+    def pop_due(self, now):
+        """Return the next query that is due at the given time, or None"""
+        if self.schedule and self.schedule[0][0] <= now:
+            return heapq.heappop(self.schedule)[2]
+        return None
+
+    def process(self, query, listing, now=None):
+        """Reschedule the given query and return a change event if its listing changed since its last refresh.
+        The listing is None if the refresh failed."""
+        now = time() if now is None else now
+        service, region, operation, profile = query
+        interval = get_refresh_interval(service, operation, self.default_interval)
+        heapq.heappush(self.schedule, (now + interval, id(query), query))
+        if listing is None:
+            return None
+        digest = sha256(normalize_listing(listing)).hexdigest()
+        previous_digest = self.digests.get(query)
+        if digest == previous_digest:
+            return None
+        self.digests[query] = digest
+        previous_counts = self.counts.get(query, {})
+        counts = {key: len(value) for key, value in listing.resources.items() if key != 'truncated'}
+        self.counts[query] = counts
+        save_listing(listing)
+        if previous_digest is None:
+            # The first listing is the baseline for later changes
+            return None
+        return {
+            'time': round(now, 3),
+            'service': service,
+            'region': region,
+            'operation': operation,
+            'profile': profile,
+            'previous_counts': previous_counts,
+            'counts': counts,
+        }
+
+
+def refresh(query):
+    """Acquire the listing of the given query, and return the query and the listing (or None if the query failed)"""
+    try:
+        listing = Listing.acquire(*query)
+        # Derive the resources, which may request auxiliary responses
+        listing.resources  # pylint:disable=pointless-statement
+        return query, listing
+    except Exception:  # pylint:disable=broad-except
+        return query, None
+
+
+def do_watch(to_run, rate=5.0, parallel=8, default_interval=DEFAULT_REFRESH_INTERVAL, duration=None, verbose=0):
+    """Refresh the given queries continuously, at most rate requests per second, and print a JSON line
+    change event for every listing whose normalized content changed. Stops after duration seconds, if given."""
+    watcher = Watcher(to_run, default_interval)
+    # Every API request counts against the budget, including segments and auxiliary requests of listings
+    set_request_limiter(RateLimiter(rate))
+    end_time = time() + duration if duration else None
+    pending = set()
+    print('Watching {} listings...'.format(len(to_run)))
+    with ThreadPoolExecutor(parallel) as executor:
+        while end_time is None or time() < end_time:
+            now = time()
+            while len(pending) < 2 * parallel:
+                query = watcher.pop_due(now)
+                if query is None:
+                    break
+                pending.add(executor.submit(refresh, query))
+            # Wake up for the next due query, but at least every second to check for the end of the run
+            if len(pending) >= 2 * parallel or watcher.next_due() is None:
+                timeout = 1.0
+            else:
+                timeout = min(max(0.0, watcher.next_due() - now), 1.0)
+            if not pending:
+                sleep(timeout)
+                continue
+            done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                query, listing = future.result()
+                if verbose > 1:
+                    print('Refreshed {} {}'.format(query, 'failed' if listing is None else 'successfully'))
+                event = watcher.process(query, listing)
+                if event is not None:
+                    print(json.dumps(event))
+                    sys.stdout.flush()
+        for future in pending:
+            future.cancel()
+    set_request_limiter(None)
+    print('...done')